@@ -1,11 +1,22 @@
+import asyncio
 import json
 import logging
 import sys
-from typing import Annotated
-from fastapi import FastAPI, File, HTTPException
+from typing import Annotated, Awaitable, List, Literal, Union
+import zipfile
+from fastapi import FastAPI, File, Header, HTTPException, Request, Response, UploadFile
+from fastapi.responses import StreamingResponse
 from loguru import logger
 
-from utils import ConverterProxy, FuturesLimitReachedException
+from batch import BatchManager, unpack
+from claim_check import ClaimCheckMissingException
+from compression import ResponseCompressor, parse_accept_encoding
+from formats import UnsupportedFormatException, estimate_cost
+from local import LocalConversionError, LocalConverter
+from metrics import Metrics, hit_ratio, instrument
+from profiling import PROFILERS, SAMPLING, ProfilerBusyException, ProfileRunner
+from tracing import NULL_SPAN, current_span, trace_requests
+from utils import ConversionFailedException, ConversionTimeoutException, ConverterProxy, FuturesLimitReachedException
 
 
 class InterceptHandler(logging.Handler):
@@ -45,20 +56,200 @@ def setup_logging():
     logger.add("logs/errors.log", level="ERROR")
 
 
+class ClientDisconnectedException(Exception):
+    pass
+
+
+async def cancel_on_disconnect(request: Request, awaitable: Awaitable, poll_interval: float = 1):
+    """
+    Awaits the result, cancelling it when the client closes the connection.
+    """
+    task = asyncio.ensure_future(awaitable)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=poll_interval)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            task.cancel()
+            raise ClientDisconnectedException()
+
+
 def create_app():
     app = FastAPI()
     app.converter = ConverterProxy()
+    # Small documents are converted in process when LOCAL_MAX_COST is set
+    app.local_converter = LocalConverter.from_env(app.converter.cache)
+    app.paths = {'local': 0, 'remote': 0}
+    app.compressor = ResponseCompressor.from_env()
+
+    def select_path(estimate: dict) -> str:
+        path = 'local' if app.local_converter.accepts(estimate) else 'remote'
+        app.paths[path] += 1
+        logger.info(f"Estimated conversion cost: {estimate}, conversion path: {path}")
+        return path
+
+    async def convert(data: bytes) -> bytes:
+        estimate = await asyncio.to_thread(estimate_cost, data)
+        if estimate['format'] is None:
+            raise UnsupportedFormatException()
+        if select_path(estimate) == 'local':
+            return await app.local_converter.convert(data)
+        return await app.converter.convert(data, estimate['cost'])
+
+    app.batches = BatchManager.from_env(convert)
+    # Profiling is only available with PROFILE_TOKEN set
+    app.profiler = ProfileRunner.from_env()
+
+    def get_stats() -> dict:
+        return {
+            **app.converter.get_stats(),
+            'cache': app.converter.cache.stats,
+            'paths': app.paths,
+            'local': app.local_converter.stats,
+            'http_compression': app.compressor.stats,
+            'http_compression_cache': app.compressor.cache.stats,
+            'batches': app.batches.stats,
+            'profiles': app.profiler.stats,
+        }
+
+    app.metrics = Metrics('docparse_api')
+    instrument(app, app.metrics)
+    # The proxy tracer records the spans of the API as well
+    app.tracer = app.converter.tracer
+    trace_requests(app, app.tracer)
+    app.metrics.gauge('converter_futures', 'Conversions waiting for a worker reply', lambda: len(app.converter.futures))
+    app.metrics.gauge('converter_futures_limit', 'MAX_CONVERTER_FUTURES (0 - no limit)',
+                      lambda: app.converter.futures_limit)
+    app.metrics.gauge('converter_cost', 'Estimated cost of the conversions in progress', lambda: app.converter.cost)
+    app.metrics.gauge('local_pending', 'Conversions in progress in the local pool',
+                      lambda: app.local_converter.pending)
+    app.metrics.gauge('cache_hit_ratio', 'Share of the cache lookups that found the result',
+                      lambda: hit_ratio(app.converter.cache.stats))
+    app.metrics.gauge('model_load_seconds', 'Model load time by process and model of the local pool',
+                      app.local_converter.model_load, ('pid', 'model'))
+    app.metrics.stats('stats', 'API statistics, the same as GET /stats', get_stats)
 
     # Setup logging for Uvicorn
     setup_logging()
 
+    @app.on_event("startup")
+    async def startup():
+        # Connect before the first request; if the broker is not reachable yet
+        # the connection is retried on the first conversion
+        try:
+            await app.converter.start()
+        except Exception:
+            logger.exception("ConverterProxy initialization failed, will retry on request")
+
+    @app.on_event("shutdown")
+    async def shutdown():
+        await app.batches.close()
+        await app.converter.close()
+        app.local_converter.close()
+        app.profiler.close()
+
     @app.post("/")
-    async def root(file: Annotated[bytes, File()]):
+    async def root(request: Request, file: Annotated[bytes, File()]):
+        estimate = await asyncio.to_thread(estimate_cost, file)
+        if estimate['format'] is None:
+            # Rejected before taking a converter slot, a worker would only fail on it
+            raise HTTPException(status_code=415, detail='Unsupported document format')
+        path = select_path(estimate)
+        span = current_span.get() or NULL_SPAN
+        span.set_attribute('document.bytes', len(file))
+        span.set_attribute('document.cost', estimate['cost'])
+        span.set_attribute('conversion.path', path)
+        accept_encoding = request.headers.get('accept-encoding')
+        accept = parse_accept_encoding(accept_encoding)
+        headers = {'X-Conversion-Path': path}
         try:
-            result = await app.converter.convert(file)
-            return json.loads(result.decode())
+            if path == 'local':
+                result = await cancel_on_disconnect(request, app.local_converter.convert(file))
+                encoding = None
+            else:
+                reply = await cancel_on_disconnect(request, app.converter.convert_reply(
+                    file, estimate['cost'], accept, timing=bool(request.headers.get('x-debug-timing'))))
+                result, encoding = reply.body, reply.encoding
+                if reply.timing is not None:
+                    headers['X-Conversion-Timing'] = json.dumps(reply.timing)
+            # Compressed by the worker results are passed to the client without decoding,
+            # the others are compressed once and kept in the cache of the compressor
+            if not encoding:
+                key = await asyncio.to_thread(app.converter.cache.key, file)
+                result, encoding = await asyncio.to_thread(
+                    app.compressor.encode_cached, key, result, accept_encoding)
+            return Response(content=result, media_type='application/json', headers={
+                **app.compressor.headers(encoding),
+                **headers,
+            })
+        except (LocalConversionError, ConversionFailedException):
+            raise HTTPException(status_code=422, detail='Conversion failed')
+        except UnsupportedFormatException:
+            raise HTTPException(status_code=415, detail='Unsupported document format')
+        except ClaimCheckMissingException:
+            raise HTTPException(status_code=502, detail='Conversion result expired')
         except FuturesLimitReachedException:
             logger.error("Too many requests in progress, try later")
             raise HTTPException(status_code=429, detail='Too many requests in progress, try later')
+        except ConversionTimeoutException:
+            raise HTTPException(status_code=504, detail='Conversion timed out')
+        except ClientDisconnectedException:
+            logger.info("Client disconnected, conversion cancelled")
+            raise HTTPException(status_code=499, detail='Client disconnected')
+
+    @app.post("/batch")
+    async def batch(files: Annotated[List[UploadFile], File()]):
+        documents = []
+        for upload in files:
+            data = await upload.read()
+            try:
+                documents.extend(await asyncio.to_thread(unpack, upload.filename, data, app.batches.max_file_bytes))
+            except zipfile.BadZipFile:
+                raise HTTPException(status_code=400, detail=f'{upload.filename} is not a ZIP archive')
+        if not documents:
+            raise HTTPException(status_code=400, detail='No documents in the batch')
+        if len(documents) > app.batches.max_files:
+            raise HTTPException(status_code=413, detail=f'Too many documents, at most {app.batches.max_files} per batch')
+        batch = await app.batches.submit(documents)
+        # Results are streamed as they finish, the batch id lets the client resume
+        return StreamingResponse(batch.read(), media_type='application/x-ndjson', headers={'X-Batch-Id': batch.id})
+
+    @app.get("/batch/{batch_id}")
+    async def batch_results(batch_id: str, offset: int = 0):
+        batch = app.batches.get(batch_id)
+        if batch is None:
+            raise HTTPException(status_code=404, detail='Batch not found or expired')
+        return StreamingResponse(batch.read(offset), media_type='application/x-ndjson', headers={'X-Batch-Id': batch.id})
+
+    @app.post("/debug/profile", include_in_schema=False)
+    async def profile(file: Annotated[bytes, File()],
+                      x_profile_token: Annotated[Union[str, None], Header()] = None,
+                      profiler: Literal[PROFILERS] = SAMPLING, memory: bool = True,
+                      format: Literal['json', 'profile'] = 'json', top: int = 30):
+        # Not found rather than forbidden, so the endpoint is not advertised
+        if not app.profiler.authorized(x_profile_token):
+            raise HTTPException(status_code=404, detail='Not Found')
+        try:
+            report = await app.profiler.run(file, profiler=profiler, memory=memory, top=top)
+        except ProfilerBusyException:
+            raise HTTPException(status_code=429, detail='Another profile is running, try later')
+        profile_data = report.pop('profile')
+        if format == 'profile':
+            # Folded stacks for flame graph tools, or pstats for snakeviz and flameprof
+            if profiler == SAMPLING:
+                return Response(profile_data, media_type='text/plain')
+            return Response(profile_data, media_type='application/octet-stream',
+                            headers={'Content-Disposition': 'attachment; filename="profile.pstats"'})
+        if profiler == SAMPLING:
+            report['folded'] = profile_data
+        return report
+
+    @app.get("/cache")
+    async def cache_stats():
+        return app.converter.cache.stats
+
+    @app.get("/stats")
+    async def converter_stats():
+        return get_stats()
     
     return app
@@ -1,73 +1,310 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import io
 import json
+import multiprocessing
 import os
-import tempfile
+import re
+import time
 import traceback
+from typing import List, Tuple, Union
 import docx
-from fastapi import FastAPI, Request, UploadFile, File, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form
+from fastapi.responses import HTMLResponse, RedirectResponse, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
 from jinja2 import Template
-from doc_parse import DocHandler, DocHTML, DocJSON
+from loguru import logger
+from cache import ResultCache, conversion_version
+from compression import ResponseCompressor
+from doc_parse import DocHandler, DocHTML, DocJSON, StageTimer, model_load_stats, preload_models
 from doc_parse.conf import CONF
+from metrics import Metrics, ModelLoadTimes, hit_ratio, instrument, size_bucket
+
+
+def convert_document(contents: bytes, max_section_chars: int = 256 * 2 ** 10,
+                     timing: bool = False) -> Tuple[List[str], str, dict, str, float, Union[dict, None]]:
+    """
+    Converts a .docx document to HTML sections and JSON. Runs inside a pool process.
+
+    Args:
+        contents (bytes): The document content.
+        max_section_chars (int, optional): Section size after which a new section starts.
+        timing (bool, optional): Whether to time the conversion stages.
+
+    Returns:
+        tuple: HTML sections, table of contents links, anchors of the sections,
+            JSON content, the conversion time in seconds and the stage timing
+            report (None if timing is off).
+    """
+    start = time.perf_counter()
+    timer = StageTimer() if timing else None
+    doc = docx.Document(io.BytesIO(contents))
+    handler = DocHandler(doc, timer=timer, **CONF)
+
+    # Convert to HTML, split into sections loaded by the viewer on demand
+    html_converter = DocHTML()
+    sections, toc_links, anchors = html_converter.get_sections(handler, max_section_chars)
+
+    # Convert to JSON
+    try:
+        json_converter = DocJSON()
+        json_content = json_converter.get_json(handler)
+    except Exception as ex:
+        tb = ''.join(traceback.TracebackException.from_exception(ex).format())
+        json_content = json.dumps({'result': 'Failed', 'traceback': tb})
+    report = timer.report() if timer is not None else None
+    return sections, toc_links, anchors, json_content, time.perf_counter() - start, report
+
+
+def server_timing(queue_time: float, convert_time: float, report: Union[dict, None] = None) -> str:
+    """
+    Makes the Server-Timing header value: the queue and conversion times, and the
+    conversion stages when they were timed.
+    """
+    metrics = [f'queue;dur={queue_time * 1000:.0f}', f'convert;dur={convert_time * 1000:.0f}']
+    if report is not None:
+        for name, stage in report['stages'].items():
+            # Metric names are tokens, the dots of the nested stages are not allowed
+            metrics.append(f'{name.replace(".", "-")};dur={stage["seconds"] * 1000:.1f}')
+    return ', '.join(metrics)
+
+
+def init_process(load_times: multiprocessing.Queue):
+    """
+    Loads the models of a pool process and reports their load times.
+    """
+    preload_models()
+    load_times.put((os.getpid(), model_load_stats()))
+
+
+RESULT_ID = re.compile('[0-9a-f]{64}')
+
+
+def load_template(path: str) -> Template:
+    with open(path, 'r') as f:
+        return Template(f.read())
+
+
+def store_document(results: ResultCache, result_id: str, sections: List[str], toc_links: str,
+                   anchors: dict, json_content: str):
+    """
+    Stores a converted document: the JSON result, every HTML section and the
+    index of the sections.
+    """
+    results.put(result_id, json_content.encode())
+    for index, section in enumerate(sections):
+        results.put(f'{result_id}.{index}', section.encode())
+    document = {'sections': len(sections), 'toc_links': toc_links, 'anchors': anchors}
+    results.put(f'{result_id}.index', json.dumps(document).encode())
+
+
+def load_document(results: ResultCache, result_id: str) -> Union[dict, None]:
+    """
+    Loads the index of the stored document sections.
+    """
+    document = results.get(f'{result_id}.index')
+    return json.loads(document) if document is not None else None
+
+
+def document_complete(results: ResultCache, result_id: str, document: dict) -> bool:
+    """
+    Checks whether the JSON result and every section of a stored document are
+    still in the store. Each of them is evicted and expires on its own, a
+    document missing any of them is converted and stored again.
+    """
+    keys = [result_id] + [f'{result_id}.{index}' for index in range(document['sections'])]
+    return all(results.contains(key) for key in keys)
+
+
+def load_section(results: ResultCache, result_id: str, index: int) -> Union[str, None]:
+    section = results.get(f'{result_id}.{index}')
+    return section.decode() if section is not None else None
+
 
 def create_app():
     app = FastAPI()
-    upload_folder = 'uploads/'
     max_content_length = 16 * 1024 * 1024  # 16 MB max file size
+    # Conversions run in a process pool, so a large document does not block
+    # the event loop and other viewers
+    processes = int(os.environ.get('VIEWER_PROCESSES', default='1'))
+    max_pending = int(os.environ.get('VIEWER_MAX_PENDING', default=str(2 * processes)))
+    max_section_chars = int(os.environ.get('VIEWER_SECTION_KB', default='256')) * 2 ** 10
+    # Stage timing of every conversion, or of the requests with the X-Debug-Timing header
+    timing = os.environ.get('VIEWER_TIMING') == '1'
+    load_times = ModelLoadTimes()
+    app.executor = ProcessPoolExecutor(max_workers=processes, initializer=init_process,
+                                       initargs=(load_times.queue,))
+    app.pending = 0
+    # Templates are compiled once instead of on every request
+    upload_template = load_template('templates/upload.html')
+    result_template = load_template('templates/result.html')
+    # JSON results are stored by the document content, so concurrent users never
+    # overwrite each other's results and downloads never reconvert
+    app.results = ResultCache(
+        memory_bytes=int(os.environ.get('VIEWER_RESULTS_MB', default='64')) * 2 ** 20,
+        directory=os.environ.get('VIEWER_RESULTS_DIR') or None,
+        disk_bytes=int(os.environ.get('VIEWER_RESULTS_DISK_MB', default='1024')) * 2 ** 20,
+        version=conversion_version(),
+        ttl=float(os.environ.get('VIEWER_RESULTS_TTL', default='3600'))
+    )
+    app.compressor = ResponseCompressor.from_env()
+    app.stats = {
+        'requests': 0,
+        'cached': 0,
+        'rejected': 0,
+        'failed': 0,
+        'queue_seconds': 0.0,
+        'convert_seconds': 0.0,
+    }
+
+    def get_stats() -> dict:
+        return {
+            **app.stats,
+            'pending': app.pending,
+            'results': app.results.stats,
+            'http_compression': app.compressor.stats,
+            'http_compression_cache': app.compressor.cache.stats,
+        }
+
+    app.metrics = Metrics('docparse_viewer')
+    instrument(app, app.metrics)
+    queue_wait = app.metrics.histogram('queue_wait_seconds', 'Time a document waits for a conversion process')
+    conversion_time = app.metrics.histogram(
+        'conversion_seconds', 'Conversion time of a document by its size bucket', ('size',))
+    app.metrics.gauge('pending', 'Conversions in progress or queued', lambda: app.pending)
+    app.metrics.gauge('max_pending', 'VIEWER_MAX_PENDING', lambda: max_pending)
+    app.metrics.gauge('results_hit_ratio', 'Share of the result store lookups that found the result',
+                      lambda: hit_ratio(app.results.stats))
+    app.metrics.gauge('model_load_seconds', 'Model load time by process and model', load_times.get, ('pid', 'model'))
+    app.metrics.stats('stats', 'Viewer statistics, the same as GET /stats', get_stats)
+
+    @app.on_event("shutdown")
+    def shutdown():
+        app.executor.shutdown(cancel_futures=True)
+
+    async def compressed_response(request: Request, content: Union[str, bytes], media_type: str = 'text/html',
+                                  key: Union[str, None] = None, headers: Union[dict, None] = None) -> Response:
+        # Stored content is compressed once, the compressor keeps the compressed variants
+        if isinstance(content, str):
+            content = content.encode()
+        accept_encoding = request.headers.get('accept-encoding')
+        if key is None:
+            content, encoding = await asyncio.to_thread(app.compressor.encode, content, accept_encoding)
+        else:
+            content, encoding = await asyncio.to_thread(
+                app.compressor.encode_cached, key, content, accept_encoding)
+        return Response(content, media_type=media_type, headers={**app.compressor.headers(encoding), **(headers or {})})
 
     @app.get("/", response_class=HTMLResponse)
     async def upload_file_form():
-        with open('templates/upload.html', 'r') as f:
-            template = Template(f.read())
-        return template.render()
+        return upload_template.render()
 
     @app.post("/", response_class=HTMLResponse)
-    async def upload_file(file: UploadFile = File(...)):
+    async def upload_file(request: Request, file: UploadFile = File(...)):
         if not file.filename.endswith(('.doc', '.docx')):
             return RedirectResponse(url="/", status_code=303)
 
-        # Read DOC
-        temp_file = tempfile.NamedTemporaryFile(delete=False)
+        # Read DOC, the upload is parsed from memory without temporary files
+        contents = await file.read()
+        app.stats['requests'] += 1
+        result_id = app.results.key(contents)
+
+        # The same document uploaded again is served from the store
+        document = await asyncio.to_thread(load_document, app.results, result_id)
+        first_section = None
+        if document is not None:
+            if await asyncio.to_thread(document_complete, app.results, result_id, document):
+                first_section = await asyncio.to_thread(load_section, app.results, result_id, 0)
+            else:
+                logger.info(f"Document {file.filename} partially evicted from the result store, converting again")
+        if first_section is not None:
+            app.stats['cached'] += 1
+            logger.info(f"Document {file.filename} found in the result store (id: {result_id})")
+            return await compressed_response(request, result_template.render(
+                first_section=first_section,
+                sections=document['sections'],
+                toc_links=document['toc_links'],
+                result_id=result_id
+            ))
+
+        if app.pending >= max_pending:
+            app.stats['rejected'] += 1
+            logger.error("Too many conversions in progress, try later")
+            raise HTTPException(status_code=429, detail='Too many conversions in progress, try later')
+
+        start = time.perf_counter()
+        app.pending += 1
         try:
-            contents = await file.read()
-            temp_file.write(contents)
-            temp_file.flush()
-            doc = docx.Document(temp_file.name)
-            handler = DocHandler(doc, **CONF)
-
-            # Convert to HTML
-            html_converter = DocHTML()
-            html_content, toc_links = html_converter.get_html(handler)
-
-            # Convert to JSON
-            try:
-                json_converter = DocJSON()
-                json_content = json_converter.get_json(handler)
-            except Exception as ex:
-                tb = ''.join(traceback.TracebackException.from_exception(ex).format())
-                json_content = json.dumps({'result': 'Failed', 'traceback': tb})
-
-            json_file_path = os.path.join(upload_folder, 'output.json')
-            with open(json_file_path, 'w') as json_file:
-                json_file.write(json_content)
-
-            with open('templates/result.html', 'r') as f:
-                template = Template(f.read())
-            return template.render(
-                html_content=html_content,
-                toc_links=toc_links,
-                json_file_path=json_file_path
-            )
+            sections, toc_links, anchors, json_content, convert_time, report = await asyncio.get_running_loop().run_in_executor(
+                app.executor, convert_document, contents, max_section_chars,
+                timing or bool(request.headers.get('x-debug-timing')))
+        except Exception:
+            app.stats['failed'] += 1
+            raise
         finally:
-            temp_file.close()
-            os.unlink(temp_file.name)
+            app.pending -= 1
+        total_time = time.perf_counter() - start
+        queue_time = max(total_time - convert_time, 0)
+        app.stats['queue_seconds'] += queue_time
+        app.stats['convert_seconds'] += convert_time
+        queue_wait.observe(queue_time)
+        conversion_time.observe(convert_time, size_bucket(len(contents)))
+        logger.info(f"Document {file.filename} converted in {convert_time:.2f}s (queued {queue_time:.2f}s)")
+        headers = {'Server-Timing': server_timing(queue_time, convert_time, report)}
+        if report is not None:
+            logger.info(f"Document {file.filename} conversion timing: {report}")
+            headers['X-Conversion-Timing'] = json.dumps(report)
+
+        await asyncio.to_thread(store_document, app.results, result_id, sections, toc_links, anchors, json_content)
+
+        # Only the first section is sent with the page, the rest is loaded by the viewer
+        return await compressed_response(
+            request,
+            result_template.render(
+                first_section=sections[0],
+                sections=len(sections),
+                toc_links=toc_links,
+                result_id=result_id
+            ),
+            headers=headers
+        )
+
+    @app.get("/stats")
+    async def stats():
+        return get_stats()
+
+    @app.get("/section", response_class=HTMLResponse)
+    async def section(request: Request, id: str, index: Union[int, None] = None, anchor: Union[str, None] = None):
+        if not RESULT_ID.fullmatch(id):
+            raise HTTPException(status_code=404, detail='Result not found')
+        if index is None:
+            # Any anchor of the table of contents, resolved to its section
+            document = await asyncio.to_thread(load_document, app.results, id)
+            if document is None or anchor not in document['anchors']:
+                raise HTTPException(status_code=404, detail='Section not found or expired, upload the document again')
+            index = document['anchors'][anchor]
+        key = f'{id}.{index}'
+        section_content = await asyncio.to_thread(app.results.get, key)
+        if section_content is None:
+            raise HTTPException(status_code=404, detail='Section not found or expired, upload the document again')
+        return await compressed_response(request, section_content, key=key, headers={'X-Section-Index': str(index)})
 
     @app.get("/download_json")
-    async def download_json(path: str):
-        return FileResponse(path, media_type='application/json', filename='output.json')
+    async def download_json(request: Request, id: str):
+        # Only ids made by the store, anything else could point outside its directory
+        if not RESULT_ID.fullmatch(id):
+            raise HTTPException(status_code=404, detail='Result not found')
+        json_content = await asyncio.to_thread(app.results.get, id)
+        if json_content is None:
+            raise HTTPException(status_code=404, detail='Result not found or expired, upload the document again')
+        return await compressed_response(
+            request,
+            json_content,
+            media_type='application/json',
+            key=id,
+            headers={'Content-Disposition': 'attachment; filename="output.json"'}
+        )
 
-    os.makedirs(upload_folder, exist_ok=True)
     return app
 
 app = create_app()
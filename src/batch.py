@@ -0,0 +1,297 @@
+import asyncio
+from functools import partial
+from io import BytesIO
+import json
+import os
+import tempfile
+import time
+from typing import AsyncIterator, Awaitable, Callable, List, Tuple, Union
+import uuid
+import zipfile
+from loguru import logger
+from claim_check import ClaimCheckMissingException
+from formats import UnsupportedFormatException
+from local import LocalConversionError
+from utils import ConversionFailedException, ConversionTimeoutException, FuturesLimitReachedException
+
+
+DOCUMENT_EXTENSIONS = ('.doc', '.docx')
+
+
+class FileTooLargeException(Exception):
+    pass
+
+
+# Errors reported for a file, with the status code the single document endpoint returns
+ERROR_STATUS = [
+    (FileTooLargeException, 413, 'File is too large'),
+    (UnsupportedFormatException, 415, 'Unsupported document format'),
+    (LocalConversionError, 422, 'Conversion failed'),
+    (ConversionFailedException, 422, 'Conversion failed'),
+    (FuturesLimitReachedException, 429, 'Too many requests in progress'),
+    (ClaimCheckMissingException, 502, 'Conversion result expired'),
+    (ConversionTimeoutException, 504, 'Conversion timed out'),
+]
+
+
+def read_data(filename: str, data: bytes, max_file_bytes: int) -> bytes:
+    if len(data) > max_file_bytes:
+        raise FileTooLargeException(f'{filename} is {len(data)} bytes')
+    return data
+
+
+def read_entry(archive: zipfile.ZipFile, info: zipfile.ZipInfo, max_file_bytes: int) -> bytes:
+    if info.file_size > max_file_bytes:
+        raise FileTooLargeException(f'{info.filename} is {info.file_size} bytes')
+    return archive.read(info)
+
+
+def unpack(filename: str, data: bytes, max_file_bytes: int) -> List[Tuple[str, Callable[[], bytes]]]:
+    """
+    Lists the documents of an upload: the file itself, or the documents of a ZIP
+    archive. Archive entries are read on demand, so only the archive is kept in memory.
+
+    Args:
+        filename (str): The uploaded file name.
+        data (bytes): The uploaded file content.
+        max_file_bytes (int): Largest document, uploaded or read from an archive.
+
+    Returns:
+        List[Tuple[str, Callable[[], bytes]]]: Document names and functions reading their content.
+
+    Raises:
+        zipfile.BadZipFile: If a .zip upload is not a ZIP archive.
+    """
+    if not filename.lower().endswith('.zip'):
+        return [(filename, partial(read_data, filename, data, max_file_bytes))]
+    archive = zipfile.ZipFile(BytesIO(data))
+    return [
+        (f'{filename}/{info.filename}', partial(read_entry, archive, info, max_file_bytes))
+        for info in archive.infolist()
+        if not info.is_dir() and info.filename.lower().endswith(DOCUMENT_EXTENSIONS)
+        and not info.filename.startswith('__MACOSX/')
+    ]
+
+
+def append_line(path: str, line: bytes):
+    with open(path, 'ab') as f:
+        f.write(line)
+
+
+def read_range(path: str, start: int, end: int) -> bytes:
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(end - start)
+
+
+class Batch:
+    """
+    A batch of documents converted in the background. Results are appended to an
+    NDJSON file as the documents finish, so readers may start from any line and a
+    client that lost the connection resumes where it stopped.
+    """
+
+    def __init__(self, batch_id: str, path: str, total: int):
+        self.id = batch_id
+        self.path = path
+        self.total = total
+        # Byte offset of every line in the file and of its end
+        self.offsets = [0]
+        self.created = time.time()
+        self.finished = None
+        self.task = None
+        self.updated = asyncio.Event()
+        self.write_lock = asyncio.Lock()
+        self.stats = {
+            'converted': 0,
+            'failed': 0,
+            'retries': 0,
+        }
+
+    @property
+    def lines(self) -> int:
+        return len(self.offsets) - 1
+
+    async def append(self, line: dict):
+        line = (json.dumps({'batch_id': self.id, **line}, ensure_ascii=False) + '\n').encode()
+        await self.append_raw(line)
+
+    async def append_raw(self, line: bytes):
+        async with self.write_lock:
+            await asyncio.to_thread(append_line, self.path, line)
+            self.offsets.append(self.offsets[-1] + len(line))
+        self.notify()
+
+    def notify(self):
+        updated, self.updated = self.updated, asyncio.Event()
+        updated.set()
+
+    async def read(self, offset: int = 0) -> AsyncIterator[bytes]:
+        """
+        Streams the result lines, waiting for new ones until the batch is finished.
+
+        Args:
+            offset (int): Number of lines to skip.
+        """
+        while True:
+            updated = self.updated
+            end = self.lines
+            if offset < end:
+                yield await asyncio.to_thread(read_range, self.path, self.offsets[offset], self.offsets[end])
+                offset = end
+                continue
+            if self.finished is not None:
+                return
+            await updated.wait()
+
+
+class BatchManager:
+    """
+    Converts batches of documents with a concurrency cap per batch. A file whose
+    conversion is rejected because the converter is busy is retried with a
+    backoff instead of failing the whole batch.
+    """
+
+    def __init__(self, convert: Callable[[bytes], Awaitable[bytes]], directory: Union[str, None] = None,
+                 concurrency: int = 4, max_files: int = 1000, max_file_bytes: int = 64 * 2 ** 20,
+                 ttl: float = 3600, retries: int = 20, retry_delay: float = 0.5):
+        """
+        Initializes the BatchManager.
+
+        Args:
+            convert (Callable[[bytes], Awaitable[bytes]]): Converts a document to JSON.
+            directory (str, optional): Directory for the result files, a temporary one if not set.
+            concurrency (int): Documents of a batch converted at the same time.
+            max_files (int): Largest number of documents in a batch.
+            max_file_bytes (int): Largest document, uploaded or read from an archive.
+            ttl (float): Seconds a finished batch can be resumed.
+            retries (int): Attempts to convert a document rejected by the busy converter.
+            retry_delay (float): First delay between the attempts in seconds, doubled
+                on every retry up to 10 times.
+        """
+        self.convert = convert
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'batches')
+        self.concurrency = concurrency
+        self.max_files = max_files
+        self.max_file_bytes = max_file_bytes
+        self.ttl = ttl
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.batches = {}
+        self.stats = {
+            'batches': 0,
+            'files': 0,
+            'converted': 0,
+            'failed': 0,
+            'retries': 0,
+        }
+        os.makedirs(self.directory, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, convert: Callable[[bytes], Awaitable[bytes]]):
+        return cls(
+            convert,
+            directory=os.environ.get('BATCH_DIR') or None,
+            concurrency=int(os.environ.get('BATCH_CONCURRENCY', default='4')),
+            max_files=int(os.environ.get('BATCH_MAX_FILES', default='1000')),
+            max_file_bytes=int(os.environ.get('BATCH_MAX_FILE_MB', default='64')) * 2 ** 20,
+            ttl=float(os.environ.get('BATCH_TTL', default='3600')),
+            retries=int(os.environ.get('BATCH_RETRIES', default='20')),
+            retry_delay=float(os.environ.get('BATCH_RETRY_DELAY', default='0.5'))
+        )
+
+    def get(self, batch_id: str) -> Union[Batch, None]:
+        return self.batches.get(batch_id)
+
+    async def submit(self, files: List[Tuple[str, Callable[[], bytes]]]) -> Batch:
+        """
+        Starts converting a batch in the background.
+
+        Args:
+            files (List[Tuple[str, Callable[[], bytes]]]): Document names and
+                functions reading their content, see `unpack`.
+
+        Returns:
+            Batch: The started batch.
+        """
+        await asyncio.to_thread(self.cleanup)
+        batch_id = uuid.uuid4().hex
+        batch = Batch(batch_id, os.path.join(self.directory, f'{batch_id}.ndjson'), len(files))
+        self.batches[batch_id] = batch
+        self.stats['batches'] += 1
+        self.stats['files'] += len(files)
+        # The batch goes on if the client disconnects, the results can be read later
+        batch.task = asyncio.ensure_future(self.run(batch, files))
+        logger.info(f"Batch {batch_id} started ({len(files)} files)")
+        return batch
+
+    async def run(self, batch: Batch, files: List[Tuple[str, Callable[[], bytes]]]):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            await asyncio.gather(*[
+                self.convert_file(batch, semaphore, index, name, read)
+                for index, (name, read) in enumerate(files)
+            ])
+            await batch.append({'status': 'done', 'total': batch.total, **batch.stats})
+        finally:
+            batch.finished = time.time()
+            batch.notify()
+            logger.info(f"Batch {batch.id} finished: {batch.stats}")
+
+    async def convert_file(self, batch: Batch, semaphore: asyncio.Semaphore, index: int, name: str,
+                           read: Callable[[], bytes]):
+        line = {'index': index, 'filename': name}
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                result = await self.convert_retrying(batch, await asyncio.to_thread(read))
+            except Exception as e:
+                status_code, detail = 500, 'Conversion failed'
+                for error, error_status_code, error_detail in ERROR_STATUS:
+                    if isinstance(e, error):
+                        status_code, detail = error_status_code, error_detail
+                        break
+                if status_code == 500:
+                    logger.exception(f"Batch {batch.id} file {name} failed")
+                batch.stats['failed'] += 1
+                self.stats['failed'] += 1
+                await batch.append({**line, 'status': 'error', 'status_code': status_code, 'detail': detail})
+                return
+            line['seconds'] = round(time.perf_counter() - start, 3)
+            batch.stats['converted'] += 1
+            self.stats['converted'] += 1
+            # The result is JSON on a single line already, it is embedded without parsing
+            prefix = json.dumps({'batch_id': batch.id, **line, 'status': 'ok'}, ensure_ascii=False)[:-1]
+            await batch.append_raw(prefix.encode() + b', "result": ' + result + b'}\n')
+
+    async def convert_retrying(self, batch: Batch, data: bytes) -> bytes:
+        for attempt in range(self.retries + 1):
+            try:
+                return await self.convert(data)
+            except FuturesLimitReachedException:
+                if attempt == self.retries:
+                    raise
+            batch.stats['retries'] += 1
+            self.stats['retries'] += 1
+            await asyncio.sleep(self.retry_delay * 2 ** min(attempt, 10))
+
+    def cleanup(self):
+        """
+        Forgets batches finished more than the TTL ago and removes their results.
+        """
+        now = time.time()
+        for batch_id, batch in list(self.batches.items()):
+            if batch.finished is not None and batch.finished < now - self.ttl:
+                del self.batches[batch_id]
+        # Result files of the batches from before a restart are removed as well
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name[:-len('.ndjson')] not in self.batches and entry.stat().st_mtime < now - self.ttl:
+                    os.remove(entry.path)
+            except OSError:
+                continue
+
+    async def close(self):
+        for batch in self.batches.values():
+            if batch.task is not None:
+                batch.task.cancel()
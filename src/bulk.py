@@ -0,0 +1,273 @@
+import argparse
+from concurrent.futures import FIRST_COMPLETED, Executor, ProcessPoolExecutor, wait
+from io import BytesIO
+import json
+import os
+import time
+from typing import Callable, Iterable, List, Union
+from loguru import logger
+from formats import DOC, detect_format
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+NDJSON = 'ndjson'
+PARQUET = 'parquet'
+ARROW = 'arrow'
+OUTPUT_FORMATS = (NDJSON, PARQUET, ARROW)
+DOCUMENT_EXTENSIONS = ('.doc', '.docx')
+MANIFEST_NAME = 'manifest.json'
+REPORT_NAME = 'report.json'
+
+
+def find_documents(input_dir: str) -> List[str]:
+    """
+    Lists .doc and .docx documents under the directory, relative to it.
+    """
+    documents = []
+    for root, _, files in os.walk(input_dir):
+        for name in files:
+            # Skips the lock files Word leaves next to open documents
+            if name.lower().endswith(DOCUMENT_EXTENSIONS) and not name.startswith('~$'):
+                documents.append(os.path.relpath(os.path.join(root, name), input_dir))
+    return sorted(documents)
+
+
+def convert_path(input_dir: str, path: str) -> dict:
+    """
+    Converts a document to JSON. Runs inside a pool process.
+
+    Args:
+        input_dir (str): The input directory.
+        path (str): The document path relative to the input directory.
+
+    Returns:
+        dict: The output record: path, status, error, size, conversion time in
+            seconds and the JSON result.
+    """
+    # Imported on demand, only pool processes need the models and Aspose.Words
+    from doc_parse import doc_to_docx, docx_to_json
+
+    start = time.perf_counter()
+    record = {'path': path, 'status': 'ok', 'error': None, 'size': 0, 'seconds': 0.0, 'result': None}
+    try:
+        with open(os.path.join(input_dir, path), 'rb') as f:
+            data = f.read()
+        record['size'] = len(data)
+        if detect_format(data) == DOC:
+            out_stream = BytesIO()
+            doc_to_docx(BytesIO(data), out_stream)
+            data = out_stream.getvalue()
+        record['result'] = docx_to_json(BytesIO(data))
+    except Exception as e:
+        logger.exception(f"Error during conversion of {path}")
+        record['status'] = 'error'
+        record['error'] = f'{type(e).__name__}: {e}'
+    record['seconds'] = time.perf_counter() - start
+    return record
+
+
+def write_ndjson(path: str, records: List[dict]):
+    with open(path, 'wb') as f:
+        for record in records:
+            line = {key: value for key, value in record.items() if key != 'result'}
+            line = json.dumps(line, ensure_ascii=False)
+            if record['result'] is None:
+                f.write(f'{line}\n'.encode())
+            else:
+                # The result is JSON on a single line already, it is embedded without parsing
+                f.write(f'{line[:-1]}, "result": {record["result"]}}}\n'.encode())
+
+
+def write_arrow(path: str, records: List[dict], output_format: str):
+    table = pyarrow.Table.from_pylist(records, schema=pyarrow.schema([
+        ('path', pyarrow.string()),
+        ('status', pyarrow.string()),
+        ('error', pyarrow.string()),
+        ('size', pyarrow.int64()),
+        ('seconds', pyarrow.float64()),
+        ('result', pyarrow.large_string()),
+    ]))
+    if output_format == PARQUET:
+        pyarrow.parquet.write_table(table, path)
+        return
+    with pyarrow.OSFile(path, 'wb') as sink:
+        with pyarrow.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def summarize(records: Iterable[dict], elapsed: float, skipped: int, top: int) -> dict:
+    """
+    Makes the run report: documents per second, per-file timings and the slowest files.
+    """
+    records = list(records)
+    seconds = sorted(record['seconds'] for record in records)
+
+    def percentile(q: float) -> float:
+        return round(seconds[min(len(seconds) - 1, int(q * len(seconds)))], 3) if seconds else 0.0
+
+    slowest = sorted(records, key=lambda record: record['seconds'], reverse=True)[:top]
+    return {
+        'documents': len(records),
+        'converted': sum(record['status'] == 'ok' for record in records),
+        'failed': sum(record['status'] != 'ok' for record in records),
+        'skipped': skipped,
+        'seconds': round(elapsed, 3),
+        'docs_per_second': round(len(records) / elapsed, 3) if elapsed else 0.0,
+        'file_seconds': {
+            'mean': round(sum(seconds) / len(seconds), 3) if seconds else 0.0,
+            'p50': percentile(0.5),
+            'p95': percentile(0.95),
+            'max': percentile(1),
+        },
+        'slowest': [{'path': record['path'], 'seconds': round(record['seconds'], 3), 'size': record['size']}
+                    for record in slowest],
+    }
+
+
+class BulkConverter:
+    """
+    Converts a directory of documents into shards of NDJSON, Parquet or Arrow
+    files. The manifest lists the written shards and the documents in them, so
+    an interrupted run resumes without converting them again.
+    """
+
+    def __init__(self, output_dir: str, output_format: str = NDJSON, shard_size: int = 200,
+                 window: int = 8, top: int = 10):
+        """
+        Initializes the BulkConverter.
+
+        Args:
+            output_dir (str): Directory for the shards, the manifest and the report.
+            output_format (str): NDJSON, PARQUET or ARROW.
+            shard_size (int): Documents per shard.
+            window (int): Documents submitted to the pool ahead of the finished ones.
+            top (int): Number of the slowest files in the report.
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f'Unsupported output format {output_format}')
+        if output_format != NDJSON and pyarrow is None:
+            raise ValueError(f'{output_format} output needs the pyarrow package')
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.shard_size = shard_size
+        self.window = window
+        self.top = top
+        self.manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        os.makedirs(output_dir, exist_ok=True)
+        self.manifest = self.load_manifest()
+
+    def load_manifest(self) -> dict:
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return {'format': self.output_format, 'shards': [], 'files': {}}
+        if manifest['format'] != self.output_format:
+            raise ValueError(f"{self.output_dir} holds {manifest['format']} output, not {self.output_format}")
+        return manifest
+
+    def save_manifest(self):
+        tmp_path = f'{self.manifest_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+
+    def write_shard(self, records: List[dict]):
+        name = f"part-{len(self.manifest['shards']):05d}.{self.output_format}"
+        path = os.path.join(self.output_dir, name)
+        tmp_path = f'{path}.tmp'
+        if self.output_format == NDJSON:
+            write_ndjson(tmp_path, records)
+        else:
+            write_arrow(tmp_path, records, self.output_format)
+        os.replace(tmp_path, path)
+        # The manifest is updated after the shard is complete, an interrupted
+        # run loses at most the documents of the shard being collected
+        self.manifest['shards'].append(name)
+        for record in records:
+            self.manifest['files'][record['path']] = {
+                'status': record['status'],
+                'seconds': round(record['seconds'], 3),
+                'shard': name,
+            }
+        self.save_manifest()
+
+    def run(self, executor: Executor, input_dir: str,
+            convert: Callable[[str, str], dict] = convert_path) -> dict:
+        """
+        Converts the documents not converted by the previous runs.
+
+        Args:
+            executor (Executor): Pool running the conversions.
+            input_dir (str): Directory with the documents.
+            convert (Callable[[str, str], dict]): Conversion function, see `convert_path`.
+
+        Returns:
+            dict: The run report, also written to report.json.
+        """
+        documents = find_documents(input_dir)
+        pending = [path for path in documents if path not in self.manifest['files']]
+        skipped = len(documents) - len(pending)
+        logger.info(f"Found {len(documents)} documents, {skipped} converted by previous runs")
+        self.save_manifest()
+
+        start = time.perf_counter()
+        timings = []
+        shard = []
+        running = set()
+        queued = iter(pending)
+        while True:
+            for path in queued:
+                running.add(executor.submit(convert, input_dir, path))
+                if len(running) >= self.window:
+                    break
+            if not running:
+                break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                record = future.result()
+                timings.append({key: record[key] for key in ('path', 'status', 'size', 'seconds')})
+                shard.append(record)
+            if len(shard) >= self.shard_size:
+                self.write_shard(shard)
+                shard = []
+                elapsed = time.perf_counter() - start
+                logger.info(f"Converted {len(timings)}/{len(pending)} documents, {len(timings) / elapsed:.2f} docs/s")
+        if shard:
+            self.write_shard(shard)
+
+        report = summarize(timings, time.perf_counter() - start, skipped, self.top)
+        with open(os.path.join(self.output_dir, REPORT_NAME), 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        logger.info(f"Bulk conversion report: {report}")
+        return report
+
+
+def main(args: Union[List[str], None] = None):
+    parser = argparse.ArgumentParser(description='Converts a directory of .doc/.docx documents to JSON')
+    parser.add_argument('input_dir', help='Directory with the documents, searched recursively')
+    parser.add_argument('output_dir', help='Directory for the output shards, the manifest and the report')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default=NDJSON, help='Output format')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Number of conversion processes')
+    parser.add_argument('--shard-size', type=int, default=200, help='Documents per output shard')
+    parser.add_argument('--torch-threads', type=int, default=1, help='Intra-op threads per process')
+    parser.add_argument('--top', type=int, default=10, help='Number of the slowest files in the report')
+    args = parser.parse_args(args)
+
+    # Imported on demand, the models are loaded by the pool processes only
+    from worker import init_process
+
+    converter = BulkConverter(args.output_dir, args.format, args.shard_size, window=2 * args.processes, top=args.top)
+    with ProcessPoolExecutor(max_workers=args.processes, initializer=init_process,
+                             initargs=(args.torch_threads,)) as executor:
+        report = converter.run(executor, args.input_dir)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+import time
+from typing import Union
+from loguru import logger
+
+
+def conversion_version(conf_path: str = 'doc_parse/conf.yaml', model_dir: str = 'model_dir') -> str:
+    """
+    Fingerprints everything besides the input document that affects conversion
+    results: the doc_parse config and the model files.
+
+    Args:
+        conf_path (str): Path to the doc_parse config.
+        model_dir (str): Directory with the classifier models.
+
+    Returns:
+        str: The version hash. MODEL_VERSION environment variable replaces the
+            model files fingerprint when set.
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(conf_path, 'rb') as f:
+            digest.update(f.read())
+    except OSError:
+        pass
+    model_version = os.environ.get('MODEL_VERSION')
+    if model_version:
+        digest.update(model_version.encode())
+    else:
+        for root, dirs, files in sorted(os.walk(model_dir)):
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                digest.update(f'{os.path.relpath(path, model_dir)}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return digest.hexdigest()
+
+
+def content_key(data: bytes, version: str = '') -> str:
+    """
+    Makes a cache key of the document content and the conversion version.
+    """
+    digest = hashlib.sha256(data)
+    digest.update(version.encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Conversion results cache with a bounded in-memory LRU tier and an optional
+    disk tier evicted by size. The disk tier may be shared by several processes.
+    """
+
+    def __init__(self, memory_bytes: int = 64 * 2 ** 20, directory: Union[str, None] = None,
+                 disk_bytes: int = 2 ** 30, version: str = '', ttl: float = 0):
+        """
+        Initializes the ResultCache.
+
+        Args:
+            memory_bytes (int): Size of the in-memory tier (0 - disabled).
+            directory (str, optional): Directory of the disk tier (None - disabled).
+            disk_bytes (int): Size of the disk tier.
+            version (str): Conversion version mixed into the keys.
+            ttl (float): Seconds after the last use when a result expires (0 - never).
+        """
+        self.memory = OrderedDict()
+        self.memory_used = {}
+        self.ttl = ttl
+        self.memory_bytes = memory_bytes
+        self.memory_size = 0
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.version = version
+        self.lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'bytes_saved': 0,
+            'stored': 0,
+            'evicted': 0,
+            'expired': 0,
+        }
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self.disk_size = sum(size for _, _, size in self.disk_entries())
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            memory_bytes=int(os.environ.get('CACHE_MEMORY_MB', default='64')) * 2 ** 20,
+            directory=os.environ.get('CACHE_DIR') or None,
+            disk_bytes=int(os.environ.get('CACHE_DISK_MB', default='1024')) * 2 ** 20,
+            version=conversion_version(),
+            ttl=float(os.environ.get('CACHE_TTL', default='0'))
+        )
+
+    def key(self, data: bytes) -> str:
+        return content_key(data, self.version)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str) -> Union[bytes, None]:
+        """
+        Looks the result up in memory, then on disk.
+
+        Args:
+            key (str): The result key.
+
+        Returns:
+            bytes: The cached result or None.
+        """
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None and self.expired(self.memory_used[key]):
+                self.memory_size -= len(self.memory.pop(key))
+                del self.memory_used[key]
+                self.stats['expired'] += 1
+                value = None
+            if value is not None:
+                self.memory.move_to_end(key)
+                self.memory_used[key] = time.time()
+                self.count_hit('memory_hits', value)
+                return value
+        value = self.disk_get(key)
+        with self.lock:
+            if value is None:
+                self.stats['misses'] += 1
+                return None
+            self.count_hit('disk_hits', value)
+            self.memory_put(key, value)
+        return value
+
+    def contains(self, key: str) -> bool:
+        """
+        Checks whether the result is cached and not expired, without reading it,
+        counting a lookup or marking it as used.
+        """
+        with self.lock:
+            if key in self.memory and not self.expired(self.memory_used[key]):
+                return True
+        if not self.directory:
+            return False
+        try:
+            return not self.expired(os.stat(self.path(key)).st_mtime)
+        except OSError:
+            return False
+
+    def put(self, key: str, value: bytes):
+        """
+        Stores the result in both tiers.
+
+        Args:
+            key (str): The result key.
+            value (bytes): The result.
+        """
+        with self.lock:
+            self.stats['stored'] += 1
+            self.memory_put(key, value)
+        self.disk_put(key, value)
+
+    def count_hit(self, tier: str, value: bytes):
+        self.stats['hits'] += 1
+        self.stats[tier] += 1
+        self.stats['bytes_saved'] += len(value)
+
+    def expired(self, used: float) -> bool:
+        return bool(self.ttl) and time.time() - used > self.ttl
+
+    def memory_put(self, key: str, value: bytes):
+        if len(value) > self.memory_bytes:
+            return
+        if key in self.memory:
+            self.memory_size -= len(self.memory.pop(key))
+        self.memory[key] = value
+        self.memory_used[key] = time.time()
+        self.memory_size += len(value)
+        while self.memory_size > self.memory_bytes:
+            evicted_key, evicted = self.memory.popitem(last=False)
+            del self.memory_used[evicted_key]
+            self.memory_size -= len(evicted)
+
+    def disk_get(self, key: str) -> Union[bytes, None]:
+        if not self.directory:
+            return None
+        path = self.path(key)
+        try:
+            stat = os.stat(path)
+            if self.expired(stat.st_mtime):
+                os.remove(path)
+                with self.lock:
+                    self.disk_size -= stat.st_size
+                    self.stats['expired'] += 1
+                return None
+            with open(path, 'rb') as f:
+                value = f.read()
+            # Mark as recently used for the eviction
+            os.utime(path)
+            return value
+        except OSError:
+            return None
+
+    def disk_put(self, key: str, value: bytes):
+        if not self.directory or len(value) > self.disk_bytes:
+            return
+        path = self.path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(value)
+            # Readers in other processes never see a partially written file
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.exception(f"Failed to store cached result {key}")
+            return
+        with self.lock:
+            self.disk_size += len(value)
+            if self.disk_size <= self.disk_bytes:
+                return
+        self.disk_evict()
+
+    def disk_entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def disk_evict(self):
+        # Other processes write to the same directory, so the real size is
+        # recounted instead of trusting the running estimate
+        entries = sorted(self.disk_entries(), key=lambda entry: entry[1])
+        size = sum(entry[2] for entry in entries)
+        target = self.disk_bytes * 0.9
+        evicted = 0
+        for path, _, entry_size in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+            evicted += 1
+        with self.lock:
+            self.disk_size = size
+            self.stats['evicted'] += evicted
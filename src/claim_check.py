@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+from typing import Tuple, Union
+import uuid
+from loguru import logger
+
+
+CLAIM_CHECK_HEADER = 'x-claim-check'
+
+
+class ClaimCheckMissingException(Exception):
+    pass
+
+
+class ClaimCheckStore:
+    """
+    Keeps large message bodies out of RabbitMQ: a body above the threshold is
+    written to a directory shared by the API and the workers, and the message
+    carries only its name in a header. Files are removed by the consumer once
+    the message is handled, the ones nobody consumed are removed after the TTL.
+    """
+
+    def __init__(self, directory: Union[str, None] = None, threshold: int = 256 * 2 ** 10,
+                 ttl: float = 3600):
+        """
+        Initializes the ClaimCheckStore.
+
+        Args:
+            directory (str, optional): Shared directory for the bodies (None - disabled).
+            threshold (int): Smallest body size in bytes stored in the directory.
+            ttl (float): Seconds after which an unconsumed body is removed.
+        """
+        self.directory = directory
+        self.threshold = threshold
+        self.ttl = ttl
+        self.last_cleanup = 0
+        self.lock = threading.Lock()
+        self.stats = {
+            'stored': 0,
+            'stored_bytes': 0,
+            'loaded': 0,
+            'missing': 0,
+            'expired': 0,
+        }
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            directory=os.environ.get('CLAIM_CHECK_DIR') or None,
+            threshold=int(os.environ.get('CLAIM_CHECK_THRESHOLD_KB', default='256')) * 2 ** 10,
+            ttl=float(os.environ.get('CLAIM_CHECK_TTL', default='3600'))
+        )
+
+    def count(self, key: str, value: int = 1):
+        with self.lock:
+            self.stats[key] += value
+
+    def put(self, body: bytes) -> Tuple[bytes, dict]:
+        """
+        Stores the body if it is large enough.
+
+        Args:
+            body (bytes): The message body.
+
+        Returns:
+            Tuple[bytes, dict]: The body to publish and the headers to add to the message.
+        """
+        if not self.directory or len(body) < self.threshold:
+            return body, {}
+        name = uuid.uuid4().hex
+        path = os.path.join(self.directory, name)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        # Consumers never see a partially written file
+        os.replace(tmp_path, path)
+        self.count('stored')
+        self.count('stored_bytes', len(body))
+        if time.time() - self.last_cleanup > self.ttl / 10:
+            self.cleanup()
+        return b'', {CLAIM_CHECK_HEADER: name}
+
+    def path(self, headers: Union[dict, None]) -> Union[str, None]:
+        name = (headers or {}).get(CLAIM_CHECK_HEADER)
+        if not name:
+            return None
+        if isinstance(name, bytes):
+            name = name.decode()
+        if not self.directory:
+            raise ClaimCheckMissingException(f'Claim check {name} received, but CLAIM_CHECK_DIR is not set')
+        # Names are generated by put, anything else is not a stored body
+        return os.path.join(self.directory, os.path.basename(name))
+
+    def get(self, body: bytes, headers: Union[dict, None], remove: bool = True) -> bytes:
+        """
+        Returns the message body, loading the stored one if the message carries
+        a claim check.
+
+        Args:
+            body (bytes): The received message body.
+            headers (dict, optional): The received message headers.
+            remove (bool): Remove the stored body. Consumers of messages that may be
+                redelivered keep it until the message is handled, see `remove`.
+
+        Returns:
+            bytes: The original body.
+
+        Raises:
+            ClaimCheckMissingException: If the stored body expired or was already consumed.
+        """
+        path = self.path(headers)
+        if path is None:
+            return body
+        try:
+            with open(path, 'rb') as f:
+                body = f.read()
+        except OSError:
+            self.count('missing')
+            raise ClaimCheckMissingException(f'Claim check {os.path.basename(path)} not found')
+        self.count('loaded')
+        if remove:
+            self.remove(headers)
+        return body
+
+    def remove(self, headers: Union[dict, None]):
+        """
+        Removes the stored body of a handled message, if it carries a claim check.
+        """
+        if not self.directory:
+            return
+        path = self.path(headers)
+        if path is None:
+            return
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def cleanup(self):
+        """
+        Removes stored bodies older than the TTL.
+        """
+        self.last_cleanup = time.time()
+        expired = 0
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.stat().st_mtime < self.last_cleanup - self.ttl:
+                    os.remove(entry.path)
+                    expired += 1
+            except OSError:
+                continue
+        if expired:
+            logger.info(f"Removed {expired} expired claim checks")
+            self.count('expired', expired)
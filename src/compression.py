@@ -0,0 +1,302 @@
+import gzip
+import os
+import threading
+import time
+from typing import Iterable, List, Tuple, Union
+from cache import ResultCache
+from formats import ZIP_SIGNATURE
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+BROTLI = 'br'
+DEFAULT_LEVELS = {GZIP: 6, ZSTD: 3, BROTLI: 5}
+ACCEPT_ENCODING_HEADER = 'x-accept-encoding'
+
+
+class UnsupportedEncodingException(Exception):
+    pass
+
+
+def available_encodings() -> List[str]:
+    """
+    Lists the encodings this process can decode, preferred first.
+    """
+    return ([ZSTD] if zstandard is not None else []) + ([BROTLI] if brotli is not None else []) + [GZIP]
+
+
+def parse_accept_encoding(value: Union[str, bytes, None]) -> List[str]:
+    """
+    Parses an Accept-Encoding style list, skipping encodings with zero quality.
+    """
+    if isinstance(value, bytes):
+        value = value.decode()
+    encodings = []
+    for item in (value or '').split(','):
+        name, _, params = item.strip().partition(';')
+        if not name or params.strip().replace(' ', '') in ('q=0', 'q=0.0'):
+            continue
+        encodings.append(name.strip().lower())
+    return encodings
+
+
+def compress(data: bytes, encoding: str, level: Union[int, None] = None) -> bytes:
+    if level is None:
+        level = DEFAULT_LEVELS.get(encoding)
+    if encoding == GZIP:
+        return gzip.compress(data, compresslevel=level)
+    if encoding == ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if encoding == BROTLI and brotli is not None:
+        return brotli.compress(data, quality=level)
+    raise UnsupportedEncodingException(f'Unsupported encoding {encoding}')
+
+
+def decompress(data: bytes, encoding: Union[str, None]) -> bytes:
+    if not encoding:
+        return data
+    if encoding == GZIP:
+        return gzip.decompress(data)
+    if encoding == ZSTD and zstandard is not None:
+        # Frames written by ZstdCompressor.compress carry the content size
+        return zstandard.ZstdDecompressor().decompress(data)
+    if encoding == BROTLI and brotli is not None:
+        return brotli.decompress(data)
+    raise UnsupportedEncodingException(f'Unsupported encoding {encoding}')
+
+
+class MessageCodec:
+    """
+    Compresses RabbitMQ message bodies. The encoding travels in the message
+    `content_encoding` property, so the receiver always knows how to decode.
+    """
+
+    def __init__(self, encoding: Union[str, None] = None, threshold: int = 16 * 2 ** 10,
+                 level: Union[int, None] = None):
+        """
+        Initializes the MessageCodec.
+
+        Args:
+            encoding (str, optional): GZIP or ZSTD (None - compression disabled).
+            threshold (int): Smallest body size in bytes to compress.
+            level (int, optional): Compression level, the encoding default if not set.
+        """
+        if encoding and encoding not in available_encodings():
+            raise UnsupportedEncodingException(f'Unsupported encoding {encoding}')
+        self.encoding = encoding
+        self.threshold = threshold
+        self.level = level
+        self.lock = threading.Lock()
+        self.stats = {
+            'compressed': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+        }
+
+    @classmethod
+    def from_env(cls):
+        level = os.environ.get('MESSAGE_COMPRESSION_LEVEL')
+        return cls(
+            encoding=os.environ.get('MESSAGE_COMPRESSION') or None,
+            threshold=int(os.environ.get('MESSAGE_COMPRESSION_THRESHOLD_KB', default='16')) * 2 ** 10,
+            level=int(level) if level else None
+        )
+
+    def encode(self, data: bytes, accept: Union[Iterable[str], None] = None) -> Tuple[bytes, Union[str, None]]:
+        """
+        Compresses the body if it is worth it.
+
+        Args:
+            data (bytes): The message body.
+            accept (Iterable[str], optional): Encodings the receiver can decode,
+                any if not set.
+
+        Returns:
+            Tuple[bytes, str]: The body to publish and its encoding (None - not compressed).
+        """
+        if not self.encoding or len(data) < self.threshold:
+            return data, None
+        if accept is not None and self.encoding not in accept:
+            return data, None
+        # .docx is a ZIP archive already
+        if data.startswith(ZIP_SIGNATURE):
+            return data, None
+        compressed = compress(data, self.encoding, self.level)
+        if len(compressed) >= len(data):
+            return data, None
+        with self.lock:
+            self.stats['compressed'] += 1
+            self.stats['bytes_in'] += len(data)
+            self.stats['bytes_out'] += len(compressed)
+        return compressed, self.encoding
+
+    def decode(self, data: bytes, encoding: Union[str, None]) -> bytes:
+        return decompress(data, encoding)
+
+
+class ResponseCompressor:
+    """
+    Compresses HTTP responses with the most preferred encoding the client
+    accepts. Small responses are sent as is, and so are all responses while
+    the compression CPU budget is spent.
+    """
+
+    def __init__(self, encodings: Union[Iterable[str], None] = None, threshold: int = 2 ** 10,
+                 cpu_budget: float = 0.5, level: Union[int, None] = None, cache_bytes: int = 16 * 2 ** 20):
+        """
+        Initializes the ResponseCompressor.
+
+        Args:
+            encodings (Iterable[str], optional): Encodings in order of preference,
+                all available if not set.
+            threshold (int): Smallest response size in bytes to compress.
+            cpu_budget (float): Seconds spent compressing per second (0 - unlimited).
+            level (int, optional): Compression level, the encoding default if not set.
+            cache_bytes (int): Size of the cache of the compressed variants of cached responses.
+        """
+        if encodings is None:
+            encodings = available_encodings()
+        self.encodings = [encoding for encoding in encodings if encoding in available_encodings()]
+        self.threshold = threshold
+        self.cpu_budget = cpu_budget
+        self.level = level
+        self.budget = cpu_budget
+        self.budget_time = time.perf_counter()
+        # Kept apart from the cached results, so the variants neither evict them
+        # nor count as their lookups
+        self.cache = ResultCache(memory_bytes=cache_bytes)
+        self.lock = threading.Lock()
+        self.stats = {
+            'compressed': 0,
+            'precompressed_hits': 0,
+            'over_budget': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'seconds': 0.0,
+        }
+
+    @classmethod
+    def from_env(cls):
+        encodings = os.environ.get('HTTP_COMPRESSION')
+        level = os.environ.get('HTTP_COMPRESSION_LEVEL')
+        return cls(
+            encodings=[encoding.strip() for encoding in encodings.split(',') if encoding.strip()]
+            if encodings is not None else None,
+            threshold=int(os.environ.get('HTTP_COMPRESSION_THRESHOLD_KB', default='1')) * 2 ** 10,
+            cpu_budget=float(os.environ.get('HTTP_COMPRESSION_CPU_BUDGET', default='0.5')),
+            level=int(level) if level else None,
+            cache_bytes=int(os.environ.get('HTTP_COMPRESSION_CACHE_MB', default='16')) * 2 ** 20
+        )
+
+    def choose(self, accept_encoding: Union[str, None]) -> Union[str, None]:
+        """
+        Chooses the encoding for the response.
+
+        Args:
+            accept_encoding (str, optional): The request Accept-Encoding header.
+
+        Returns:
+            str: The encoding or None if the client accepts none of them.
+        """
+        accept = parse_accept_encoding(accept_encoding)
+        for encoding in self.encodings:
+            if encoding in accept:
+                return encoding
+        return None
+
+    def reserve(self) -> bool:
+        # The budget is refilled continuously and holds at most one second of it
+        if not self.cpu_budget:
+            return True
+        with self.lock:
+            now = time.perf_counter()
+            self.budget = min(self.cpu_budget, self.budget + (now - self.budget_time) * self.cpu_budget)
+            self.budget_time = now
+            if self.budget <= 0:
+                self.stats['over_budget'] += 1
+                return False
+            return True
+
+    def compress(self, data: bytes, encoding: str) -> Union[bytes, None]:
+        start = time.perf_counter()
+        compressed = compress(data, encoding, self.level)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.budget -= elapsed
+            self.stats['seconds'] += elapsed
+            if len(compressed) >= len(data):
+                return None
+            self.stats['compressed'] += 1
+            self.stats['bytes_in'] += len(data)
+            self.stats['bytes_out'] += len(compressed)
+        return compressed
+
+    def encode(self, data: bytes, accept_encoding: Union[str, None]) -> Tuple[bytes, Union[str, None]]:
+        """
+        Compresses the response if it is worth it.
+
+        Args:
+            data (bytes): The response body.
+            accept_encoding (str, optional): The request Accept-Encoding header.
+
+        Returns:
+            Tuple[bytes, str]: The body to send and its encoding (None - not compressed).
+        """
+        if len(data) < self.threshold:
+            return data, None
+        encoding = self.choose(accept_encoding)
+        if encoding is None or not self.reserve():
+            return data, None
+        compressed = self.compress(data, encoding)
+        if compressed is None:
+            return data, None
+        return compressed, encoding
+
+    def encode_cached(self, key: str, data: bytes,
+                      accept_encoding: Union[str, None]) -> Tuple[bytes, Union[str, None]]:
+        """
+        Same as `encode` for a cached response: the compressed body is kept in
+        the cache of the compressor, so repeated responses are not compressed again.
+
+        Args:
+            key (str): The response key in the cache holding it.
+            data (bytes): The response body.
+            accept_encoding (str, optional): The request Accept-Encoding header.
+
+        Returns:
+            Tuple[bytes, str]: The body to send and its encoding (None - not compressed).
+        """
+        if len(data) < self.threshold:
+            return data, None
+        encoding = self.choose(accept_encoding)
+        if encoding is None:
+            return data, None
+        compressed = self.cache.get(f'{key}.{encoding}')
+        if compressed is not None:
+            with self.lock:
+                self.stats['precompressed_hits'] += 1
+            return compressed, encoding
+        if not self.reserve():
+            return data, None
+        compressed = self.compress(data, encoding)
+        if compressed is None:
+            return data, None
+        self.cache.put(f'{key}.{encoding}', compressed)
+        return compressed, encoding
+
+    @staticmethod
+    def headers(encoding: Union[str, None]) -> dict:
+        headers = {'Vary': 'Accept-Encoding'}
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return headers
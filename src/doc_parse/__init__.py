@@ -1 +1 @@
-import iofrom typing import Unionimport aspose.words as awimport docxfrom .conf import CONFfrom .ooxml import DocHandlerfrom .export_html import DocHTMLfrom .export_json import DocJSONdef doc_to_docx(in_stream: io.BytesIO, out_stream: io.BytesIO):    """    Converts a .doc file to a .docx file using Aspose.Words.    Args:        in_stream (io.BytesIO): The input stream containing the .doc file.        out_stream (io.BytesIO): The output stream to write the .docx file.    """    doc = aw.Document(in_stream)    doc.save(out_stream, aw.SaveFormat.DOCX)def docx_to_html(docx_path: Union[str, io.BytesIO]) -> tuple:    """    Converts a DOCX document to HTML.        Args:        docx_path (str): The path to the DOCX file.        Returns:        tuple: A tuple containing the HTML content and table of contents links.    """    doc = docx.Document(docx_path)    handler = DocHandler(doc, **CONF)    converter = DocHTML()    return converter.get_html(handler)def docx_to_json(docx_path: Union[str, io.BytesIO]) -> str:    """    Converts a DOCX document to JSON.        Args:        docx_path (str): The path to the DOCX file.        Returns:        str: Formatted JSON content.    """    doc = docx.Document(docx_path)    handler = DocHandler(doc, **CONF)    converter = DocJSON()    return converter.get_json(handler)
\ No newline at end of file
+import iofrom typing import Unionimport aspose.words as awimport docxfrom .conf import CONFfrom .ooxml import DocHandlerfrom .export_html import DocHTMLfrom .export_json import DocJSONfrom .ml import batching_stats, enable_batching, get_classifier, model_load_statsfrom .numbering import NUM_CLF_MODELfrom .timing import NULL_TIMER, StageTimerdef doc_to_docx(in_stream: io.BytesIO, out_stream: io.BytesIO):    """    Converts a .doc file to a .docx file using Aspose.Words.    Args:        in_stream (io.BytesIO): The input stream containing the .doc file.        out_stream (io.BytesIO): The output stream to write the .docx file.    """    doc = aw.Document(in_stream)    doc.save(out_stream, aw.SaveFormat.DOCX)def docx_to_html(docx_path: Union[str, io.BytesIO]) -> tuple:    """    Converts a DOCX document to HTML.        Args:        docx_path (str): The path to the DOCX file.        Returns:        tuple: A tuple containing the HTML content and table of contents links.    """    doc = docx.Document(docx_path)    handler = DocHandler(doc, **CONF)    converter = DocHTML()    return converter.get_html(handler)def docx_to_json(docx_path: Union[str, io.BytesIO], timer: Union[StageTimer, None] = None) -> str:    """    Converts a DOCX document to JSON.        Args:        docx_path (str): The path to the DOCX file.        timer (StageTimer, optional): Collects the time of the conversion stages.        Returns:        str: Formatted JSON content.    """    with (timer or NULL_TIMER).stage('parse'):        doc = docx.Document(docx_path)        handler = DocHandler(doc, timer=timer, **CONF)    converter = DocJSON()    return converter.get_json(handler)def preload_models(numeration_model: str = NUM_CLF_MODEL, warmup: bool = False):    """    Loads the classifiers used by NumberingDB into the current process, so    documents converted later do not pay for model loading.    Args:        numeration_model (str): Path to the numeration classifier model.        warmup (bool): Run a sample text through the classifier to finish            lazy initialization of the model.    """    clf = get_classifier(numeration_model)    if warmup:        clf('1.1 Общие положения')
\ No newline at end of file
@@ -1,5 +1,8 @@
-from typing import Union
+from typing import List, Union
 import docx
+from docx.oxml import parse_xml
+from docx.oxml.ns import qn
+from docx.text.paragraph import Paragraph
 import xmltodict
 
 
@@ -205,6 +208,35 @@ class TableHandler:
         return 0
                 
 
+    def layout(self) -> dict:
+        """
+        Describes the analysed grid with plain values, so it can be passed
+        between processes. Paragraphs are referenced by their position in the table.
+        """
+        paragraph_index = {p: i for i, p in enumerate(self.table._tbl.iter(qn('w:p')))}
+        return {
+            'rows': [[cell.layout(paragraph_index) for cell in row] for row in self.rows],
+            'has_frame': self.has_frame,
+            'text_col_starts': self.text_col_starts,
+            'text_col_ends': self.text_col_ends,
+            'text_row_starts': self.text_row_starts,
+            'text_row_ends': self.text_row_ends,
+        }
+
+    @classmethod
+    def from_layout(cls, table: docx.table.Table, layout: dict) -> 'TableHandler':
+        """
+        Restores the handler of a table analysed in another process, without
+        repeating the analysis.
+        """
+        handler = cls.__new__(cls)
+        handler.table = table
+        paragraphs = [Paragraph(p, table) for p in table._tbl.iter(qn('w:p'))]
+        handler.rows = [[CellHandler.from_layout(cell, paragraphs) for cell in row] for row in layout['rows']]
+        for key in ('has_frame', 'text_col_starts', 'text_col_ends', 'text_row_starts', 'text_row_ends'):
+            setattr(handler, key, layout[key])
+        return handler
+
     def get_table_height(self, xml):
         self.rows_heights = []
         for row in xml['w:tbl']['w:tr']:
@@ -244,6 +276,27 @@ class CellHandler:
     @property
     def ctext(self):
         return '\n'.join([c_par.text.strip() for c_par in self.paragraphs]).strip()
+
+    def layout(self, paragraph_index: dict) -> dict:
+        return {
+            'x': self.x,
+            'y': self.y,
+            'rowspan': self.rowspan,
+            'colspan': self.colspan,
+            'width': self.width,
+            'height': self.height,
+            'indent_top': self.indent_top,
+            'is_text': self.is_text,
+            'no_borders': self.no_borders,
+            'paragraphs': [paragraph_index[par._p] for par in self.paragraphs],
+        }
+
+    @classmethod
+    def from_layout(cls, layout: dict, paragraphs: List[Paragraph]) -> 'CellHandler':
+        cell = cls.__new__(cls)
+        cell.__dict__.update(layout)
+        cell.paragraphs = [paragraphs[i] for i in layout['paragraphs']]
+        return cell
         
         
 class TableView:
@@ -280,6 +333,23 @@ class DocRoot(ParHandler):
         self.ctext = ''
 
 
+def analyse_table(tbl_xml: str, src_page_width: int, src_page_height: int, conf: dict) -> dict:
+    """
+    Analyses a table grid in a pool process.
+
+    Args:
+        tbl_xml (str): The `w:tbl` element XML.
+        src_page_width (int): Page width of the document.
+        src_page_height (int): Page height of the document.
+        conf (dict): TableHandler parameters.
+
+    Returns:
+        dict: The table layout, see `TableHandler.layout`.
+    """
+    table = docx.table.Table(parse_xml(tbl_xml), None)
+    return TableHandler(table, src_page_width, src_page_height, **conf).layout()
+
+
 def left_join_cells(cell_1: CellHandler, cell_2: CellHandler):
     cell_1.paragraphs += cell_2.paragraphs
     cell_1.no_borders = cell_1.no_borders.union(cell_2.no_borders)
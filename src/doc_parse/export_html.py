@@ -59,13 +59,58 @@ class DocHTML:
     def get_html(self, handler: DocHandler) -> tuple:
         if not handler.processed:
             handler.process()
+        with handler.timer.stage('export_html'):
+            for content in handler.processed_content:
+                if type(content) is ParHandler:
+                    self.paragraph_html(content)
+                elif type(content) is TableView:
+                    self.table_html(content)
+            return ''.join(self.html_content), ''.join(self.toc_links)
+
+    def get_sections(self, handler: DocHandler, max_section_chars: int = 256 * 2 ** 10) -> tuple:
+        """
+        Converts the document to HTML split into sections, so a viewer can load
+        them one by one. A section starts at every depth-1 header, or after
+        max_section_chars for documents without them.
+
+        Args:
+            handler (DocHandler): The document handler.
+            max_section_chars (int, optional): Section size after which the next
+                element starts a new section.
+
+        Returns:
+            tuple: A list of section HTML chunks, table of contents links and a dict
+                mapping every anchor to the index of its section.
+        """
+        if not handler.processed:
+            handler.process()
+        with handler.timer.stage('export_html'):
+            return self.split_sections(handler, max_section_chars)
+
+    def split_sections(self, handler: DocHandler, max_section_chars: int) -> tuple:
+        bounds = [0]
+        anchors = {handler.processed_content[0].node._id: 0}
+        size = 0
         for content in handler.processed_content:
             if type(content) is ParHandler:
-                self.paragraph_html(content)
+                header = content.node.depth == 1
             elif type(content) is TableView:
+                header = False
+            else:
+                continue
+            if (header and size) or size > max_section_chars:
+                bounds.append(len(self.html_content))
+                size = 0
+            if type(content) is ParHandler:
+                self.paragraph_html(content)
+            else:
                 self.table_html(content)
-        return ''.join(self.html_content), ''.join(self.toc_links)
-            
+            size += len(self.html_content[-1])
+            if content.node._id:
+                anchors[content.node._id] = len(bounds) - 1
+        sections = [''.join(self.html_content[start:end]) for start, end in zip(bounds, bounds[1:] + [None])]
+        return sections, ''.join(self.toc_links), anchors
+
 
 def make_toc_header(text: str, depth: int, max_len: int = 35) -> str:
     """
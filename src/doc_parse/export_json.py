@@ -95,18 +95,20 @@ class DocJSON:
     def get_json(self, handler: DocHandler) -> tuple:
         if not handler.processed:
             handler.process()
-        for content in handler.processed_content:
-            if type(content) is ParHandler:
-                if content.node._id:
-                    self.indexed_pars[content.node._id] = content
-                self.paragraph_json(content)
-            elif type(content) is TableView:
-                self.table_json(content)
+        with handler.timer.stage('export_json'):
+            for content in handler.processed_content:
+                if type(content) is ParHandler:
+                    if content.node._id:
+                        self.indexed_pars[content.node._id] = content
+                    self.paragraph_json(content)
+                elif type(content) is TableView:
+                    self.table_json(content)
 
         # POSTPROCESS WITH CUSTOM CALLBACK
         processed_elements = []
         for element in self.elements:
-            action, updated_element = custom_callback(element)
+            with handler.timer.stage('custom_callback'):
+                action, updated_element = custom_callback(element)
             if action == 'pass':
                 processed_elements.append(element)
             elif action == 'update':
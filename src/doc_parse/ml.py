@@ -1 +1 @@
-import torchfrom transformers import BertForSequenceClassification, BertTokenizerclass BERTTextClassifier:    def __init__(self, model_name):        self.tokenizer = BertTokenizer.from_pretrained(model_name)        self.classifier = BertForSequenceClassification.from_pretrained(model_name).eval()            def preprocessing(self, text):        return ' '.join(text.lower().split())        def __call__(self, text):        inp_ids = self.tokenizer.encode_plus(            self.preprocessing(text.lower()),            add_special_tokens=True,            max_length=64,            return_token_type_ids=False,            padding='max_length',            truncation=True,            return_attention_mask=True,            return_tensors='pt',        )        with torch.no_grad():            return self.classifier(**inp_ids).logits[0].argmax().item() == 1
\ No newline at end of file
+from concurrent.futures import Futureimport queueimport threadingimport timefrom typing import Listimport torchfrom transformers import BertForSequenceClassification, BertTokenizerclass BERTTextClassifier:    def __init__(self, model_name):        self.tokenizer = BertTokenizer.from_pretrained(model_name)        self.classifier = BertForSequenceClassification.from_pretrained(model_name).eval()            def preprocessing(self, text):        return ' '.join(text.lower().split())        def __call__(self, text):        return self.predict([text])[0]    def predict(self, texts: List[str]) -> List[bool]:        # Inputs are padded to the same length, so a text gets the same logits        # in a batch as alone        inp_ids = self.tokenizer.batch_encode_plus(            [self.preprocessing(text.lower()) for text in texts],            add_special_tokens=True,            max_length=64,            return_token_type_ids=False,            padding='max_length',            truncation=True,            return_attention_mask=True,            return_tensors='pt',        )        with torch.no_grad():            return (self.classifier(**inp_ids).logits.argmax(dim=1) == 1).tolist()class BatchingClassifier:    """    Collects classifier calls from documents converted concurrently in    threads of one process and runs them through the model in batches.    """    def __init__(self, classifier: BERTTextClassifier, max_batch: int = 32, max_wait: float = 0.005):        """        Initializes the BatchingClassifier and starts its inference thread.        Args:            classifier (BERTTextClassifier): The wrapped classifier.            max_batch (int): Largest batch size.            max_wait (float): Seconds the first request of a batch waits for more requests.        """        self.classifier = classifier        self.max_batch = max_batch        self.max_wait = max_wait        self.requests = queue.Queue()        self.lock = threading.Lock()        self.stats = {            'requests': 0,            'batches': 0,            'batch_sizes': {},            'queue_wait_seconds': 0.0,            'queue_wait_max': 0.0,            'inference_seconds': 0.0,        }        self.thread = threading.Thread(target=self.serve, daemon=True)        self.thread.start()    def __call__(self, text: str) -> bool:        future = Future()        self.requests.put((text, time.monotonic(), future))        return future.result()    def collect(self) -> list:        batch = [self.requests.get()]        deadline = time.monotonic() + self.max_wait        while len(batch) < self.max_batch:            timeout = deadline - time.monotonic()            try:                batch.append(self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait())            except queue.Empty:                break        return batch    def serve(self):        while True:            batch = self.collect()            start = time.monotonic()            try:                results = self.classifier.predict([text for text, _, _ in batch])            except Exception as e:                for _, _, future in batch:                    future.set_exception(e)                continue            elapsed = time.monotonic() - start            for (_, _, future), result in zip(batch, results):                future.set_result(result)            self.count(batch, start, elapsed)    def count(self, batch: list, start: float, elapsed: float):        # Time in the queue is the latency batching adds to a call        waits = [start - submitted for _, submitted, _ in batch]        with self.lock:            self.stats['requests'] += len(batch)            self.stats['batches'] += 1            self.stats['batch_sizes'][len(batch)] = self.stats['batch_sizes'].get(len(batch), 0) + 1            self.stats['queue_wait_seconds'] += sum(waits)            self.stats['queue_wait_max'] = max(self.stats['queue_wait_max'], *waits)            self.stats['inference_seconds'] += elapsed    def get_stats(self) -> dict:        with self.lock:            stats = {**self.stats, 'batch_sizes': dict(sorted(self.stats['batch_sizes'].items()))}        requests = stats['requests'] or 1        stats['queue_wait_avg'] = stats['queue_wait_seconds'] / requests        stats['batch_size_avg'] = stats['requests'] / (stats['batches'] or 1)        return stats_classifiers = {}_load_seconds = {}_batching = Nonedef get_classifier(model_name: str) -> BERTTextClassifier:    """    Returns the classifier for a model, loading it only once per process.    Args:        model_name (str): Path or name of the pretrained model.    Returns:        BERTTextClassifier: The shared classifier instance, wrapped in            BatchingClassifier if batching is enabled.    """    if model_name not in _classifiers:        start = time.perf_counter()        classifier = BERTTextClassifier(model_name)        _load_seconds[model_name] = time.perf_counter() - start        if _batching is not None:            classifier = BatchingClassifier(classifier, *_batching)        _classifiers[model_name] = classifier    return _classifiers[model_name]def enable_batching(max_batch: int, max_wait: float):    """    Makes classifiers of this process batch calls from concurrent threads.    Args:        max_batch (int): Largest batch size.        max_wait (float): Seconds the first request of a batch waits for more requests.    """    global _batching    _batching = (max_batch, max_wait)    for model_name, classifier in _classifiers.items():        if not isinstance(classifier, BatchingClassifier):            _classifiers[model_name] = BatchingClassifier(classifier, max_batch, max_wait)def model_load_stats() -> dict:    """    Returns the seconds spent loading every model of this process.    """    return dict(_load_seconds)def batching_stats() -> dict:    """    Returns batching statistics by model.    """    return {        model_name: classifier.get_stats()        for model_name, classifier in _classifiers.items()        if isinstance(classifier, BatchingClassifier)    }
\ No newline at end of file
@@ -1,12 +1,57 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import re
 import statistics
 import string
-from typing import Union
+from typing import Dict, List, Union
 import uuid
 import docx
+from docx.oxml.ns import qn
+from docx.text.paragraph import Paragraph
+from loguru import logger
 import xmltodict
 from .core import ParHandler, Node
-from .ml import BERTTextClassifier
+from .ml import get_classifier
+from .timing import NULL_TIMER, StageTimer
+
+
+NUM_CLF_MODEL = 'model_dir/num_clf'
+HEADING_CLF_MODEL = 'model_dir/word_clf'
+
+_classify_pools = {}
+
+
+def get_classify_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Returns the process pool classifying paragraphs of large documents, shared
+    by all documents of the process. Every pool process loads its own model.
+    """
+    if workers not in _classify_pools:
+        _classify_pools[workers] = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return _classify_pools[workers]
+
+
+def discard_classify_pool(workers: int, pool: ProcessPoolExecutor):
+    """
+    Forgets a pool broken by a dead process, the next call of `get_classify_pool`
+    starts a new one.
+    """
+    if _classify_pools.get(workers) is pool:
+        del _classify_pools[workers]
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def classify_texts(model_name: str, texts: List[str]) -> List[bool]:
+    """
+    Classifies a shard of texts in a pool process. Texts are classified one by
+    one, exactly as during sequential processing.
+    """
+    clf = get_classifier(model_name)
+    return [clf(text) for text in texts]
 
 
 class NumberingDB:
@@ -15,15 +60,17 @@ class NumberingDB:
     """     
     def __init__(self, doc: docx.Document, appendix_header_length: int = 40,
                  default_levels: int = 9, default_font: int = 12,
-                 norm_numeration_model: str = 'model_dir/num_clf',
-                 norm_heading_model: str = 'model_dir/word_clf'):
+                 norm_numeration_model: str = NUM_CLF_MODEL,
+                 norm_heading_model: str = HEADING_CLF_MODEL, timer: Union[StageTimer, None] = None):
         """
         Initializes the NumberingDB with a DOCX document.
         
         Args:
             doc (docx.Document): The DOCX document to process.
+            timer (StageTimer, optional): Collects the time of the numbering stages (None - off).
         """
         self.doc = doc
+        self.timer = timer or NULL_TIMER
         self.appendix_header_length = appendix_header_length
         self.default_levels = default_levels
         self.default_font = default_font
@@ -42,8 +89,13 @@ class NumberingDB:
         
         self.font_size = []
         
-        self.norm_numeration_clf = BERTTextClassifier(norm_numeration_model)
-        self.norm_heading_clf = BERTTextClassifier(norm_numeration_model)
+        self.norm_numeration_model = norm_numeration_model
+        # The heading classifier runs the numeration model as well
+        self.norm_heading_model = norm_numeration_model
+        # Classifier verdicts computed ahead by `preclassify`, by model name and text
+        self.verdicts = {}
+        self.norm_numeration_clf = get_classifier(self.norm_numeration_model)
+        self.norm_heading_clf = get_classifier(self.norm_heading_model)
         
         self.stop_symbs = [')', ':', '-', '–', '—', '−']
 
@@ -194,11 +246,104 @@ class NumberingDB:
                 return par
             if not self.check_heading_style(par) and depth == 1:
                 return par
-            if not self.norm_numeration_clf(par.ctext):
+            if not self.classify_numeration(par.ctext):
                 return par
             par.node = Node(num_prefix, depth, 'REGEX')
         return par
 
+    def classify_numeration(self, text: str) -> bool:
+        verdict = self.verdicts.get((self.norm_numeration_model, text))
+        if verdict is None:
+            with self.timer.stage('classifier.numeration'):
+                verdict = self.norm_numeration_clf(text)
+        return verdict
+
+    def classify_heading(self, text: str) -> bool:
+        verdict = self.verdicts.get((self.norm_heading_model, text))
+        if verdict is None:
+            with self.timer.stage('classifier.heading'):
+                verdict = self.norm_heading_clf(text)
+        return verdict
+
+    def preclassify(self, workers: int):
+        """
+        Runs the numeration and heading classifiers over the document in parallel shards.
+
+        Numbering counters, font size statistics and anchors depend on the
+        preceding paragraphs, so they are still computed sequentially by
+        `numerize`. The classifiers do not depend on them: every paragraph that
+        may reach them is classified ahead and `numerize` replays the document
+        using the stored verdicts, with the same result as without sharding.
+
+        Args:
+            workers (int): Number of shards classified in parallel.
+        """
+        candidates = {}
+        for model_name, texts in ((self.norm_numeration_model, self.numeration_candidates()),
+                                  (self.norm_heading_model, self.heading_candidates())):
+            # Both classifiers may run the same model, its texts are classified once
+            candidates.setdefault(model_name, {}).update(dict.fromkeys(texts))
+        total = sum(len(texts) for texts in candidates.values())
+        if not total:
+            return
+        pool = get_classify_pool(workers)
+        shard_size = -(-total // workers)
+        shards = []
+        for model_name, texts in candidates.items():
+            texts = list(texts)
+            shards += [(model_name, texts[i:i + shard_size]) for i in range(0, len(texts), shard_size)]
+        try:
+            futures = [pool.submit(classify_texts, model_name, shard) for model_name, shard in shards]
+        except BrokenProcessPool:
+            # A pool process died with an earlier document, e.g. killed by the OOM killer
+            logger.error("Classification pool broken, starting a new one")
+            discard_classify_pool(workers, pool)
+            pool = get_classify_pool(workers)
+            futures = [pool.submit(classify_texts, model_name, shard) for model_name, shard in shards]
+        try:
+            for (model_name, shard), future in zip(shards, futures):
+                self.verdicts.update(((model_name, text), verdict) for text, verdict in zip(shard, future.result()))
+        except BrokenProcessPool:
+            # Texts without verdicts are classified sequentially by numerize, the
+            # next document submits to a new pool
+            logger.error("Classification pool broken, classifying sequentially")
+            discard_classify_pool(workers, pool)
+
+    def numeration_candidates(self) -> List[str]:
+        """
+        Lists distinct texts of the document paragraphs that `numerize_by_text`
+        may pass to the classifier, in document order.
+        """
+        texts = {}
+        for p in self.doc.element.body.iter(qn('w:p')):
+            text = Paragraph(p, None).text.strip()
+            _, depth, cleaned_text = find_manual_numbering(text, self.default_levels)
+            if depth and not self.stop_symbs_in_start(cleaned_text):
+                texts[text] = True
+        return list(texts)
+
+    def heading_candidates(self) -> List[str]:
+        """
+        Lists distinct texts of the document paragraphs that `numerize_by_heading`
+        may pass to the classifier, in document order.
+        """
+        texts = {}
+        for p in self.doc.element.body.iter(qn('w:p')):
+            par = Paragraph(p, self.doc._body)
+            if self.is_heading_style(par.style.name):
+                texts[par.text.strip()] = True
+        return list(texts)
+
+    def is_heading_style(self, style_name: Union[str, None]) -> bool:
+        """
+        Checks if a paragraph style lets `numerize_by_heading` classify the paragraph.
+        """
+        if not style_name:
+            return False
+        if not re.search(r'Heading (\d+)', style_name) or style_name != 'Title':
+            return False
+        return True
+
     def numerize_by_heading(self, par: ParHandler) -> ParHandler:
         """
         Processes numbering by heading.
@@ -209,13 +354,11 @@ class NumberingDB:
         Returns:
             tuple: A tuple containing the numbering prefix, depth, and source.
         """
-        if not par.style_name:
-            return par
-        if not re.search(r'Heading (\d+)', par.style_name) or par.style_name != 'Title':
+        if not self.is_heading_style(par.style_name):
             return par
         if not self.check_heading_style(par):
             return par
-        if not self.norm_heading_clf(par.ctext):
+        if not self.classify_heading(par.ctext):
             return par
         par.node = Node(par.ctext, 1, 'HEADING')
         return par
@@ -246,20 +389,22 @@ class NumberingDB:
         Returns:
             tuple: A tuple containing the numbering prefix, depth, and source.
         """
-        # Update font size stat
-        self.font_size.append(par.font_size or self.default_font)
-        # Numeraize paragraph
-        numerize_prioritet = [
-            self.numrize_by_meta,
-            self.numrize_by_style,
-            self.numerize_by_text,
-            self.numerize_by_heading,
-            self.numerize_by_appendix
-        ]
-        for method in numerize_prioritet:
-            par = method(par)
-            if par.node.num_prefix:
-                break
+        with self.timer.stage('numerize'):
+            # Update font size stat
+            self.font_size.append(par.font_size or self.default_font)
+            # Numeraize paragraph
+            numerize_prioritet = [
+                ('numerize.meta', self.numrize_by_meta),
+                ('numerize.style', self.numrize_by_style),
+                ('numerize.text', self.numerize_by_text),
+                ('numerize.heading', self.numerize_by_heading),
+                ('numerize.appendix', self.numerize_by_appendix)
+            ]
+            for stage, method in numerize_prioritet:
+                with self.timer.stage(stage):
+                    par = method(par)
+                if par.node.num_prefix:
+                    break
         return par
     
     def get_levels_abstracts(self):
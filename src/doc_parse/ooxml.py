@@ -1,11 +1,43 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import re
-from typing import List, Union
+import time
+from typing import Dict, List, Union
 import docx
+from docx.oxml.ns import qn
 from loguru import logger
 import xmltodict
 from .conf import CONF
-from .core import ParHandler, TableHandler, TableView, Node, DocRoot
+from .core import ParHandler, TableHandler, TableView, Node, DocRoot, analyse_table
 from .numbering import NumberingDB
+from .timing import NULL_TIMER, StageTimer
+
+
+_table_pools = {}
+
+
+def get_table_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Returns the process pool analysing tables, shared by all documents of the process.
+    """
+    if workers not in _table_pools:
+        # Spawned, the converting process may run threads that fork would copy mid-operation
+        _table_pools[workers] = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return _table_pools[workers]
+
+
+def discard_table_pool(workers: int, pool: ProcessPoolExecutor):
+    """
+    Forgets a pool broken by a dead process, the next call of `get_table_pool`
+    starts a new one.
+    """
+    if _table_pools.get(workers) is pool:
+        del _table_pools[workers]
+        pool.shutdown(wait=False, cancel_futures=True)
 
 
 class DocHandler:
@@ -14,16 +46,24 @@ class DocHandler:
     """
     def __init__(self, doc: docx.Document, default_width: int = 11907, default_height: int = 16840,
                  max_toc_pages: int = 10, max_doc_pages: int = 2000,
-                 avg_page_chars_count: int = 1200, **kwargs):
+                 avg_page_chars_count: int = 1200, table_workers: int = 0,
+                 parallel_table_min_cells: int = 100, shard_workers: int = 0,
+                 shard_min_paragraphs: int = 2000, timer: Union[StageTimer, None] = None, **kwargs):
         """
         Initializes the DocHandler with a DOCX document.
         
         Args:
             doc (docx.Document): The DOCX document to process.
+            table_workers (int): Processes analysing table grids in parallel (0 - sequential).
+            parallel_table_min_cells (int): Smallest table analysed in the pool.
+            shard_workers (int): Processes classifying paragraphs of large documents (0 - sequential).
+            shard_min_paragraphs (int): Smallest document, in paragraphs, processed in shards.
+            timer (StageTimer, optional): Collects the time of the conversion stages (None - off).
         """
         self.doc = doc
+        self.timer = timer or NULL_TIMER
         self.xml = xmltodict.parse(doc.element.xml, process_namespaces=False)
-        self.num_db = NumberingDB(doc)
+        self.num_db = NumberingDB(doc, timer=self.timer)
         self.chars_count = 0
         self.last_depth = 1
         self.last_pars = []
@@ -42,17 +82,60 @@ class DocHandler:
         self.max_toc_pages = max_toc_pages
         self.max_doc_pages = max_doc_pages
         self.avg_page_chars_count = avg_page_chars_count
+        self.table_workers = table_workers
+        self.parallel_table_min_cells = parallel_table_min_cells
+        self.shard_workers = shard_workers
+        self.shard_min_paragraphs = shard_min_paragraphs
         self.processed = False
         
     def process(self):
-        for content in self.doc.iter_inner_content():
-            if type(content) is docx.text.paragraph.Paragraph:
-                self.process_paragraph(content)
-            elif type(content) is docx.table.Table:
-                self.process_table(content)
-            else:
-                logger.warning(type(content), 'missed')
+        with self.timer.stage('process'):
+            with self.timer.stage('analyse_tables'):
+                analysed = self.analyse_tables()
+            if self.shard_workers and len(self.doc.paragraphs) >= self.shard_min_paragraphs:
+                with self.timer.stage('preclassify'):
+                    self.num_db.preclassify(self.shard_workers)
+            for content in self.doc.iter_inner_content():
+                if type(content) is docx.text.paragraph.Paragraph:
+                    if self.timer.enabled:
+                        start = time.perf_counter()
+                        self.process_paragraph(content)
+                        self.timer.record_paragraph(time.perf_counter() - start, content.text.strip())
+                    else:
+                        self.process_paragraph(content)
+                elif type(content) is docx.table.Table:
+                    with self.timer.stage('process_table'):
+                        self.process_table(content, analysed.get(content._tbl))
+                else:
+                    logger.warning(type(content), 'missed')
         self.processed = True
+
+    def analyse_tables(self) -> Dict:
+        """
+        Submits grid analysis of large tables to the process pool. Table titles,
+        parents and frame text paragraphs depend on the preceding content, so
+        they are still resolved in document order by `process_table`.
+
+        Returns:
+            dict: Layout futures by `w:tbl` element.
+        """
+        if not self.table_workers:
+            return {}
+        pool = get_table_pool(self.table_workers)
+        analysed = {}
+        for tbl in self.doc.element.body.iterchildren(qn('w:tbl')):
+            if len(tbl.xpath('.//w:tc')) < self.parallel_table_min_cells:
+                continue
+            try:
+                analysed[tbl] = pool.submit(analyse_table, tbl.xml, self.width, self.height, CONF)
+            except BrokenProcessPool:
+                # A pool process died with an earlier document, e.g. killed by the OOM
+                # killer. Tables of the broken pool are analysed sequentially instead
+                logger.error("Table analysis pool broken, starting a new one")
+                discard_table_pool(self.table_workers, pool)
+                pool = get_table_pool(self.table_workers)
+                analysed[tbl] = pool.submit(analyse_table, tbl.xml, self.width, self.height, CONF)
+        return analysed
         
     def insert_node(self, node: Node):
         self.last_depth = node.depth
@@ -110,7 +193,9 @@ class DocHandler:
             tuple: A tuple containing the HTML content and table of contents links.
         """
         # Update doc numeration
-        par = self.num_db.numerize(ParHandler(par))
+        with self.timer.stage('par_handler'):
+            par = ParHandler(par)
+        par = self.num_db.numerize(par)
         if par.ctext:
             self.last_pars.append(par.ctext)
             self.last_pars = self.last_pars[-2:]
@@ -129,17 +214,18 @@ class DocHandler:
         # par.ctext = f'DBG [{par.node.source}] ' + par.ctext
         self.processed_content.append(par)
 
-    def process_table(self, table: docx.table.Table) -> tuple:
+    def process_table(self, table: docx.table.Table, analysed: Union[Future, None] = None) -> tuple:
         """
         Processes a table.
         
         Args:
             table (docx.table.Table): The table to process.
+            analysed (Future, optional): The table layout analysed in the pool.
         
         Returns:
             tuple: A tuple containing the HTML content and table of contents links.
         """
-        table = TableHandler(table, self.width, self.height, **CONF)
+        table = self.get_table_handler(table, analysed)
         subtable = TableView(self.get_table_title())
         for i, row in enumerate(table.rows):
             if not any([cell.is_text for cell in row]):
@@ -166,6 +252,24 @@ class DocHandler:
         # Close last opened table
         self.append_table(subtable)
             
+    def get_table_handler(self, table: docx.table.Table, analysed: Union[Future, None]) -> TableHandler:
+        if not self.timer.enabled:
+            return self.analyse_table(table, analysed)
+        start = time.perf_counter()
+        handler = self.analyse_table(table, analysed)
+        elapsed = time.perf_counter() - start
+        self.timer.add('table_handler', elapsed)
+        self.timer.record_table(elapsed, len(handler.rows), sum(len(row) for row in handler.rows))
+        return handler
+
+    def analyse_table(self, table: docx.table.Table, analysed: Union[Future, None]) -> TableHandler:
+        if analysed is not None:
+            try:
+                return TableHandler.from_layout(table, analysed.result())
+            except Exception:
+                logger.exception("Parallel table analysis failed, analysing sequentially")
+        return TableHandler(table, self.width, self.height, **CONF)
+
     def append_table(self, table: TableView):
         if table.empty():
             return
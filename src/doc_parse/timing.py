@@ -0,0 +1,196 @@
+from contextlib import nullcontext
+import heapq
+import time
+import tracemalloc
+from typing import Dict, Iterable, List
+
+
+class StageTimer:
+    """
+    Collects cumulative time and call counts of the conversion stages of one
+    document, and the slowest tables and paragraphs.
+    """
+    enabled = True
+
+    def __init__(self, top: int = 5, label_length: int = 40, span_stages: Iterable[str] = (),
+                 memory: bool = False):
+        """
+        Initializes the StageTimer.
+
+        Args:
+            top (int): Number of the slowest items of every kind kept for the report.
+            label_length (int): Length of the paragraph texts in the report.
+            span_stages (Iterable[str]): Stages whose every call is also recorded
+                with its wall clock start and end, for tracing. Meant for the stages
+                called a few times per document, not per paragraph.
+            memory (bool): Also record the peak memory allocated by every stage,
+                tracemalloc must be tracing.
+        """
+        self.top = top
+        self.label_length = label_length
+        self.span_stages = frozenset(span_stages)
+        self.spans = []
+        self.memory = memory
+        # Memory at the start of the running stages and the peak seen while they run
+        self.memory_stack = []
+        self.memory_peaks: Dict[str, int] = {}
+        self.stages: Dict[str, List[float]] = {}
+        self.slowest: Dict[str, list] = {}
+        self.counter = 0
+        self.tables = 0
+        self.table_cells = 0
+        self.start = time.perf_counter()
+
+    def stage(self, name: str) -> 'Stage':
+        if name in self.span_stages:
+            return SpanStage(self, name)
+        if self.memory:
+            return MemoryStage(self, name)
+        return Stage(self, name)
+
+    def add(self, name: str, seconds: float, calls: int = 1):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = [0.0, 0]
+        stage[0] += seconds
+        stage[1] += calls
+
+    def memory_enter(self):
+        current, peak = tracemalloc.get_traced_memory()
+        if self.memory_stack:
+            self.memory_stack[-1][1] = max(self.memory_stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        self.memory_stack.append([current, current])
+
+    def memory_exit(self, name: str):
+        _, peak = tracemalloc.get_traced_memory()
+        start, stage_peak = self.memory_stack.pop()
+        stage_peak = max(stage_peak, peak)
+        # The peak of a stage is also the peak of the stages it runs in
+        if self.memory_stack:
+            self.memory_stack[-1][1] = max(self.memory_stack[-1][1], stage_peak)
+        self.memory_peaks[name] = max(self.memory_peaks.get(name, 0), stage_peak - start)
+
+    def record(self, kind: str, seconds: float, **details):
+        """
+        Keeps the item if it is one of the slowest of its kind.
+
+        Args:
+            kind (str): Kind of the item, e.g. "tables".
+            seconds (float): Time spent on the item.
+            **details: Item description for the report.
+        """
+        items = self.slowest.setdefault(kind, [])
+        # The counter breaks ties, the details are never compared
+        self.counter += 1
+        item = (seconds, self.counter, details)
+        if len(items) < self.top:
+            heapq.heappush(items, item)
+        elif seconds > items[0][0]:
+            heapq.heapreplace(items, item)
+
+    def record_table(self, seconds: float, rows: int, cells: int):
+        self.tables += 1
+        self.table_cells += cells
+        self.record('tables', seconds, index=self.tables - 1, rows=rows, cells=cells)
+
+    def record_paragraph(self, seconds: float, text: str):
+        if len(text) > self.label_length:
+            text = text[:self.label_length] + '...'
+        self.record('paragraphs', seconds, text=text)
+
+    def report(self) -> dict:
+        """
+        Returns the structured report: stages by time, table counts and the slowest
+        items, and the recorded stage calls if there are any.
+        """
+        report = {
+            'total_seconds': round(time.perf_counter() - self.start, 4),
+            'stages': {
+                name: {'seconds': round(seconds, 4), 'calls': calls,
+                       **({'memory_peak_bytes': self.memory_peaks[name]} if name in self.memory_peaks else {})}
+                for name, (seconds, calls) in sorted(self.stages.items(), key=lambda item: -item[1][0])
+            },
+            'tables': {'count': self.tables, 'cells': self.table_cells},
+            'slowest': {
+                kind: [{'seconds': round(seconds, 4), **details} for seconds, _, details in sorted(items, reverse=True)]
+                for kind, items in self.slowest.items()
+            },
+        }
+        if self.spans:
+            report['spans'] = [{'name': name, 'start_ns': start, 'end_ns': end} for name, start, end in self.spans]
+        return report
+
+
+class Stage:
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer: StageTimer, name: str):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class SpanStage(Stage):
+    __slots__ = ('start_ns',)
+
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        return super().__enter__()
+
+    def __exit__(self, *exc_info):
+        super().__exit__(*exc_info)
+        self.timer.spans.append((self.name, self.start_ns, time.time_ns()))
+        return False
+
+
+class MemoryStage(Stage):
+    """
+    A stage that also records the peak of the memory allocated while it runs,
+    above the memory allocated when it started.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        self.timer.memory_enter()
+        return super().__enter__()
+
+    def __exit__(self, *exc_info):
+        super().__exit__(*exc_info)
+        self.timer.memory_exit(self.name)
+        return False
+
+
+class NullTimer:
+    """
+    The timer used when timing is off, all its methods do nothing.
+    """
+    enabled = False
+
+    def __init__(self):
+        self.context = nullcontext()
+
+    def stage(self, name: str):
+        return self.context
+
+    def add(self, name: str, seconds: float, calls: int = 1):
+        pass
+
+    def record(self, kind: str, seconds: float, **details):
+        pass
+
+    def record_table(self, seconds: float, rows: int, cells: int):
+        pass
+
+    def record_paragraph(self, seconds: float, text: str):
+        pass
+
+
+NULL_TIMER = NullTimer()
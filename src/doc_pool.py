@@ -0,0 +1,266 @@
+import io
+import os
+import queue
+import select
+import struct
+import subprocess
+import sys
+import threading
+import time
+from typing import BinaryIO, Callable, List, Union
+from loguru import logger
+from memory import memory_info
+
+
+OK = b'\x00'
+ERROR = b'\x01'
+# Sent by a conversion process once it is ready to convert
+READY = b'\x02'
+HEADER = struct.Struct('>I')
+
+
+class DocConversionError(Exception):
+    pass
+
+
+class DocConversionTimeout(DocConversionError):
+    pass
+
+
+def read_frame(stream: BinaryIO) -> Union[bytes, None]:
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    size, = HEADER.unpack(header)
+    data = stream.read(size)
+    if len(data) < size:
+        return None
+    return data
+
+
+def write_frame(stream: BinaryIO, data: bytes):
+    stream.write(HEADER.pack(len(data)))
+    stream.write(data)
+    stream.flush()
+
+
+def aspose_doc_to_docx(data: bytes) -> bytes:
+    """
+    Converts a .doc document to .docx using Aspose.Words.
+    """
+    import aspose.words as aw
+    out = io.BytesIO()
+    doc = aw.Document(io.BytesIO(data))
+    doc.save(out, aw.SaveFormat.DOCX)
+    return out.getvalue()
+
+
+def serve(convert: Callable[[bytes], bytes] = aspose_doc_to_docx):
+    """
+    Conversion process loop: reads documents from stdin and writes results to stdout,
+    one length-prefixed frame per document. Exits when stdin is closed.
+    """
+    # Keep the original stdout for frames and send anything the converter
+    # prints to stderr, so it cannot break the protocol
+    frames_out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    frames_in = sys.stdin.buffer
+    write_frame(frames_out, READY)
+    while True:
+        data = read_frame(frames_in)
+        if data is None:
+            return
+        try:
+            write_frame(frames_out, OK + convert(data))
+        except Exception as e:
+            write_frame(frames_out, ERROR + str(e).encode())
+
+
+class DocConverter:
+    """
+    A single conversion subprocess.
+    """
+
+    def __init__(self, command: List[str], start_timeout: float = 60):
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.start_timeout = start_timeout
+        self.ready = False
+        self.tasks = 0
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    def rss(self) -> int:
+        try:
+            return memory_info(self.pid)['rss']
+        except OSError:
+            return 0
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+
+    def wait_ready(self):
+        """
+        Waits until the process has started, so its start is not counted in
+        the timeout of the first conversion.
+        """
+        readable, _, _ = select.select([self.process.stdout], [], [], self.start_timeout)
+        if not readable:
+            self.kill()
+            raise DocConversionError(f'Conversion process did not start in {self.start_timeout}s')
+        if read_frame(self.process.stdout) != READY:
+            raise DocConversionError(f'Conversion process exited with code {self.process.wait()}')
+        self.ready = True
+
+    def convert(self, data: bytes, timeout: float, max_memory: int) -> bytes:
+        if not self.ready:
+            self.wait_ready()
+        write_frame(self.process.stdin, data)
+        deadline = time.monotonic() + timeout
+        while True:
+            readable, _, _ = select.select([self.process.stdout], [], [], 0.2)
+            if readable:
+                break
+            if time.monotonic() > deadline:
+                self.kill()
+                raise DocConversionTimeout(f'Conversion takes more than {timeout}s')
+            if max_memory and self.rss() > max_memory:
+                self.kill()
+                raise DocConversionError(f'Conversion process exceeded {max_memory} bytes')
+        reply = read_frame(self.process.stdout)
+        if reply is None:
+            raise DocConversionError(f'Conversion process exited with code {self.process.wait()}')
+        self.tasks += 1
+        if reply[:1] == ERROR:
+            raise DocConversionError(reply[1:].decode(errors='replace'))
+        return reply[1:]
+
+
+class DocConversionPool:
+    """
+    A pool of isolated subprocesses converting .doc to .docx with Aspose.Words.
+
+    A conversion process is killed when a conversion exceeds the timeout or the
+    memory ceiling, and is recycled after `max_tasks` conversions.
+    """
+
+    def __init__(self, size: int = 1, timeout: float = 120, max_memory: int = 0,
+                 max_tasks: int = 50, command: Union[List[str], None] = None, start_timeout: float = 60):
+        """
+        Initializes the DocConversionPool. Processes are started on demand.
+
+        Args:
+            size (int): Maximum number of conversion processes.
+            timeout (float): Seconds a single conversion may take.
+            max_memory (int): RSS ceiling of a conversion process in bytes (0 - no limit).
+            max_tasks (int): Conversions after which a process is replaced (0 - never).
+            command (List[str], optional): Command starting a conversion process.
+            start_timeout (float): Seconds a conversion process may take to start.
+        """
+        self.timeout = timeout
+        self.start_timeout = start_timeout
+        self.max_memory = max_memory
+        self.max_tasks = max_tasks
+        self.command = command or [sys.executable, os.path.abspath(__file__)]
+        self.slots = threading.Semaphore(size)
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.stats = {
+            'conversions': 0,
+            'failures': 0,
+            'timeouts': 0,
+            'killed': 0,
+            'recycled': 0,
+            'seconds': 0.0,
+        }
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            size=int(os.environ.get('DOC_POOL_SIZE', default='1')),
+            timeout=float(os.environ.get('DOC_TIMEOUT', default='120')),
+            max_memory=int(os.environ.get('DOC_MAX_MEMORY_MB', default='2048')) * 2 ** 20,
+            max_tasks=int(os.environ.get('DOC_MAX_TASKS', default='50')),
+            start_timeout=float(os.environ.get('DOC_START_TIMEOUT', default='60'))
+        )
+
+    def reusable(self, converter: DocConverter) -> bool:
+        if converter.process.poll() is not None:
+            return False
+        return not (self.max_memory and converter.rss() > self.max_memory)
+
+    def count(self, key: str, value: float = 1):
+        with self.lock:
+            self.stats[key] += value
+
+    def convert(self, data: bytes) -> bytes:
+        """
+        Converts a .doc document to .docx in one of the pool processes. Blocks
+        until the conversion is done, so call it from a thread.
+
+        Args:
+            data (bytes): The .doc document content.
+
+        Returns:
+            bytes: The .docx document content.
+
+        Raises:
+            DocConversionError: If the conversion failed, timed out or ran out of memory.
+        """
+        with self.slots:
+            try:
+                converter = self.idle.get_nowait()
+            except queue.Empty:
+                converter = DocConverter(self.command, self.start_timeout)
+            start = time.time()
+            try:
+                result = converter.convert(data, self.timeout, self.max_memory)
+            except DocConversionError as e:
+                self.count('failures')
+                if isinstance(e, DocConversionTimeout):
+                    self.count('timeouts')
+                if self.reusable(converter):
+                    self.idle.put(converter)
+                else:
+                    self.count('killed')
+                    converter.kill()
+                raise
+            except OSError as e:
+                self.count('failures')
+                self.count('killed')
+                converter.kill()
+                raise DocConversionError(f'Conversion process failed: {e}')
+            finally:
+                elapsed = time.time() - start
+                self.count('seconds', elapsed)
+                self.count('conversions')
+            logger.info(f"DOC to DOCX conversion took {elapsed:.2f}s (pid: {converter.pid})")
+
+            if self.reusable(converter) and not (self.max_tasks and converter.tasks >= self.max_tasks):
+                self.idle.put(converter)
+            else:
+                self.count('recycled')
+                converter.close()
+            return result
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+if __name__ == '__main__':
+    # Imported before the process reports ready, the import takes seconds
+    import aspose.words
+    serve()
@@ -0,0 +1,107 @@
+import io
+from typing import BinaryIO, Dict, Tuple
+import zipfile
+import zlib
+
+
+DOCX = 'docx'
+DOC = 'doc'
+
+OLE2_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+ZIP_SIGNATURE = b'PK\x03\x04'
+RTF_SIGNATURE = b'{\\rtf'
+DOCX_MAIN_PART = 'word/document.xml'
+
+PARAGRAPH_TAGS = (b'<w:p>', b'<w:p ', b'<w:p/>')
+CELL_TAGS = (b'<w:tc>', b'<w:tc ')
+# Rough size of a paragraph in a binary .doc, the content is not scanned
+DOC_BYTES_PER_PARAGRAPH = 300
+SCAN_CHUNK_SIZE = 2 ** 20
+
+
+class UnsupportedFormatException(Exception):
+    pass
+
+
+def detect_format(data: bytes) -> str:
+    """
+    Detects the document format by its signature, without parsing the document.
+
+    Args:
+        data (bytes): The document content.
+
+    Returns:
+        str: DOCX for OOXML documents, DOC for formats converted to .docx by Aspose.Words
+            (OLE2 .doc and RTF).
+
+    Raises:
+        UnsupportedFormatException: If the content is not a supported document.
+    """
+    if data.startswith(OLE2_SIGNATURE) or data.startswith(RTF_SIGNATURE):
+        return DOC
+    if data.startswith(ZIP_SIGNATURE):
+        # Only the central directory at the end of the archive is read
+        try:
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                archive.getinfo(DOCX_MAIN_PART)
+        except zipfile.BadZipFile:
+            raise UnsupportedFormatException('Damaged ZIP archive')
+        except KeyError:
+            raise UnsupportedFormatException(f'ZIP archive without {DOCX_MAIN_PART}')
+        return DOCX
+    raise UnsupportedFormatException(f'Unknown signature {data[:8]!r}')
+
+
+def count_tags(stream: BinaryIO, tags: Dict[str, Tuple[bytes, ...]]) -> Dict[str, int]:
+    """
+    Counts opening tags in an XML stream without parsing it.
+    """
+    counts = dict.fromkeys(tags, 0)
+    # A tag split between chunks starts in the tail of the previous chunk, the
+    # tail is shorter than the tag so nothing is counted twice
+    overlap = max(len(tag) for variants in tags.values() for tag in variants) - 1
+    tail = b''
+    while True:
+        chunk = stream.read(SCAN_CHUNK_SIZE)
+        if not chunk:
+            return counts
+        for name, variants in tags.items():
+            counts[name] += sum((tail[-(len(tag) - 1):] + chunk).count(tag) for tag in variants)
+        tail = (tail + chunk)[-overlap:]
+
+
+def estimate_cost(data: bytes) -> dict:
+    """
+    Estimates the conversion cost of a document. For .docx only the main part is
+    decompressed and scanned for paragraphs and table cells, nothing is parsed.
+
+    Args:
+        data (bytes): The document content.
+
+    Returns:
+        dict: The detected format (None if unsupported), uncompressed size of the
+            main part, paragraphs and table cells counts and the cost in paragraphs.
+            Formats without a cheap scan are estimated by size.
+    """
+    try:
+        doc_format = detect_format(data)
+    except UnsupportedFormatException:
+        doc_format = None
+    estimate = {'format': doc_format, 'xml_size': 0, 'paragraphs': 0, 'cells': 0}
+    counts = None
+    if doc_format == DOCX:
+        try:
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                estimate['xml_size'] = archive.getinfo(DOCX_MAIN_PART).file_size
+                with archive.open(DOCX_MAIN_PART) as stream:
+                    counts = count_tags(stream, {'paragraphs': PARAGRAPH_TAGS, 'cells': CELL_TAGS})
+        except (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError):
+            # Damaged or unusually compressed archive, the worker reports it
+            pass
+    if counts is not None:
+        estimate.update(counts)
+    else:
+        estimate['paragraphs'] = len(data) // DOC_BYTES_PER_PARAGRAPH
+    # Table cells are analysed on top of their paragraphs
+    estimate['cost'] = max(1, estimate['paragraphs'] + estimate['cells'])
+    return estimate
@@ -0,0 +1,125 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import os
+import uuid
+from loguru import logger
+from cache import ResultCache
+from formats import DOCX
+from metrics import ModelLoadTimes
+
+
+class LocalConversionError(Exception):
+    pass
+
+
+class LocalConverter:
+    """
+    Converts small .docx documents in a process pool of the API itself, skipping
+    the RabbitMQ round trip. Uses the same conversion function as the worker,
+    so the results are identical.
+    """
+
+    def __init__(self, cache: ResultCache, max_cost: float, processes: int = 1,
+                 max_pending: int = 2, torch_threads: int = 1):
+        """
+        Initializes the LocalConverter. The pool starts with the first conversion.
+
+        Args:
+            cache (ResultCache): Conversion results cache shared with ConverterProxy.
+            max_cost (float): Largest estimated cost converted locally.
+            processes (int): Number of conversion processes.
+            max_pending (int): Conversions per process queued before the documents
+                are sent to the workers instead.
+            torch_threads (int): Number of intra-op threads torch may use.
+        """
+        self.cache = cache
+        self.max_cost = max_cost
+        self.processes = processes
+        self.max_pending = max_pending * processes
+        self.torch_threads = torch_threads
+        self.executor = None
+        self.load_times = None
+        self.pending = 0
+        self.stats = {
+            'conversions': 0,
+            'failures': 0,
+            'busy': 0,
+        }
+
+    @classmethod
+    def from_env(cls, cache: ResultCache):
+        return cls(
+            cache,
+            max_cost=float(os.environ.get('LOCAL_MAX_COST', default='0')),
+            processes=int(os.environ.get('LOCAL_PROCESSES', default='1')),
+            max_pending=int(os.environ.get('LOCAL_MAX_PENDING', default='2')),
+            torch_threads=int(os.environ.get('WORKER_TORCH_THREADS', default='1'))
+        )
+
+    def accepts(self, estimate: dict) -> bool:
+        """
+        Checks whether the document should be converted locally.
+
+        Args:
+            estimate (dict): The document estimate, see `formats.estimate_cost`.
+        """
+        # .doc documents need Aspose.Words, which only runs in the worker
+        if not self.max_cost or estimate['format'] != DOCX or estimate['cost'] > self.max_cost:
+            return False
+        if self.pending >= self.max_pending:
+            self.stats['busy'] += 1
+            return False
+        return True
+
+    async def convert(self, data: bytes) -> bytes:
+        """
+        Converts a .docx document to JSON in the local pool.
+
+        Args:
+            data (bytes): The document content.
+
+        Returns:
+            bytes: The converted document data, the same as the worker replies.
+
+        Raises:
+            LocalConversionError: If the conversion failed.
+        """
+        # Imported on demand, the API does not load models unless local conversions are enabled
+        from worker import convert_docx, init_process
+
+        key = self.cache.key(data)
+        cached = await asyncio.to_thread(self.cache.get, key)
+        if cached is not None:
+            logger.info(f"Conversion result found in cache (key: {key})")
+            return cached
+
+        if self.executor is None:
+            self.load_times = ModelLoadTimes()
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                initializer=init_process,
+                initargs=(self.torch_threads, self.load_times.queue)
+            )
+        self.pending += 1
+        try:
+            converted = await asyncio.get_running_loop().run_in_executor(
+                self.executor, convert_docx, data, f'local-{uuid.uuid4()}')
+        finally:
+            self.pending -= 1
+        self.stats['conversions'] += 1
+        if converted is None:
+            self.stats['failures'] += 1
+            raise LocalConversionError()
+        converted = converted.encode()
+        await asyncio.to_thread(self.cache.put, key, converted)
+        return converted
+
+    def model_load(self) -> dict:
+        """
+        Returns the model load seconds of the pool processes by process id and model name.
+        """
+        return self.load_times.get() if self.load_times is not None else {}
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
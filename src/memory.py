@@ -0,0 +1,22 @@
+def memory_info(pid: int) -> dict:
+    """
+    Reads the memory usage of a process from /proc/<pid>/smaps_rollup.
+
+    Args:
+        pid (int): The process id.
+
+    Returns:
+        dict: Resident, proportional, shared and private memory in bytes.
+    """
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    return {
+        'rss': fields.get('Rss', 0),
+        'pss': fields.get('Pss', 0),
+        'shared': fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0),
+        'private': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0),
+    }
@@ -0,0 +1,314 @@
+import asyncio
+import bisect
+import multiprocessing
+import os
+import queue
+import resource
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+from fastapi import FastAPI, Request, Response
+from loguru import logger
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Upper bounds of the document size buckets and their label values
+SIZE_BUCKETS = ((64 * 2 ** 10, '64KB'), (256 * 2 ** 10, '256KB'), (2 ** 20, '1MB'), (4 * 2 ** 20, '4MB'),
+                (16 * 2 ** 20, '16MB'))
+
+
+def size_bucket(size: int) -> str:
+    """
+    Returns the label of the document size bucket, e.g. "1MB" for documents of
+    256 KB up to 1 MB.
+    """
+    for bound, label in SIZE_BUCKETS:
+        if size <= bound:
+            return label
+    return 'inf'
+
+
+def process_rss() -> int:
+    """
+    Returns the resident memory of the current process in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Peak instead of the current value where /proc is not available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def hit_ratio(stats: dict) -> float:
+    """
+    Returns the share of the lookups of a `ResultCache` that found the result.
+    """
+    lookups = stats['hits'] + stats['misses']
+    return stats['hits'] / lookups if lookups else 0.0
+
+
+class ModelLoadTimes:
+    """
+    Model load times of the processes of a pool, sent by their initializers
+    through a queue.
+    """
+
+    def __init__(self):
+        self.queue = multiprocessing.Queue()
+        self.seconds = {}
+
+    def get(self) -> dict:
+        """
+        Returns the load seconds by process id and model name.
+        """
+        while True:
+            try:
+                pid, seconds = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.seconds[pid] = seconds
+        return {(pid, model): value for pid, models in self.seconds.items() for model, value in models.items()}
+
+
+def format_labels(names: Iterable[str], values: Iterable) -> str:
+    labels = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    )
+    return f'{{{labels}}}' if labels else ''
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def collect(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(self.labels, label_values)} {format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # Observations by bucket (not cumulative), their sum and count per label values
+        self.values: Dict[tuple, list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        names = self.labels + ('le',)
+        with self.lock:
+            for label_values, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = format_labels(names, label_values + (format_value(bound),))
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = format_labels(self.labels, label_values)
+                lines.append(f'{self.name}_sum{labels} {format_value(total)}')
+                lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Gauge:
+    """
+    A gauge read when the metrics are collected. The function returns the value,
+    or a dict of values by label values.
+    """
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], Union[float, dict]],
+                 labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.labels = labels
+
+    def collect(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        value = self.function()
+        values = value if isinstance(value, dict) else {(): value}
+        for label_values, value in sorted(values.items()):
+            if not isinstance(label_values, tuple):
+                label_values = (label_values,)
+            lines.append(f'{self.name}{format_labels(self.labels, label_values)} {format_value(value)}')
+        return lines
+
+
+def flatten_stats(stats: dict, prefix: str = '') -> Dict[str, float]:
+    """
+    Flattens a nested stats dict to numeric values by joined keys.
+    """
+    values = {}
+    for key, value in stats.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            values.update(flatten_stats(value, f'{name}_'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = value
+    return values
+
+
+class Stats:
+    """
+    Exports the numbers of a stats dict, which every component of the service
+    keeps, as one metric family labeled by the stat name.
+    """
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], dict]):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def collect(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} untyped']
+        for key, value in sorted(flatten_stats(self.function()).items()):
+            lines.append(f'{self.name}{format_labels(("stat",), (key,))} {format_value(value)}')
+        return lines
+
+
+class Metrics:
+    """
+    Registry of the metrics of a process, rendered in the Prometheus text format.
+    """
+
+    def __init__(self, namespace: str):
+        """
+        Initializes the Metrics.
+
+        Args:
+            namespace (str): Prefix of the metric names, e.g. "docparse_api".
+        """
+        self.namespace = namespace
+        self.metrics = []
+        self.gauge('process_resident_memory_bytes', 'Resident memory of the process', process_rss)
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.add(Counter(f'{self.namespace}_{name}', documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self.add(Histogram(f'{self.namespace}_{name}', documentation, labels, buckets))
+
+    def gauge(self, name: str, documentation: str, function: Callable[[], Union[float, dict]],
+              labels: Tuple[str, ...] = ()) -> Gauge:
+        return self.add(Gauge(f'{self.namespace}_{name}', documentation, function, labels))
+
+    def stats(self, name: str, documentation: str, function: Callable[[], dict]) -> Stats:
+        return self.add(Stats(f'{self.namespace}_{name}', documentation, function))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.collect())
+            except Exception:
+                # A broken metric should not hide the others
+                logger.exception(f"Failed to collect metric {metric.name}")
+        return '\n'.join(lines) + '\n'
+
+
+def instrument(app: FastAPI, metrics: Metrics) -> Histogram:
+    """
+    Adds the /metrics endpoint to the app and observes the latency of its requests
+    by route and status code. Streamed responses are observed when their headers
+    are sent.
+
+    Args:
+        app (FastAPI): The app.
+        metrics (Metrics): The metrics of the app.
+
+    Returns:
+        Histogram: The request latency histogram.
+    """
+    latency = metrics.histogram('http_request_duration_seconds', 'HTTP request latency by route and status code',
+                                ('method', 'route', 'status'))
+
+    @app.middleware('http')
+    async def observe_latency(request: Request, call_next):
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            # Route templates instead of paths, so ids do not make new series
+            route = request.scope.get('route')
+            latency.observe(time.perf_counter() - start, request.method,
+                            route.path if route is not None else 'unmatched', status)
+
+    @app.get('/metrics', include_in_schema=False)
+    async def get_metrics():
+        return Response(await asyncio.to_thread(metrics.render), media_type=CONTENT_TYPE)
+
+    return latency
+
+
+async def serve_metrics(metrics: Metrics, port: int, host: str = '0.0.0.0') -> asyncio.AbstractServer:
+    """
+    Serves the metrics over HTTP for processes without a web server, e.g. the
+    worker. Every request gets the metrics, whatever its path.
+
+    Args:
+        metrics (Metrics): The metrics to serve.
+        port (int): The port to listen on.
+        host (str): The address to listen on.
+
+    Returns:
+        asyncio.AbstractServer: The started server.
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Request line and headers are not needed, only read until their end
+            await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            body = (await asyncio.to_thread(metrics.render)).encode()
+            writer.write(
+                b'HTTP/1.1 200 OK\r\n'
+                + f'Content-Type: {CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode()
+                + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"Serving metrics on port {port}")
+    return server
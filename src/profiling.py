@@ -0,0 +1,303 @@
+import argparse
+import asyncio
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import cProfile
+from functools import partial
+import hmac
+from io import BytesIO
+import json
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import traceback
+from typing import List, Union
+from loguru import logger
+from formats import DOC, detect_format
+
+
+SAMPLING = 'sampling'
+CPROFILE = 'cprofile'
+PROFILERS = (SAMPLING, CPROFILE)
+
+
+class ProfilerBusyException(Exception):
+    pass
+
+
+def function_label(name: str, path: str, line: int) -> str:
+    """
+    Names a function for the profile: name, file relative to the installed
+    packages or the working directory, and the first line.
+    """
+    if 'site-packages' in path:
+        path = path.split('site-packages', 1)[1].lstrip(os.sep)
+    elif path.startswith(os.getcwd()):
+        path = os.path.relpath(path)
+    return f'{name} ({path}:{line})'
+
+
+class StackSampler:
+    """
+    Samples the stack of a thread at a fixed interval. The samples make a
+    flame graph in the folded stacks format and the hottest functions.
+    """
+
+    def __init__(self, interval: float = 0.005, thread_id: Union[int, None] = None):
+        """
+        Initializes the StackSampler.
+
+        Args:
+            interval (float): Seconds between the samples.
+            thread_id (int, optional): The sampled thread, the current one by default.
+        """
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(function_label(code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def folded(self) -> str:
+        """
+        Returns the samples in the folded stacks format of flamegraph.pl, also
+        read by speedscope and most flame graph viewers.
+        """
+        return ''.join(f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top(self, count: int) -> List[dict]:
+        """
+        Returns the functions with the most samples on top of the stack.
+        """
+        own, total = Counter(), Counter()
+        for stack, samples in self.stacks.items():
+            own[stack[-1]] += samples
+            # Recursive functions count once per sample
+            for function in set(stack):
+                total[function] += samples
+        return [
+            {
+                'function': function,
+                'self_seconds': round(samples * self.interval, 3),
+                'total_seconds': round(total[function] * self.interval, 3),
+                'self_samples': samples,
+            }
+            for function, samples in own.most_common(count)
+        ]
+
+
+def cprofile_top(stats: dict, count: int) -> List[dict]:
+    """
+    Returns the functions with the most own time of a cProfile run.
+
+    Args:
+        stats (dict): The `pstats.Stats.stats` of the run.
+        count (int): Number of the functions.
+    """
+    top = sorted(stats.items(), key=lambda item: -item[1][2])[:count]
+    return [
+        {
+            'function': function_label(name, filename, line),
+            'self_seconds': round(own_time, 3),
+            'total_seconds': round(total_time, 3),
+            'calls': calls,
+        }
+        for (filename, line, name), (_, calls, own_time, total_time, _) in top
+    ]
+
+
+def profile_document(data: bytes, profiler: str = SAMPLING, memory: bool = True, interval: float = 0.005,
+                     top: int = 30) -> dict:
+    """
+    Converts a document with DocHandler and DocJSON under a profiler. Runs
+    inside a pool process with the models loaded, so model loading is not profiled.
+
+    Args:
+        data (bytes): The .doc or .docx document.
+        profiler (str): SAMPLING, which samples the stack, or CPROFILE, which
+            traces every call and is slower.
+        memory (bool): Record the peak memory allocated by every stage with
+            tracemalloc, which slows the conversion down further.
+        interval (float): Seconds between the stack samples.
+        top (int): Number of the hottest functions in the report.
+
+    Returns:
+        dict: The report: conversion seconds, the error if the conversion failed,
+            stages with their time and peak memory, the hottest functions and the
+            profile - folded stacks for SAMPLING, marshalled pstats for CPROFILE.
+    """
+    # Imported on demand, only the profiling process needs the models and Aspose.Words
+    import docx
+    from doc_parse import DocHandler, DocJSON, StageTimer, doc_to_docx
+    from doc_parse.conf import CONF
+
+    if profiler not in PROFILERS:
+        raise ValueError(f'Unsupported profiler {profiler}')
+    timer = StageTimer(top=10, memory=memory)
+    if memory:
+        tracemalloc.start()
+    if profiler == SAMPLING:
+        sampler = StackSampler(interval)
+        sampler.start()
+    else:
+        profile = cProfile.Profile()
+        profile.enable()
+    error = None
+    start = time.perf_counter()
+    try:
+        if detect_format(data) == DOC:
+            with timer.stage('doc_to_docx'):
+                out_stream = BytesIO()
+                doc_to_docx(BytesIO(data), out_stream)
+                data = out_stream.getvalue()
+        with timer.stage('parse'):
+            handler = DocHandler(docx.Document(BytesIO(data)), timer=timer, **CONF)
+        DocJSON().get_json(handler)
+    except Exception as e:
+        # The profile of a failing conversion is as useful as of a slow one
+        error = ''.join(traceback.TracebackException.from_exception(e).format())
+    finally:
+        seconds = time.perf_counter() - start
+        if profiler == SAMPLING:
+            sampler.stop()
+        else:
+            profile.disable()
+        memory_peak = tracemalloc.get_traced_memory()[1] if memory else None
+        if memory:
+            tracemalloc.stop()
+
+    report = {
+        'profiler': profiler,
+        'seconds': round(seconds, 3),
+        'error': error,
+        'memory_peak_bytes': memory_peak,
+        **timer.report(),
+    }
+    if profiler == SAMPLING:
+        report['top_functions'] = sampler.top(top)
+        report['samples'] = sum(sampler.stacks.values())
+        report['profile'] = sampler.folded()
+    else:
+        stats = pstats.Stats(profile).stats
+        report['top_functions'] = cprofile_top(stats, top)
+        # The format of pstats.Stats.dump_stats, for snakeviz or flameprof
+        report['profile'] = marshal.dumps(stats)
+    return report
+
+
+class ProfileRunner:
+    """
+    Profiles conversions one at a time in a process of its own, so a profiled
+    conversion does not share the process with other requests.
+    """
+
+    def __init__(self, token: Union[str, None] = None, torch_threads: int = 1):
+        """
+        Initializes the ProfileRunner. The process starts with the first profile.
+
+        Args:
+            token (str, optional): Token the requests must present (None - profiling is disabled).
+            torch_threads (int): Number of intra-op threads torch may use.
+        """
+        self.token = token
+        self.torch_threads = torch_threads
+        self.executor = None
+        self.busy = False
+        self.stats = {
+            'profiles': 0,
+            'rejected': 0,
+        }
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            token=os.environ.get('PROFILE_TOKEN') or None,
+            torch_threads=int(os.environ.get('WORKER_TORCH_THREADS', default='1'))
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.token is not None
+
+    def authorized(self, token: Union[str, None]) -> bool:
+        return self.enabled and token is not None and hmac.compare_digest(token.encode(), self.token.encode())
+
+    async def run(self, data: bytes, **options) -> dict:
+        """
+        Profiles the conversion of a document, see `profile_document` for the options.
+
+        Raises:
+            ProfilerBusyException: If another profile is running.
+        """
+        # Imported on demand, like in LocalConverter
+        from worker import init_process
+
+        if self.busy:
+            self.stats['rejected'] += 1
+            raise ProfilerBusyException()
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=1, initializer=init_process,
+                                                initargs=(self.torch_threads,))
+        self.busy = True
+        try:
+            report = await asyncio.get_running_loop().run_in_executor(
+                self.executor, partial(profile_document, data, **options))
+        finally:
+            self.busy = False
+        self.stats['profiles'] += 1
+        logger.info(f"Profiled conversion in {report['seconds']}s, stages: {report['stages']}")
+        return report
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+
+def main(args: Union[List[str], None] = None):
+    parser = argparse.ArgumentParser(description='Profiles the conversion of a .doc/.docx document')
+    parser.add_argument('document', help='The document to convert')
+    parser.add_argument('--profiler', choices=PROFILERS, default=SAMPLING, help='Stack sampling or cProfile')
+    parser.add_argument('--no-memory', action='store_true', help='Do not record the peak memory of the stages')
+    parser.add_argument('--interval', type=float, default=0.005, help='Seconds between the stack samples')
+    parser.add_argument('--top', type=int, default=30, help='Number of the hottest functions in the report')
+    parser.add_argument('--output', help='File for the profile: folded stacks or pstats, by the profiler')
+    args = parser.parse_args(args)
+
+    # Imported on demand, like in bulk.py
+    from worker import init_process
+
+    init_process(1)
+    with open(args.document, 'rb') as f:
+        data = f.read()
+    report = profile_document(data, args.profiler, not args.no_memory, args.interval, args.top)
+    profile = report.pop('profile')
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(profile.encode() if isinstance(profile, str) else profile)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import gc
+import multiprocessing
+import os
+import signal
+import time
+from typing import Callable
+from loguru import logger
+import torch
+from doc_parse import preload_models
+from memory import memory_info
+
+
+class Supervisor:
+    """
+    Loads models once in the parent process and forks conversion children
+    that share the model weights copy-on-write.
+    """
+
+    def __init__(self, target: Callable[[int], None], children: int, max_tasks: int = 0,
+                 stats_interval: float = 60, torch_threads: int = 1, restart_delay: float = 1,
+                 max_restart_delay: float = 60, min_uptime: float = 60, max_failures: int = 5,
+                 poll_interval: float = 1):
+        """
+        Initializes the Supervisor.
+
+        Args:
+            target (Callable): Child entry point, receives the number of
+                documents after which the child exits (0 - never).
+            children (int): Number of conversion children to keep running.
+            max_tasks (int): Documents converted by a child before it is recycled.
+            stats_interval (float): Seconds between children memory reports.
+            torch_threads (int): Number of intra-op threads torch may use.
+            restart_delay (float): Seconds before restarting a child that failed
+                quickly, doubled on every consecutive failure of its slot.
+            max_restart_delay (float): Longest delay before a restart.
+            min_uptime (float): A child failing sooner failed quickly.
+            max_failures (int): Consecutive quick failures of a slot after which
+                the supervisor stops (0 - never).
+            poll_interval (float): Seconds between the checks of the children.
+        """
+        self.target = target
+        self.children_count = children
+        self.max_tasks = max_tasks
+        self.stats_interval = stats_interval
+        self.torch_threads = torch_threads
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.min_uptime = min_uptime
+        self.max_failures = max_failures
+        self.poll_interval = poll_interval
+        # Children by pid with their slot and start time
+        self.children = {}
+        # Consecutive quick failures and the earliest restart time of every slot
+        self.failures = [0] * children
+        self.restart_at = [0.0] * children
+        self.stopping = False
+        self.failed = False
+        self.context = multiprocessing.get_context('fork')
+
+    @classmethod
+    def from_env(cls, target: Callable[[int], None]):
+        return cls(
+            target,
+            children=int(os.environ.get('WORKER_PROCESSES', default=str(os.cpu_count()))),
+            max_tasks=int(os.environ.get('WORKER_MAX_TASKS', default='100')),
+            stats_interval=float(os.environ.get('WORKER_STATS_INTERVAL', default='60')),
+            torch_threads=int(os.environ.get('WORKER_TORCH_THREADS', default='1')),
+            restart_delay=float(os.environ.get('WORKER_RESTART_DELAY', default='1')),
+            max_failures=int(os.environ.get('WORKER_MAX_FAILURES', default='5'))
+        )
+
+    def preload(self):
+        # A single torch thread keeps OpenMP from starting a thread pool that
+        # would not survive fork
+        torch.set_num_threads(self.torch_threads)
+        start = time.time()
+        preload_models(warmup=True)
+        logger.info(f"Models preloaded in {time.time() - start:.1f}s (pid: {os.getpid()})")
+        # Move preloaded objects out of GC tracking, so collections in children
+        # do not write to (and copy) the shared pages
+        gc.collect()
+        gc.freeze()
+
+    def run_child(self):
+        # Children inherit the supervisor handlers, restore the defaults
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        self.target(self.max_tasks)
+
+    def spawn(self, slot: int):
+        child = self.context.Process(target=self.run_child)
+        child.start()
+        self.children[child.pid] = (slot, child, time.time())
+        logger.info(f"Conversion child started (pid: {child.pid}, slot: {slot})")
+
+    def reap(self):
+        for pid, (slot, child, started) in list(self.children.items()):
+            if child.is_alive():
+                continue
+            child.join()
+            del self.children[pid]
+            if child.exitcode == 0:
+                logger.info(f"Conversion child recycled (pid: {pid})")
+                self.failures[slot] = 0
+                continue
+            logger.error(f"Conversion child died (pid: {pid}, exitcode: {child.exitcode})")
+            if time.time() - started >= self.min_uptime:
+                self.failures[slot] = 0
+                continue
+            # A child failing on startup (broken models, OOM while loading) would
+            # fail again at once, restarts of its slot are spaced out
+            self.failures[slot] += 1
+            if self.max_failures and self.failures[slot] >= self.max_failures:
+                logger.critical(f"Conversion child failed {self.failures[slot]} times in a row, stopping")
+                self.failed = True
+                self.stopping = True
+                continue
+            delay = min(self.restart_delay * 2 ** (self.failures[slot] - 1), self.max_restart_delay)
+            self.restart_at[slot] = time.time() + delay
+            logger.warning(f"Restarting conversion child in {delay:.0f}s (slot: {slot}, failures: {self.failures[slot]})")
+
+    def report_memory(self):
+        for pid in self.children:
+            try:
+                mem = memory_info(pid)
+            except OSError:
+                continue
+            logger.info(
+                f"Child memory (pid: {pid}): shared {mem['shared'] / 2 ** 20:.0f} MB, "
+                f"private {mem['private'] / 2 ** 20:.0f} MB, "
+                f"pss {mem['pss'] / 2 ** 20:.0f} MB"
+            )
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def run(self) -> int:
+        """
+        Keeps the children running until SIGTERM or SIGINT.
+
+        Returns:
+            int: The exit code: 0, or 1 if a child kept failing on startup.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.preload()
+        last_report = time.time()
+        while not self.stopping:
+            self.reap()
+            running = {slot for slot, _, _ in self.children.values()}
+            for slot in range(self.children_count):
+                if not self.stopping and slot not in running and time.time() >= self.restart_at[slot]:
+                    self.spawn(slot)
+            if time.time() - last_report > self.stats_interval:
+                self.report_memory()
+                last_report = time.time()
+            time.sleep(self.poll_interval)
+
+        logger.info("Stopping conversion children")
+        for _, child, _ in self.children.values():
+            child.terminate()
+        for _, child, _ in self.children.values():
+            child.join()
+        return 1 if self.failed else 0
@@ -0,0 +1,51 @@
+import json
+from pathlib import Path
+import sys
+sys.path.append('..')
+
+from fastapi.testclient import TestClient
+
+from formats import OLE2_SIGNATURE
+from utils import ConversionReply
+
+docx_example = (Path(__file__).parent / 'docs_examples' / 'doc_1.docx').read_bytes()
+
+
+def test_unsupported_format():
+    from api import create_app
+
+    app = create_app()
+    with TestClient(app) as client:
+        response = client.post('/', files={'file': ('doc.docx', b'%PDF-1.4 not a document')})
+        assert response.status_code == 415
+        # Rejected before a conversion path is chosen
+        assert app.paths == {'local': 0, 'remote': 0}
+        response = client.post('/batch', files={'files': ('doc.pdf', b'%PDF-1.4 not a document')})
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert lines[0]['status_code'] == 415
+        assert lines[-1]['failed'] == 1
+
+
+def test_conversion_path(monkeypatch):
+    from api import create_app
+
+    monkeypatch.setenv('LOCAL_MAX_COST', '1000000')
+    app = create_app()
+
+    async def convert_local(data):
+        return b'{"path": "local"}'
+
+    async def convert_reply(data, cost=1, accept=(), timing=False):
+        return ConversionReply(b'{"path": "remote"}', None)
+
+    app.local_converter.convert = convert_local
+    app.converter.convert_reply = convert_reply
+    with TestClient(app) as client:
+        response = client.post('/', files={'file': ('doc.docx', docx_example)})
+        assert response.headers['X-Conversion-Path'] == 'local'
+        assert response.json() == {'path': 'local'}
+        # .doc documents are only converted by the workers
+        response = client.post('/', files={'file': ('doc.doc', OLE2_SIGNATURE + b'doc content')})
+        assert response.headers['X-Conversion-Path'] == 'remote'
+        assert response.json() == {'path': 'remote'}
+        assert client.get('/stats').json()['paths'] == {'local': 1, 'remote': 1}
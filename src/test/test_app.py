@@ -0,0 +1,96 @@
+import sys
+sys.path.append('..')
+
+from fastapi.testclient import TestClient
+
+from app import create_app, store_document
+
+
+def test_queue_limit(monkeypatch):
+    monkeypatch.setenv('VIEWER_MAX_PENDING', '0')
+    with TestClient(create_app()) as client:
+        response = client.post('/', files={'file': ('doc.docx', b'content')})
+        assert response.status_code == 429
+        assert client.get('/stats').json()['rejected'] == 1
+
+
+def test_unsupported_extension():
+    with TestClient(create_app()) as client:
+        response = client.post('/', files={'file': ('doc.pdf', b'content')}, follow_redirects=False)
+        assert response.status_code == 303
+
+
+def test_download_stored_result():
+    with TestClient(create_app()) as client:
+        result_id = client.app.results.key(b'content')
+        client.app.results.put(result_id, b'{"result": "ok"}')
+        response = client.get('/download_json', params={'id': result_id})
+        assert response.status_code == 200
+        assert response.json() == {'result': 'ok'}
+        assert 'output.json' in response.headers['content-disposition']
+
+
+def test_compressed_download():
+    with TestClient(create_app()) as client:
+        result_id = client.app.results.key(b'content')
+        content = '{"result": "%s"}' % ('ok ' * 1000)
+        client.app.results.put(result_id, content.encode())
+        for _ in range(2):
+            response = client.get('/download_json', params={'id': result_id}, headers={'Accept-Encoding': 'gzip'})
+            assert response.headers['content-encoding'] == 'gzip'
+            assert response.text == content
+        assert client.app.compressor.stats['precompressed_hits'] == 1
+        # The compressed variant is not a lookup of the stored result
+        assert client.app.results.stats['hits'] == 2
+
+
+def test_download_missing_result():
+    with TestClient(create_app()) as client:
+        assert client.get('/download_json', params={'id': '0' * 64}).status_code == 404
+        assert client.get('/download_json', params={'id': '../app.py'}).status_code == 404
+
+
+def test_stored_document_sections(monkeypatch):
+    # Stored documents are served without converting
+    monkeypatch.setenv('VIEWER_MAX_PENDING', '0')
+    with TestClient(create_app()) as client:
+        result_id = client.app.results.key(b'content')
+        store_document(client.app.results, result_id, ['<h1 id="par1">A</h1>', '<h1 id="par2">B</h1><p id="table3"></p>'],
+                       '<a href="#par1">A</a>', {'par1': 0, 'par2': 1, 'table3': 1}, '{}')
+        response = client.post('/', files={'file': ('doc.docx', b'content')})
+        assert response.status_code == 200
+        assert 'id="par1"' in response.text and 'id="par2"' not in response.text
+        assert 'id="section-1"' in response.text
+        assert client.get('/stats').json()['cached'] == 1
+
+        response = client.get('/section', params={'id': result_id, 'index': 1})
+        assert response.text == '<h1 id="par2">B</h1><p id="table3"></p>'
+        response = client.get('/section', params={'id': result_id, 'anchor': 'table3'})
+        assert response.headers['x-section-index'] == '1'
+        assert client.get('/section', params={'id': result_id, 'index': 2}).status_code == 404
+        assert client.get('/section', params={'id': result_id, 'anchor': 'par9'}).status_code == 404
+
+
+def test_partially_evicted_document(monkeypatch):
+    # A document missing a section is converted again instead of served
+    monkeypatch.setenv('VIEWER_MAX_PENDING', '0')
+    with TestClient(create_app()) as client:
+        results = client.app.results
+        result_id = results.key(b'content')
+        store_document(results, result_id, ['<h1 id="par1">A</h1>', '<h1 id="par2">B</h1>'],
+                       '<a href="#par1">A</a>', {'par1': 0, 'par2': 1}, '{}')
+        results.memory.pop(f'{result_id}.1')
+        results.memory_used.pop(f'{result_id}.1')
+        response = client.post('/', files={'file': ('doc.docx', b'content')})
+        assert response.status_code == 429
+        assert client.get('/stats').json()['cached'] == 0
+
+
+def test_metrics(monkeypatch):
+    monkeypatch.setenv('VIEWER_MAX_PENDING', '0')
+    with TestClient(create_app()) as client:
+        client.post('/', files={'file': ('doc.docx', b'content')})
+        lines = client.get('/metrics').text.splitlines()
+        assert 'docparse_viewer_max_pending 0' in lines
+        assert 'docparse_viewer_http_request_duration_seconds_count{method="POST",route="/",status="429"} 1' in lines
+        assert 'docparse_viewer_stats{stat="rejected"} 1' in lines
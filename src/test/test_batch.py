@@ -0,0 +1,86 @@
+import asyncio
+from io import BytesIO
+import json
+import sys
+import zipfile
+sys.path.append('..')
+
+import pytest
+
+from batch import BatchManager, FileTooLargeException, unpack
+from local import LocalConversionError
+from utils import FuturesLimitReachedException
+
+pytest_plugins = ('pytest_asyncio',)
+
+
+class FakeConverter:
+    def __init__(self, busy=0):
+        self.busy = busy
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, data):
+        if self.busy:
+            self.busy -= 1
+            raise FuturesLimitReachedException()
+        if data == b'broken':
+            raise LocalConversionError()
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        return json.dumps({'text': data.decode()}).encode()
+
+
+def make_zip(files):
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, data in files.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+async def read_lines(batch, offset=0):
+    return [json.loads(line) for chunk in [chunk async for chunk in batch.read(offset)]
+            for line in chunk.splitlines()]
+
+
+def test_unpack():
+    data = make_zip({'a.docx': b'a', 'dir/b.doc': b'b', 'notes.txt': b'c', '__MACOSX/a.docx': b'd'})
+    documents = unpack('specs.zip', data, 10)
+    assert [name for name, _ in documents] == ['specs.zip/a.docx', 'specs.zip/dir/b.doc']
+    assert [read() for _, read in documents] == [b'a', b'b']
+    assert [read() for _, read in unpack('a.docx', b'a', 10)] == [b'a']
+    # An uploaded document has the same limit as the documents of an archive
+    [(_, read)] = unpack('large.docx', b'large doc', 5)
+    with pytest.raises(FileTooLargeException):
+        read()
+
+
+@pytest.mark.asyncio
+async def test_batch(tmp_path):
+    converter = FakeConverter(busy=2)
+    manager = BatchManager(converter, directory=str(tmp_path), concurrency=2, max_file_bytes=5, retry_delay=0.001)
+    documents = unpack('docs.zip', make_zip({f'{i}.docx': f'doc {i}'.encode() for i in range(5)}), 5)
+    documents += unpack('broken.docx', b'broken', 10) + unpack('large.zip', make_zip({'large.docx': b'large doc'}), 5)
+    batch = await manager.submit(documents)
+    lines = await read_lines(batch)
+    assert {line['batch_id'] for line in lines} == {batch.id}
+    results = {line['filename']: line for line in lines[:-1]}
+    assert results['docs.zip/3.docx']['result'] == {'text': 'doc 3'}
+    assert results['broken.docx']['status_code'] == 422
+    assert results['large.zip/large.docx']['status_code'] == 413
+    assert lines[-1] == {'batch_id': batch.id, 'status': 'done', 'total': 7, 'converted': 5, 'failed': 2, 'retries': 2}
+    assert converter.max_running <= 2
+
+    # Resumed from the fifth line
+    assert await read_lines(manager.get(batch.id), 5) == lines[5:]
+
+
+@pytest.mark.asyncio
+async def test_retries_exhausted(tmp_path):
+    manager = BatchManager(FakeConverter(busy=10), directory=str(tmp_path), retries=1, retry_delay=0.001)
+    batch = await manager.submit(unpack('a.docx', b'a', 5))
+    lines = await read_lines(batch)
+    assert lines[0]['status_code'] == 429
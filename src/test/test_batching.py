@@ -0,0 +1,43 @@
+from concurrent.futures import ThreadPoolExecutor
+import sys
+import threading
+sys.path.append('..')
+
+import pytest
+
+from doc_parse.ml import BatchingClassifier
+
+
+class FakeClassifier:
+    def __init__(self):
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def predict(self, texts):
+        with self.lock:
+            self.batches.append(len(texts))
+        if 'error' in texts:
+            raise ValueError('bad text')
+        return [text.startswith('1.') for text in texts]
+
+
+def test_results_match_callers():
+    classifier = FakeClassifier()
+    batching = BatchingClassifier(classifier, max_batch=8, max_wait=0.05)
+    texts = [f'{i % 2}. text {i}' for i in range(32)]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(batching, texts))
+    assert results == [text.startswith('1.') for text in texts]
+    assert max(classifier.batches) <= 8
+    assert len(classifier.batches) < len(texts)
+    stats = batching.get_stats()
+    assert stats['requests'] == 32
+    assert sum(size * count for size, count in stats['batch_sizes'].items()) == 32
+    assert stats['queue_wait_max'] >= stats['queue_wait_avg'] > 0
+
+
+def test_error_reaches_caller():
+    batching = BatchingClassifier(FakeClassifier(), max_batch=1)
+    with pytest.raises(ValueError):
+        batching('error')
+    assert batching('1. text') is True
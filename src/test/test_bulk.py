@@ -0,0 +1,96 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+sys.path.append('..')
+
+import pytest
+
+from bulk import ARROW, MANIFEST_NAME, PARQUET, BulkConverter, find_documents
+
+
+def fake_convert(input_dir, path):
+    with open(os.path.join(input_dir, path), 'rb') as f:
+        data = f.read()
+    if data == b'broken':
+        return {'path': path, 'status': 'error', 'error': 'ValueError: broken', 'size': len(data),
+                'seconds': 1.0, 'result': None}
+    if data == b'interrupt':
+        raise KeyboardInterrupt()
+    return {'path': path, 'status': 'ok', 'error': None, 'size': len(data), 'seconds': len(data) / 100,
+            'result': json.dumps({'text': data.decode()})}
+
+
+def make_documents(directory, documents):
+    for name, data in documents.items():
+        os.makedirs(os.path.dirname(directory / name), exist_ok=True)
+        (directory / name).write_bytes(data)
+
+
+def read_ndjson(directory):
+    return [json.loads(line) for name in sorted(os.listdir(directory)) if name.endswith('.ndjson')
+            for line in (directory / name).read_text().splitlines()]
+
+
+def test_find_documents(tmp_path):
+    make_documents(tmp_path, {'a.docx': b'', 'sub/b.DOC': b'', '~$a.docx': b'', 'c.txt': b''})
+    assert find_documents(str(tmp_path)) == ['a.docx', os.path.join('sub', 'b.DOC')]
+
+
+def test_run_and_resume(tmp_path):
+    input_dir, output_dir = tmp_path / 'in', tmp_path / 'out'
+    make_documents(input_dir, {f'{i}.docx': f'document {i}'.encode() for i in range(5)})
+    make_documents(input_dir, {'broken.docx': b'broken'})
+
+    with ThreadPoolExecutor(2) as executor:
+        report = BulkConverter(str(output_dir), shard_size=2, window=2, top=2).run(executor, str(input_dir), fake_convert)
+    assert report['documents'] == 6
+    assert report['failed'] == 1
+    assert report['docs_per_second'] > 0
+    assert len(report['slowest']) == 2
+    assert report['slowest'][0] == {'path': 'broken.docx', 'seconds': 1.0, 'size': 6}
+    records = read_ndjson(output_dir)
+    assert sorted(record['path'] for record in records) == ['0.docx', '1.docx', '2.docx', '3.docx', '4.docx', 'broken.docx']
+    assert {'path': '3.docx', 'status': 'ok', 'error': None, 'size': 10, 'seconds': 0.1,
+            'result': {'text': 'document 3'}} in records
+    manifest = json.loads((output_dir / MANIFEST_NAME).read_text())
+    assert len(manifest['shards']) == 3
+
+    # A run interrupted after the first shard resumes from it
+    make_documents(input_dir, {'5.docx': b'document 5', '6.docx': b'interrupt', '7.docx': b'document 7'})
+    with pytest.raises(KeyboardInterrupt):
+        with ThreadPoolExecutor(1) as executor:
+            BulkConverter(str(output_dir), shard_size=1, window=1).run(executor, str(input_dir), fake_convert)
+    (input_dir / '6.docx').write_bytes(b'document 6')
+    with ThreadPoolExecutor(2) as executor:
+        report = BulkConverter(str(output_dir), shard_size=2).run(executor, str(input_dir), fake_convert)
+    assert report['skipped'] == 7
+    assert report['documents'] == 2
+    assert sorted(record['path'] for record in read_ndjson(output_dir)) == sorted(
+        find_documents(str(input_dir)))
+
+
+def test_format_mismatch(tmp_path):
+    pytest.importorskip('pyarrow')
+    with ThreadPoolExecutor(1) as executor:
+        BulkConverter(str(tmp_path)).run(executor, str(tmp_path), fake_convert)
+    with pytest.raises(ValueError):
+        BulkConverter(str(tmp_path), PARQUET)
+
+
+@pytest.mark.parametrize('output_format', [PARQUET, ARROW])
+def test_columnar_output(tmp_path, output_format):
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+    input_dir, output_dir = tmp_path / 'in', tmp_path / 'out'
+    make_documents(input_dir, {'a.docx': b'document a', 'broken.docx': b'broken'})
+    with ThreadPoolExecutor(1) as executor:
+        BulkConverter(str(output_dir), output_format).run(executor, str(input_dir), fake_convert)
+    path = str(output_dir / f'part-00000.{output_format}')
+    if output_format == PARQUET:
+        table = pyarrow.parquet.read_table(path)
+    else:
+        table = pyarrow.ipc.open_file(path).read_all()
+    rows = sorted(table.to_pylist(), key=lambda row: row['path'])
+    assert rows[0]['result'] == '{"text": "document a"}'
+    assert rows[1]['status'] == 'error' and rows[1]['result'] is None
@@ -0,0 +1,72 @@
+import os
+import sys
+sys.path.append('..')
+
+from cache import ResultCache, content_key
+
+
+def test_key():
+    assert content_key(b'doc', 'v1') == content_key(b'doc', 'v1')
+    assert content_key(b'doc', 'v1') != content_key(b'doc', 'v2')
+    assert content_key(b'doc', 'v1') != content_key(b'other doc', 'v1')
+
+
+def test_memory_lru():
+    cache = ResultCache(memory_bytes=10)
+    cache.put('a', b'aaaa')
+    cache.put('b', b'bbbb')
+    assert cache.get('a') == b'aaaa'
+    # 'b' is the least recently used entry
+    cache.put('c', b'cccc')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'aaaa'
+    assert cache.get('c') == b'cccc'
+    assert cache.stats['hits'] == 3
+    assert cache.stats['misses'] == 1
+    assert cache.stats['bytes_saved'] == 12
+
+
+def test_disk_tier(tmp_path):
+    cache = ResultCache(memory_bytes=4, directory=str(tmp_path), disk_bytes=100)
+    cache.put('a', b'aaaa')
+    cache.put('b', b'bbbb')
+    assert cache.get('a') == b'aaaa'
+    assert cache.stats['disk_hits'] == 1
+    # Another process sharing the directory
+    other = ResultCache(memory_bytes=4, directory=str(tmp_path), disk_bytes=100)
+    assert other.get('b') == b'bbbb'
+
+
+def test_disk_eviction(tmp_path):
+    cache = ResultCache(memory_bytes=0, directory=str(tmp_path), disk_bytes=25)
+    for i, key in enumerate(['a', 'b', 'c']):
+        cache.put(key, key.encode() * 10)
+        os.utime(cache.path(key), (i, i))
+    assert cache.get('a') is None
+    assert cache.get('b') == b'b' * 10
+    assert cache.get('c') == b'c' * 10
+    assert cache.stats['evicted'] == 1
+
+
+def test_ttl(tmp_path):
+    cache = ResultCache(memory_bytes=100, directory=str(tmp_path), disk_bytes=100, ttl=60)
+    cache.put('a', b'aaaa')
+    assert cache.get('a') == b'aaaa'
+    cache.memory_used['a'] -= 120
+    os.utime(cache.path('a'), (0, 0))
+    assert cache.get('a') is None
+    assert not os.path.exists(cache.path('a'))
+    assert cache.stats['expired'] == 2
+    assert cache.disk_size == 0
+
+
+def test_contains(tmp_path):
+    cache = ResultCache(memory_bytes=100, directory=str(tmp_path), ttl=60)
+    cache.put('a', b'result')
+    assert cache.contains('a') and not cache.contains('b')
+    cache.memory.clear()
+    # Found on disk without a lookup
+    assert cache.contains('a')
+    assert cache.stats['hits'] == cache.stats['misses'] == 0
+    cache.ttl = 1e-9
+    assert not cache.contains('a')
@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+sys.path.append('..')
+
+import pytest
+
+from claim_check import CLAIM_CHECK_HEADER, ClaimCheckMissingException, ClaimCheckStore
+
+
+def test_small_body_inline(tmp_path):
+    store = ClaimCheckStore(str(tmp_path), threshold=10)
+    assert store.put(b'small') == (b'small', {})
+    assert store.get(b'small', None) == b'small'
+    assert not list(tmp_path.iterdir())
+
+
+def test_disabled():
+    store = ClaimCheckStore(None, threshold=0)
+    assert store.put(b'body') == (b'body', {})
+    with pytest.raises(ClaimCheckMissingException):
+        store.get(b'', {CLAIM_CHECK_HEADER: 'name'})
+
+
+def test_round_trip(tmp_path):
+    store = ClaimCheckStore(str(tmp_path), threshold=10)
+    body, headers = store.put(b'large message body')
+    assert body == b''
+    assert store.get(body, headers) == b'large message body'
+    # The body is removed once consumed
+    with pytest.raises(ClaimCheckMissingException):
+        store.get(body, headers)
+    assert store.stats['stored'] == 1
+    assert store.stats['missing'] == 1
+
+
+def test_cleanup(tmp_path):
+    store = ClaimCheckStore(str(tmp_path), threshold=10, ttl=60)
+    _, old = store.put(b'unconsumed old body')
+    _, new = store.put(b'unconsumed new body')
+    past = time.time() - 120
+    os.utime(tmp_path / old[CLAIM_CHECK_HEADER], (past, past))
+    store.cleanup()
+    assert [path.name for path in tmp_path.iterdir()] == [new[CLAIM_CHECK_HEADER]]
+    assert store.stats['expired'] == 1
+
+
+def test_keep_until_handled(tmp_path):
+    store = ClaimCheckStore(str(tmp_path), threshold=10)
+    body, headers = store.put(b'large message body')
+    # A redelivered message reads the body again
+    assert store.get(body, headers, remove=False) == b'large message body'
+    assert store.get(body, headers, remove=False) == b'large message body'
+    store.remove(headers)
+    assert not list(tmp_path.iterdir())
+    store.remove(headers)
+    store.remove({})
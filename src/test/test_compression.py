@@ -0,0 +1,71 @@
+import sys
+sys.path.append('..')
+
+import pytest
+
+from compression import (GZIP, MessageCodec, ResponseCompressor, UnsupportedEncodingException, decompress,
+                         parse_accept_encoding)
+from formats import ZIP_SIGNATURE
+
+body = b'{"content": "' + b'repetitive text ' * 1000 + b'"}'
+
+
+def test_round_trip():
+    codec = MessageCodec(GZIP, threshold=10, level=9)
+    compressed, encoding = codec.encode(body)
+    assert encoding == GZIP
+    assert len(compressed) < len(body)
+    assert codec.decode(compressed, encoding) == body
+    assert codec.stats['compressed'] == 1
+
+
+def test_not_compressed():
+    codec = MessageCodec(GZIP, threshold=10)
+    assert codec.encode(b'short') == (b'short', None)
+    assert codec.encode(body, accept=['zstd']) == (body, None)
+    docx = ZIP_SIGNATURE + body
+    assert codec.encode(docx) == (docx, None)
+    assert MessageCodec(None).encode(body) == (body, None)
+    assert decompress(body, None) == body
+
+
+def test_parse_accept_encoding():
+    assert parse_accept_encoding('gzip, deflate, br;q=0.9, zstd;q=0') == ['gzip', 'deflate', 'br']
+    assert parse_accept_encoding(b'zstd,gzip') == ['zstd', 'gzip']
+    assert parse_accept_encoding(None) == []
+
+
+def test_unsupported():
+    with pytest.raises(UnsupportedEncodingException):
+        MessageCodec('deflate')
+    with pytest.raises(UnsupportedEncodingException):
+        decompress(body, 'deflate')
+
+
+def test_response_compressor():
+    compressor = ResponseCompressor([GZIP], threshold=100, cpu_budget=0)
+    compressed, encoding = compressor.encode(body, 'deflate, gzip')
+    assert encoding == GZIP
+    assert decompress(compressed, encoding) == body
+    assert compressor.encode(body, 'deflate') == (body, None)
+    assert compressor.encode(body, None) == (body, None)
+    assert compressor.encode(b'short', 'gzip') == (b'short', None)
+    assert compressor.headers(GZIP) == {'Vary': 'Accept-Encoding', 'Content-Encoding': GZIP}
+
+
+def test_response_compressor_budget():
+    compressor = ResponseCompressor([GZIP], threshold=100, cpu_budget=0.001)
+    compressor.budget = -1
+    assert compressor.encode(body, 'gzip') == (body, None)
+    assert compressor.stats['over_budget'] == 1
+
+
+def test_precompressed():
+    compressor = ResponseCompressor([GZIP], threshold=100, cpu_budget=0)
+    compressed, encoding = compressor.encode_cached('key', body, 'gzip')
+    assert compressor.cache.get(f'key.{GZIP}') == compressed
+    # Over the budget the stored variant is still sent
+    compressor.cpu_budget, compressor.budget = 0.001, -1
+    assert compressor.encode_cached('key', body, 'gzip') == (compressed, encoding)
+    assert compressor.stats['compressed'] == 1
+    assert compressor.stats['precompressed_hits'] == 1
@@ -0,0 +1,268 @@
+import asyncio
+import json
+from itertools import cycle
+import sys
+sys.path.append('..')
+
+import pytest
+
+import utils
+from claim_check import ClaimCheckStore
+from compression import GZIP, MessageCodec, compress
+from tracing import Tracer
+from formats import UnsupportedFormatException
+from utils import (CONVERSION_FAILED, ERROR_HEADER, TIMING_HEADER, TIMING_REPORT_HEADER, UNSUPPORTED_FORMAT,
+                   ConversionFailedException, ConversionTimeoutException, ConverterProxy, CostLimitReachedException)
+
+pytest_plugins = ('pytest_asyncio',)
+
+
+class FakeExchange:
+    def __init__(self):
+        self.published = []
+        self.routing_keys = []
+
+    async def publish(self, message, routing_key):
+        self.published.append(message)
+        self.routing_keys.append(routing_key)
+
+
+class FakeChannel:
+    def __init__(self):
+        self.default_exchange = FakeExchange()
+
+    async def declare_queue(self, name=None, **kwargs):
+        return FakeQueue()
+
+    async def declare_exchange(self, name, type):
+        return FakeExchange()
+
+
+class FakeConnection:
+    def __init__(self):
+        self.channels = []
+
+    async def channel(self, **kwargs):
+        await asyncio.sleep(0.01)
+        self.channels.append(FakeChannel())
+        return self.channels[-1]
+
+
+class FakeQueue:
+    name = 'callback'
+
+    async def consume(self, callback, no_ack):
+        pass
+
+
+class FakeReply:
+    def __init__(self, correlation_id, body, headers=None, content_encoding=None):
+        self.correlation_id = correlation_id
+        self.body = body
+        self.headers = headers
+        self.content_encoding = content_encoding
+
+
+@pytest.fixture
+def proxy(monkeypatch):
+    monkeypatch.setenv('MAX_CONVERTER_FUTURES', '2')
+    instance = ConverterProxy()
+    # Skip RabbitMQ connection
+    instance.initialized = True
+    instance.channel = FakeChannel()
+    instance.callback_queue = FakeQueue()
+    instance.cancel_exchange = FakeExchange()
+    instance.publish_channels_cycle = cycle([instance.channel])
+    return instance
+
+
+async def reply(proxy, body):
+    message = proxy.channel.default_exchange.published[-1]
+    await proxy.on_message(FakeReply(message.correlation_id, body))
+
+
+@pytest.mark.asyncio
+async def test_coalesce_identical(proxy):
+    requests = [asyncio.create_task(proxy.convert(b'same document')) for _ in range(4)]
+    await asyncio.sleep(0.1)
+    assert len(proxy.channel.default_exchange.published) == 1
+    assert len(proxy.futures) == 1
+    await reply(proxy, b'result')
+    assert await asyncio.gather(*requests) == [b'result'] * 4
+    assert proxy.stats['coalesced'] == 3
+    assert not proxy.futures and not proxy.inflight and not proxy.waiters
+
+
+@pytest.mark.asyncio
+async def test_cancel_one_waiter(proxy):
+    first = asyncio.create_task(proxy.convert(b'same document'))
+    second = asyncio.create_task(proxy.convert(b'same document'))
+    await asyncio.sleep(0.1)
+    first.cancel()
+    await asyncio.sleep(0.1)
+    assert len(proxy.futures) == 1
+    await reply(proxy, b'result')
+    assert await second == b'result'
+    with pytest.raises(asyncio.CancelledError):
+        await first
+
+
+@pytest.mark.asyncio
+async def test_cancel_all_waiters(proxy):
+    requests = [asyncio.create_task(proxy.convert(b'same document')) for _ in range(2)]
+    await asyncio.sleep(0.1)
+    for request in requests:
+        request.cancel()
+    await asyncio.gather(*requests, return_exceptions=True)
+    await asyncio.sleep(0.1)
+    # Futures slot is released and the late reply is ignored
+    assert not proxy.futures and not proxy.inflight and not proxy.waiters
+    # Workers are told to skip the task, the late reply is ignored
+    task = proxy.channel.default_exchange.published[-1]
+    assert proxy.cancel_exchange.published[-1].correlation_id == task.correlation_id
+    await reply(proxy, b'result')
+    assert proxy.get_stats()['late_replies'] == 1
+
+
+@pytest.mark.asyncio
+async def test_timeout(proxy):
+    proxy.timeout = 0.2
+    with pytest.raises(ConversionTimeoutException):
+        await proxy.convert(b'slow document')
+    await asyncio.sleep(0.1)
+    task = proxy.channel.default_exchange.published[-1]
+    assert float(task.headers['x-deadline']) > 0
+    assert task.expiration is not None
+    assert proxy.cancel_exchange.published[-1].correlation_id == task.correlation_id
+    assert proxy.get_stats()['timeouts'] == 1
+    assert proxy.get_stats()['futures'] == 0
+
+
+@pytest.mark.asyncio
+async def test_cost_admission_and_lanes(proxy):
+    proxy.futures_limit = 0
+    proxy.cost_limit = 3000
+    proxy.large_cost = 2000
+    large = asyncio.create_task(proxy.convert(b'large document', cost=2500))
+    await asyncio.sleep(0.1)
+    small = asyncio.create_task(proxy.convert(b'small document', cost=10))
+    await asyncio.sleep(0.1)
+    assert proxy.channel.default_exchange.routing_keys == [proxy.large_queue, proxy.queue]
+    with pytest.raises(CostLimitReachedException):
+        await proxy.convert(b'another large document', cost=2500)
+    assert proxy.get_stats()['cost'] == 2510
+    await reply(proxy, b'small result')
+    assert await small == b'small result'
+    message = proxy.channel.default_exchange.published[0]
+    await proxy.on_message(FakeReply(message.correlation_id, b'large result'))
+    assert await large == b'large result'
+    assert proxy.get_stats()['cost'] == 0
+    # A document over the limit is admitted when nothing else runs
+    huge = asyncio.create_task(proxy.convert(b'huge document', cost=5000))
+    await asyncio.sleep(0.1)
+    await reply(proxy, b'huge result')
+    assert await huge == b'huge result'
+    assert proxy.stats['cost_rejected'] == 1
+
+
+@pytest.mark.asyncio
+async def test_concurrent_start(monkeypatch):
+    monkeypatch.setenv('CONVERTER_CHANNELS', '3')
+    connections = []
+
+    async def get_connection(robust=False):
+        await asyncio.sleep(0.01)
+        connections.append(FakeConnection())
+        return connections[-1]
+
+    monkeypatch.setattr(utils, 'get_connection', get_connection)
+    instance = ConverterProxy()
+    await asyncio.gather(*[instance.start() for _ in range(5)])
+    assert len(connections) == 1
+    # One consume channel and the publish channels
+    assert len(connections[0].channels) == 4
+    assert instance.initialized
+
+
+@pytest.mark.asyncio
+async def test_claim_check(proxy, tmp_path):
+    proxy.claims = ClaimCheckStore(str(tmp_path), threshold=10)
+    request = asyncio.create_task(proxy.convert(b'large document content'))
+    await asyncio.sleep(0.1)
+    task = proxy.channel.default_exchange.published[-1]
+    assert task.body == b''
+    assert proxy.claims.get(task.body, task.headers) == b'large document content'
+    body, headers = proxy.claims.put(b'large conversion result')
+    await proxy.on_message(FakeReply(task.correlation_id, body, headers))
+    assert await request == b'large conversion result'
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.mark.asyncio
+async def test_compressed_reply(proxy):
+    proxy.codec = MessageCodec(GZIP, threshold=10)
+    data = b'{"content": "' + b'repetitive text ' * 100 + b'"}'
+    plain = asyncio.create_task(proxy.convert_encoded(b'document', accept=[]))
+    passed = asyncio.create_task(proxy.convert_encoded(b'document', accept=[GZIP]))
+    await asyncio.sleep(0.1)
+    task = proxy.channel.default_exchange.published[-1]
+    assert GZIP in task.headers['x-accept-encoding']
+    await proxy.on_message(FakeReply(task.correlation_id, compress(data, GZIP), content_encoding=GZIP))
+    assert await plain == (data, None)
+    assert await passed == (compress(data, GZIP), GZIP)
+    # Cached uncompressed
+    assert await proxy.convert(b'document') == data
+
+
+@pytest.mark.asyncio
+async def test_timing_reply(proxy):
+    request = asyncio.create_task(proxy.convert_reply(b'timed document', timing=True))
+    await asyncio.sleep(0.1)
+    task = proxy.channel.default_exchange.published[-1]
+    assert task.headers[TIMING_HEADER] == '1'
+    report = {'total_seconds': 0.5, 'stages': {'process': {'seconds': 0.4, 'calls': 1}}}
+    await proxy.on_message(FakeReply(task.correlation_id, b'result', {TIMING_REPORT_HEADER: json.dumps(report)}))
+    reply = await request
+    assert reply.body == b'result'
+    assert reply.timing == report
+    # Cached results come without the report
+    assert (await proxy.convert_reply(b'timed document', timing=True)).timing is None
+
+
+@pytest.mark.asyncio
+async def test_trace_propagation(proxy, tmp_path):
+    path = tmp_path / 'spans.jsonl'
+    proxy.tracer = Tracer('api', str(path))
+    with proxy.tracer.start_span('request') as parent:
+        request = asyncio.create_task(proxy.convert(b'traced document'))
+        await asyncio.sleep(0.1)
+    task = proxy.channel.default_exchange.published[-1]
+    trace_id, span_id = task.headers['traceparent'].split('-')[1:3]
+    assert trace_id == parent.context.trace_id
+    await proxy.on_message(FakeReply(task.correlation_id, b'result'))
+    assert await request == b'result'
+    proxy.tracer.close()
+    spans = [json.loads(line)['resourceSpans'][0]['scopeSpans'][0]['spans'][0] for line in path.read_text().splitlines()]
+    span = next(span for span in spans if span['name'] == 'converter.request')
+    assert span['spanId'] == span_id
+    assert span['parentSpanId'] == parent.context.span_id
+    assert {'key': 'correlation_id', 'value': {'stringValue': task.correlation_id}} in span['attributes']
+
+
+@pytest.mark.asyncio
+async def test_error_reply(proxy):
+    request = asyncio.create_task(proxy.convert(b'not a document'))
+    await asyncio.sleep(0.1)
+    task = proxy.channel.default_exchange.published[-1]
+    await proxy.on_message(FakeReply(task.correlation_id, b'Unknown signature', {ERROR_HEADER: UNSUPPORTED_FORMAT}))
+    with pytest.raises(UnsupportedFormatException):
+        await request
+    # Failures are not cached, the document is converted again next time
+    request = asyncio.create_task(proxy.convert(b'not a document'))
+    await asyncio.sleep(0.1)
+    task = proxy.channel.default_exchange.published[-1]
+    await proxy.on_message(FakeReply(task.correlation_id, b'Conversion failed', {ERROR_HEADER: CONVERSION_FAILED}))
+    with pytest.raises(ConversionFailedException):
+        await request
+    assert proxy.stats['failed'] == 2
+    assert not proxy.futures and not proxy.inflight
@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+sys.path.append('..')
+
+import pytest
+
+from doc_pool import DocConversionError, DocConversionPool, DocConversionTimeout
+
+# Conversion process reversing the input instead of running Aspose.Words
+child_command = [sys.executable, '-c', '''
+import time
+import doc_pool
+
+def convert(data):
+    if data == b"slow":
+        time.sleep(10)
+    if data == b"bad":
+        raise ValueError("bad document")
+    if data == b"noisy":
+        print("noise")
+    return data[::-1]
+
+doc_pool.serve(convert)
+''']
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    monkeypatch.setenv('PYTHONPATH', src_dir)
+    instance = DocConversionPool(size=2, timeout=1, max_tasks=3, command=child_command)
+    yield instance
+    instance.close()
+
+
+def test_convert(pool):
+    assert pool.convert(b'abc') == b'cba'
+    # Output of the converter does not break the protocol
+    assert pool.convert(b'noisy') == b'ysion'
+    large = os.urandom(5 * 2 ** 20)
+    assert pool.convert(large) == large[::-1]
+    assert pool.stats['recycled'] == 1
+
+
+def test_concurrent(pool):
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(pool.convert, [b'12', b'34', b'56', b'78']))
+    assert results == [b'21', b'43', b'65', b'87']
+
+
+def test_errors(pool):
+    with pytest.raises(DocConversionError, match='bad document'):
+        pool.convert(b'bad')
+    with pytest.raises(DocConversionTimeout):
+        pool.convert(b'slow')
+    assert pool.convert(b'ok') == b'ko'
+    assert pool.stats['failures'] == 2
+    assert pool.stats['timeouts'] == 1
+    assert pool.stats['killed'] == 1
+
+
+def test_slow_start(monkeypatch):
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    monkeypatch.setenv('PYTHONPATH', src_dir)
+    # Start of the process is not counted in the conversion timeout
+    command = [sys.executable, '-c', 'import time, doc_pool; time.sleep(1.5); doc_pool.serve(lambda data: data[::-1])']
+    pool = DocConversionPool(timeout=1, command=command)
+    assert pool.convert(b'abc') == b'cba'
+    pool.close()
+    pool = DocConversionPool(timeout=1, command=[sys.executable, '-c', 'raise SystemExit(3)'])
+    with pytest.raises(DocConversionError, match='exited with code 3'):
+        pool.convert(b'abc')
@@ -0,0 +1,39 @@
+from pathlib import Path
+import re
+import sys
+sys.path.append('..')
+
+import docx
+import pytest
+
+from doc_parse import DocHandler, DocHTML
+from doc_parse import numbering
+from doc_parse.conf import CONF
+
+docx_example = Path(__file__).parent / 'docs_examples' / 'doc_1.docx'
+
+
+@pytest.fixture(autouse=True)
+def classifier(monkeypatch):
+    monkeypatch.setattr(numbering, 'get_classifier', lambda model_name: lambda text: len(text) % 3 != 0)
+
+
+def test_sections():
+    html_content, toc_links = DocHTML().get_html(DocHandler(docx.Document(docx_example), **CONF))
+    sections, section_toc_links, anchors = DocHTML().get_sections(DocHandler(docx.Document(docx_example), **CONF))
+    assert ''.join(sections) == html_content
+    assert section_toc_links == toc_links
+    assert len(sections) > 1
+    for anchor in re.findall(r'href="#([^"]+)"', toc_links):
+        assert f'id="{anchor}"' in sections[anchors[anchor]]
+    for section in sections[1:]:
+        assert section.startswith('<div style="') and '<h1 ' in section.split('</div>')[0]
+
+
+def test_section_size():
+    handler = DocHandler(docx.Document(docx_example), **CONF)
+    html_content, _ = DocHTML().get_html(handler)
+    sections, _, anchors = DocHTML().get_sections(handler, max_section_chars=1000)
+    assert ''.join(sections) == html_content
+    assert len(sections) > len(DocHTML().get_sections(handler)[0])
+    assert max(anchors.values()) == len(sections) - 1
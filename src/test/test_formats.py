@@ -0,0 +1,64 @@
+import io
+from pathlib import Path
+import sys
+sys.path.append('..')
+import zipfile
+
+import pytest
+
+import formats
+from formats import DOC, DOCX, OLE2_SIGNATURE, UnsupportedFormatException, detect_format, estimate_cost
+
+docx_example = Path(__file__).parent / 'docs_examples' / 'doc_1.docx'
+
+
+def make_zip(names, content='<xml/>'):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name in names:
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
+
+def test_docx():
+    assert detect_format(docx_example.read_bytes()) == DOCX
+    assert detect_format(make_zip(['[Content_Types].xml', 'word/document.xml'])) == DOCX
+
+
+@pytest.mark.parametrize('data', [
+    OLE2_SIGNATURE + b'\x00' * 504,
+    b'{\\rtf1\\ansi text}',
+])
+def test_doc(data):
+    assert detect_format(data) == DOC
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'test data bytes',
+    make_zip(['xl/workbook.xml']),
+    docx_example.read_bytes()[:100],
+])
+def test_unsupported(data):
+    with pytest.raises(UnsupportedFormatException):
+        detect_format(data)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 5, 7, 2 ** 20])
+def test_estimate_cost(monkeypatch, chunk_size):
+    monkeypatch.setattr(formats, 'SCAN_CHUNK_SIZE', chunk_size)
+    body = '<w:body><w:p><w:r/></w:p><w:tbl><w:tr><w:tc><w:p w:rsidR="1"/></w:tc>' \
+        '<w:tc><w:p/></w:tc></w:tr></w:tbl><w:pPr/><w:proofErr/></w:body>'
+    estimate = estimate_cost(make_zip(['word/document.xml'], body))
+    assert estimate['format'] == DOCX
+    assert estimate['xml_size'] == len(body)
+    assert estimate['paragraphs'] == 3
+    assert estimate['cells'] == 2
+    assert estimate['cost'] == 5
+
+
+def test_estimate_cost_by_size():
+    estimate = estimate_cost(OLE2_SIGNATURE + b'\x00' * 3000)
+    assert estimate['format'] == DOC
+    assert estimate['cost'] == 10
+    assert estimate_cost(b'test data bytes')['format'] is None
@@ -0,0 +1,47 @@
+from pathlib import Path
+import sys
+sys.path.append('..')
+
+import pytest
+
+from cache import ResultCache
+from formats import DOC, DOCX
+from local import LocalConverter
+
+pytest_plugins = ('pytest_asyncio',)
+
+docx_example = (Path(__file__).parent / 'docs_examples' / 'doc_1.docx').read_bytes()
+
+
+def estimate(doc_format, cost):
+    return {'format': doc_format, 'cost': cost}
+
+
+def test_accepts():
+    converter = LocalConverter(ResultCache(), max_cost=100, processes=2, max_pending=1)
+    assert converter.accepts(estimate(DOCX, 100))
+    assert not converter.accepts(estimate(DOCX, 101))
+    assert not converter.accepts(estimate(DOC, 10))
+    assert not converter.accepts(estimate(None, 10))
+    converter.pending = 2
+    assert not converter.accepts(estimate(DOCX, 10))
+    assert converter.stats['busy'] == 1
+
+
+def test_disabled():
+    converter = LocalConverter(ResultCache(), max_cost=0)
+    assert not converter.accepts(estimate(DOCX, 1))
+
+
+@pytest.mark.asyncio
+async def test_same_result_as_worker():
+    from worker import convert_docx
+
+    converter = LocalConverter(ResultCache(), max_cost=1000000)
+    try:
+        converted = await converter.convert(docx_example)
+    finally:
+        converter.close()
+    # The client gets the same document whichever path converted it
+    assert converted == convert_docx(docx_example, 'worker').encode()
+    assert converter.stats['conversions'] == 1 and converter.stats['failures'] == 0
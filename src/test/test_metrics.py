@@ -0,0 +1,79 @@
+import asyncio
+import sys
+sys.path.append('..')
+
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+import pytest
+
+from metrics import Metrics, instrument, serve_metrics, size_bucket
+
+pytest_plugins = ('pytest_asyncio',)
+
+
+def test_histogram():
+    metrics = Metrics('test')
+    histogram = metrics.histogram('seconds', 'Test seconds', ('kind',), buckets=(1, 10))
+    for value in (0.5, 1, 5, 50):
+        histogram.observe(value, 'a')
+    lines = metrics.render().splitlines()
+    assert '# TYPE test_seconds histogram' in lines
+    assert 'test_seconds_bucket{kind="a",le="1"} 2' in lines
+    assert 'test_seconds_bucket{kind="a",le="10"} 3' in lines
+    assert 'test_seconds_bucket{kind="a",le="+Inf"} 4' in lines
+    assert 'test_seconds_sum{kind="a"} 56.5' in lines
+    assert 'test_seconds_count{kind="a"} 4' in lines
+
+
+def test_gauges_and_stats():
+    metrics = Metrics('test')
+    metrics.gauge('load_seconds', 'Load', lambda: {(1, 'model"x'): 2.5}, ('pid', 'model'))
+    metrics.stats('stats', 'Stats', lambda: {'requests': 3, 'cache': {'hits': 1}, 'name': 'skipped'})
+    lines = metrics.render().splitlines()
+    assert 'test_load_seconds{pid="1",model="model\\"x"} 2.5' in lines
+    assert 'test_stats{stat="cache_hits"} 1' in lines
+    assert 'test_stats{stat="requests"} 3' in lines
+    assert not any('skipped' in line for line in lines)
+    assert any(line.startswith('test_process_resident_memory_bytes ') for line in lines)
+
+
+def test_size_bucket():
+    assert size_bucket(1000) == '64KB'
+    assert size_bucket(2 ** 20) == '1MB'
+    assert size_bucket(2 ** 30) == 'inf'
+
+
+def test_instrument():
+    app = FastAPI()
+    metrics = Metrics('test')
+    instrument(app, metrics)
+
+    @app.get('/items/{item_id}')
+    async def item(item_id: int):
+        if item_id > 1:
+            raise HTTPException(status_code=429)
+        return {}
+
+    with TestClient(app) as client:
+        for item_id in (1, 1, 2):
+            client.get(f'/items/{item_id}')
+        response = client.get('/metrics')
+    assert response.headers['content-type'].startswith('text/plain')
+    lines = response.text.splitlines()
+    assert 'test_http_request_duration_seconds_count{method="GET",route="/items/{item_id}",status="200"} 2' in lines
+    assert 'test_http_request_duration_seconds_count{method="GET",route="/items/{item_id}",status="429"} 1' in lines
+
+
+@pytest.mark.asyncio
+async def test_serve_metrics():
+    metrics = Metrics('test')
+    metrics.gauge('value', 'Value', lambda: 7)
+    server = await serve_metrics(metrics, 0, host='127.0.0.1')
+    port = server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    response = await reader.read()
+    writer.close()
+    server.close()
+    assert response.startswith(b'HTTP/1.1 200 OK')
+    assert b'\ntest_value 7\n' in response
@@ -0,0 +1,91 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import io
+import sys
+sys.path.append('..')
+
+import docx
+import pytest
+
+from doc_parse import numbering
+from doc_parse.conf import CONF
+from doc_parse.ooxml import DocHandler
+
+
+def make_document():
+    doc = docx.Document()
+    for i in range(1, 40):
+        doc.add_paragraph().add_run(f'{i}. Раздел {i}' + 'x' * (i % 4)).bold = True
+        doc.add_paragraph().add_run(f'{i}.1. Подраздел {i}' + 'y' * (i % 5)).bold = i % 2 == 0
+        doc.add_paragraph('Текст раздела ' * 10)
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+
+    def classifier(text):
+        calls.append(text)
+        return len(text) % 3 != 0
+
+    monkeypatch.setattr(numbering, 'get_classifier', lambda model_name: classifier)
+    monkeypatch.setattr(numbering, 'get_classify_pool', lambda workers: ThreadPoolExecutor(workers))
+    return calls
+
+
+def process(data, **kwargs):
+    handler = DocHandler(docx.Document(io.BytesIO(data)), **{**CONF, **kwargs})
+    handler.process()
+    return [
+        (content.node._id, content.node.num_prefix, content.node.depth, content.node.source,
+         content.node.parents, content.ctext)
+        for content in handler.processed_content
+    ]
+
+
+def test_sharded_same_as_sequential(calls):
+    data = make_document()
+    expected = process(data)
+    assert calls
+    sequential_calls = set(calls)
+    calls.clear()
+    assert process(data, shard_workers=3, shard_min_paragraphs=1) == expected
+    # Every verdict used by the sequential pass was computed in the shards
+    assert sequential_calls <= set(calls)
+    assert len(calls) == len(set(calls))
+
+
+def test_headings_classified_in_shards(calls, monkeypatch):
+    doc = docx.Document()
+    for i in range(1, 20):
+        doc.add_paragraph(f'Заголовок {i}' + 'z' * (i % 4), style='Heading 1').runs[0].bold = True
+        doc.add_paragraph('Текст раздела ' * 10)
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    monkeypatch.setattr(numbering.NumberingDB, 'is_heading_style',
+                        lambda self, style_name: style_name == 'Heading 1')
+    expected = process(buffer.getvalue())
+    assert any(source == 'HEADING' for _, _, _, source, _, _ in expected)
+    sequential_calls = set(calls)
+    calls.clear()
+    assert process(buffer.getvalue(), shard_workers=3, shard_min_paragraphs=1) == expected
+    # Headings are not classified again by the sequential pass
+    assert sequential_calls <= set(calls)
+    assert len(calls) == len(set(calls))
+
+
+def test_broken_pool_falls_back(calls, monkeypatch):
+    class BrokenPool(ThreadPoolExecutor):
+        def submit(self, fn, *args, **kwargs):
+            future = Future()
+            future.set_exception(BrokenProcessPool('A process in the process pool was terminated abruptly'))
+            return future
+
+    data = make_document()
+    expected = process(data)
+    monkeypatch.setattr(numbering, 'get_classify_pool', lambda workers: BrokenPool(workers))
+    # Paragraphs without verdicts of the pool are classified sequentially
+    assert process(data, shard_workers=3, shard_min_paragraphs=1) == expected
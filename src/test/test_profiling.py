@@ -0,0 +1,97 @@
+import marshal
+from pathlib import Path
+import sys
+import time
+import tracemalloc
+sys.path.append('..')
+
+from fastapi.testclient import TestClient
+import pytest
+
+from doc_parse import StageTimer
+from doc_parse import numbering
+from profiling import CPROFILE, SAMPLING, StackSampler, profile_document
+
+docx_example = Path(__file__).parent / 'docs_examples' / 'doc_1.docx'
+
+
+@pytest.fixture
+def classifier(monkeypatch):
+    monkeypatch.setattr(numbering, 'get_classifier', lambda model_name: lambda text: len(text) % 3 != 0)
+
+
+def busy_loop(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_stack_sampler():
+    sampler = StackSampler(interval=0.001)
+    sampler.start()
+    busy_loop(0.2)
+    sampler.stop()
+    assert sampler.stacks
+    hottest = sampler.top(1)[0]
+    assert hottest['function'].startswith('busy_loop (')
+    assert hottest['self_samples'] > 0
+    for line in sampler.folded().splitlines():
+        stack, count = line.rsplit(' ', 1)
+        assert int(count) > 0
+        assert 'test_stack_sampler' in stack
+
+
+def test_memory_stages():
+    timer = StageTimer(memory=True)
+    tracemalloc.start()
+    try:
+        with timer.stage('outer'):
+            with timer.stage('inner'):
+                data = bytearray(4 * 2 ** 20)
+                del data
+            with timer.stage('small'):
+                data = bytearray(2 ** 20)
+    finally:
+        tracemalloc.stop()
+    stages = timer.report()['stages']
+    assert stages['inner']['memory_peak_bytes'] >= 4 * 2 ** 20
+    assert 2 ** 20 <= stages['small']['memory_peak_bytes'] < 4 * 2 ** 20
+    # The peak of an inner stage is the peak of the outer one as well
+    assert stages['outer']['memory_peak_bytes'] >= stages['inner']['memory_peak_bytes']
+
+
+@pytest.mark.parametrize('profiler', [SAMPLING, CPROFILE])
+def test_profile_document(classifier, profiler):
+    report = profile_document(docx_example.read_bytes(), profiler, interval=0.001, top=5)
+    for stage in ('parse', 'process', 'export_json'):
+        assert report['stages'][stage]['memory_peak_bytes'] > 0
+    assert report['memory_peak_bytes'] >= report['stages']['process']['memory_peak_bytes']
+    assert len(report['top_functions']) == 5
+    if profiler == SAMPLING:
+        assert 'process (doc_parse/ooxml.py:' in report['profile']
+    else:
+        stats = marshal.loads(report['profile'])
+        assert any(name == 'process' and path.endswith('ooxml.py') for path, _, name in stats)
+
+
+def test_profile_endpoint(monkeypatch):
+    from api import create_app
+
+    monkeypatch.setenv('PROFILE_TOKEN', 'secret')
+    app = create_app()
+
+    async def run(data, **options):
+        return {'seconds': 0.1, 'stages': {}, 'options': options, 'profile': 'main;convert 3\n'}
+
+    monkeypatch.setattr(app.profiler, 'run', run)
+    with TestClient(app) as client:
+        files = {'file': ('doc.docx', b'content')}
+        assert client.post('/debug/profile', files=files).status_code == 404
+        assert client.post('/debug/profile', files=files, headers={'X-Profile-Token': 'wrong'}).status_code == 404
+        response = client.post('/debug/profile', files=files, headers={'X-Profile-Token': 'secret'},
+                               params={'memory': 'false'})
+        assert response.json()['folded'] == 'main;convert 3\n'
+        assert response.json()['options'] == {'profiler': SAMPLING, 'memory': False, 'top': 30}
+        response = client.post('/debug/profile', files=files, headers={'X-Profile-Token': 'secret'},
+                               params={'format': 'profile'})
+        assert response.text == 'main;convert 3\n'
@@ -0,0 +1,34 @@
+import signal
+import sys
+sys.path.append('..')
+
+import pytest
+
+from supervisor import Supervisor
+
+
+def fail_on_startup(max_tasks):
+    sys.exit(1)
+
+
+@pytest.fixture
+def supervisor(monkeypatch):
+    # Supervisor.run installs its own handlers
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+    instance = Supervisor(fail_on_startup, children=1, restart_delay=0.05, max_restart_delay=0.1,
+                          min_uptime=60, max_failures=3, poll_interval=0.01)
+    monkeypatch.setattr(instance, 'preload', lambda: None)
+    yield instance
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def test_gives_up_on_quick_failures(supervisor, monkeypatch):
+    started = []
+    spawn = supervisor.spawn
+    monkeypatch.setattr(supervisor, 'spawn', lambda slot: started.append(slot) or spawn(slot))
+    assert supervisor.run() == 1
+    # Restarted with a delay after every failure, then stopped
+    assert started == [0, 0, 0]
+    assert supervisor.failures == [3]
+    assert not supervisor.children
@@ -0,0 +1,50 @@
+from pathlib import Path
+import sys
+sys.path.append('..')
+
+import docx
+import pytest
+
+from doc_parse.conf import CONF
+from doc_parse.core import TableHandler, analyse_table
+from doc_parse.ooxml import discard_table_pool, get_table_pool
+
+docx_example = Path(__file__).parent / 'docs_examples' / 'doc_1.docx'
+doc = docx.Document(docx_example)
+width, height = CONF['default_width'], CONF['default_height']
+
+
+def describe(handler):
+    return {
+        'frame': (handler.has_frame, handler.text_col_starts, handler.text_col_ends,
+                  handler.text_row_starts, handler.text_row_ends),
+        'rows': [
+            [(cell.x, cell.y, cell.rowspan, cell.colspan, cell.width, cell.height, cell.indent_top,
+              cell.is_text, cell.no_borders, cell.ctext, [par._p for par in cell.paragraphs])
+             for cell in row]
+            for row in handler.rows
+        ],
+    }
+
+
+@pytest.mark.parametrize('table', doc.tables)
+def test_layout_round_trip(table):
+    expected = describe(TableHandler(table, width, height, **CONF))
+    layout = analyse_table(table._tbl.xml, width, height, CONF)
+    assert describe(TableHandler.from_layout(table, layout)) == expected
+
+
+@pytest.fixture
+def table_pool():
+    pool = get_table_pool(2)
+    yield pool
+    # The pool is cached for the process, it would outlive the test
+    discard_table_pool(2, pool)
+    pool.shutdown()
+
+
+def test_pool(table_pool):
+    table = max(doc.tables, key=lambda table: len(table._tbl.xpath('.//w:tc')))
+    expected = describe(TableHandler(table, width, height, **CONF))
+    layout = table_pool.submit(analyse_table, table._tbl.xml, width, height, CONF).result()
+    assert describe(TableHandler.from_layout(table, layout)) == expected
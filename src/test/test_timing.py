@@ -0,0 +1,40 @@
+from pathlib import Path
+import sys
+sys.path.append('..')
+
+import docx
+import pytest
+
+from doc_parse import DocHandler, DocHTML, StageTimer
+from doc_parse import numbering
+from doc_parse.conf import CONF
+
+docx_example = Path(__file__).parent / 'docs_examples' / 'doc_1.docx'
+
+
+@pytest.fixture(autouse=True)
+def classifier(monkeypatch):
+    monkeypatch.setattr(numbering, 'get_classifier', lambda model_name: lambda text: len(text) % 3 != 0)
+
+
+def test_stage_report():
+    timer = StageTimer(top=3)
+    handler = DocHandler(docx.Document(docx_example), timer=timer, **CONF)
+    DocHTML().get_html(handler)
+    report = timer.report()
+    for stage in ('process', 'numerize', 'par_handler', 'table_handler', 'export_html'):
+        assert stage in report['stages']
+    seconds = [stage['seconds'] for stage in report['stages'].values()]
+    assert seconds == sorted(seconds, reverse=True)
+    assert report['stages']['table_handler']['calls'] == report['tables']['count'] > 0
+    assert report['tables']['cells'] > 0
+    assert 0 < len(report['slowest']['tables']) <= 3
+    assert len(report['slowest']['paragraphs']) == 3
+    paragraph_seconds = [paragraph['seconds'] for paragraph in report['slowest']['paragraphs']]
+    assert paragraph_seconds == sorted(paragraph_seconds, reverse=True)
+
+
+def test_timing_keeps_output():
+    html_content = DocHTML().get_html(DocHandler(docx.Document(docx_example), **CONF))
+    timed_content = DocHTML().get_html(DocHandler(docx.Document(docx_example), timer=StageTimer(), **CONF))
+    assert timed_content == html_content
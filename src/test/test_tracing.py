@@ -0,0 +1,133 @@
+import json
+import sys
+sys.path.append('..')
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from tracing import SpanContext, Tracer, current_span, format_traceparent, parse_traceparent, trace_requests
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+PARENT_ID = '00f067aa0ba902b7'
+
+
+def read_spans(path):
+    spans = []
+    with open(path) as f:
+        for line in f:
+            request = json.loads(line)
+            resource = request['resourceSpans'][0]
+            for span in resource['scopeSpans'][0]['spans']:
+                span['service'] = resource['resource']['attributes'][0]['value']['stringValue']
+                span['attributes'] = {item['key']: list(item['value'].values())[0] for item in span['attributes']}
+                spans.append(span)
+    return spans
+
+
+def test_traceparent():
+    context = parse_traceparent(f'00-{TRACE_ID}-{PARENT_ID}-01')
+    assert context == SpanContext(TRACE_ID, PARENT_ID, True)
+    assert format_traceparent(context) == f'00-{TRACE_ID}-{PARENT_ID}-01'
+    assert parse_traceparent(f'00-{TRACE_ID}-{PARENT_ID}-00').sampled is False
+    for value in (None, '', 'garbage', f'00-{"0" * 32}-{PARENT_ID}-01', f'00-{TRACE_ID}-xyz-01'):
+        assert parse_traceparent(value) is None
+
+
+def test_nested_spans(tmp_path):
+    path = tmp_path / 'spans.jsonl'
+    tracer = Tracer('test', str(path))
+    with tracer.start_span('parent', parent=SpanContext(TRACE_ID, PARENT_ID)) as parent:
+        with tracer.start_span('child', attributes={'size': 10}):
+            assert current_span.get().name == 'child'
+        headers = tracer.inject({})
+    assert current_span.get() is None
+    tracer.close()
+    child, exported_parent = read_spans(path)
+    assert headers['traceparent'] == f'00-{TRACE_ID}-{parent.context.span_id}-01'
+    assert exported_parent['parentSpanId'] == PARENT_ID
+    assert child['traceId'] == exported_parent['traceId'] == TRACE_ID
+    assert child['parentSpanId'] == exported_parent['spanId']
+    assert child['attributes'] == {'size': '10'}
+    assert child['service'] == 'test'
+
+
+def test_error_status(tmp_path):
+    path = tmp_path / 'spans.jsonl'
+    tracer = Tracer('test', str(path))
+    try:
+        with tracer.start_span('failing'):
+            raise ValueError('broken')
+    except ValueError:
+        pass
+    tracer.close()
+    assert read_spans(path)[0]['status'] == {'code': 2, 'message': 'ValueError: broken'}
+
+
+def test_sampling(tmp_path):
+    path = tmp_path / 'spans.jsonl'
+    tracer = Tracer('test', str(path), sample_ratio=0)
+    with tracer.start_span('root') as span:
+        # Not recorded, but the decision is passed on
+        assert tracer.inject({})['traceparent'].endswith('-00')
+        with tracer.start_span('child'):
+            pass
+    tracer.close()
+    assert span.context.sampled is False
+    assert path.read_text() == ''
+
+
+def test_disabled():
+    tracer = Tracer('test')
+    with tracer.start_span('span') as span:
+        span.set_attribute('key', 'value')
+    assert tracer.inject({}) == {}
+
+
+def test_trace_requests(tmp_path):
+    path = tmp_path / 'spans.jsonl'
+    tracer = Tracer('test', str(path))
+    app = FastAPI()
+    trace_requests(app, tracer)
+
+    @app.get('/items/{item_id}')
+    async def item(item_id: int):
+        with tracer.start_span('handler'):
+            return {}
+
+    with TestClient(app) as client:
+        client.get('/items/1', headers={'traceparent': f'00-{TRACE_ID}-{PARENT_ID}-01'})
+    tracer.close()
+    handler, request = read_spans(path)
+    assert request['name'] == 'GET /items/{item_id}'
+    assert request['traceId'] == TRACE_ID and request['parentSpanId'] == PARENT_ID
+    assert request['attributes']['http.status_code'] == '200'
+    assert handler['parentSpanId'] == request['spanId']
+
+
+def test_worker_stage_spans(tmp_path):
+    from worker import ConversionWorker, trace_id
+
+    path = tmp_path / 'spans.jsonl'
+    worker = ConversionWorker(None, None, None, None, None, tracer=Tracer('worker', str(path)))
+    report = {
+        'stages': {'process': {'seconds': 0.1, 'calls': 1}, 'numerize': {'seconds': 0.05, 'calls': 30}},
+        'tables': {'count': 2, 'cells': 10},
+        'spans': [
+            {'name': 'export_json', 'start_ns': 400, 'end_ns': 500},
+            {'name': 'analyse_tables', 'start_ns': 200, 'end_ns': 250},
+            {'name': 'parse', 'start_ns': 100, 'end_ns': 200},
+            {'name': 'process', 'start_ns': 200, 'end_ns': 400},
+        ],
+    }
+    with worker.tracer.start_span('convert_docx', trace_id=trace_id('4bf92f35-77b3-4da6-a3ce-929d0e0e4736')) as span:
+        worker.trace_stages(span, report)
+    worker.tracer.close()
+    spans = {span['name']: span for span in read_spans(path)}
+    root = spans['convert_docx']
+    assert root['traceId'] == TRACE_ID
+    assert root['attributes']['stage.numerize.calls'] == '30'
+    assert root['attributes']['tables'] == '2'
+    for name in ('parse', 'process', 'export_json'):
+        assert spans[name]['parentSpanId'] == root['spanId']
+    assert spans['analyse_tables']['parentSpanId'] == spans['process']['spanId']
+    assert 'spans' not in report
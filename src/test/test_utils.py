@@ -4,6 +4,7 @@ sys.path.append('..')
 import contextlib
 import threading
 import time
+import uuid
 
 import asyncio
 import aiohttp
@@ -13,6 +14,7 @@ from aio_pika import Message
 from aio_pika.exceptions import QueueEmpty
 from loguru import logger
 
+from formats import OLE2_SIGNATURE
 from utils import get_connection
 
 queue_name = os.environ.get('CONVERTER_QUEUE', default='convert')
@@ -105,7 +107,7 @@ class FakeWorker(threading.Thread):
                         await asyncio.sleep(0.1)
                 await exchange.publish(
                         Message(
-                            body=b'completed by test',
+                            body=b'"completed by test"',
                             correlation_id=msg.correlation_id
                             ),
                             routing_key=msg.reply_to
@@ -125,7 +127,10 @@ def fake_worker():
 def create_form_data():
     data = aiohttp.FormData()
     data.add_field('file', 
-            b'test data bytes', # for FakeWorker any data will be fine
+            # for FakeWorker any .doc will be fine: the API rejects unknown formats and
+            # converts small .docx in process. It has to differ between requests,
+            # identical concurrent uploads share one conversion
+            OLE2_SIGNATURE + b'test data bytes ' + uuid.uuid4().bytes,
             filename='doc.doc',
             )
     return data
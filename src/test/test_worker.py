@@ -0,0 +1,113 @@
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+import sys
+sys.path.append('..')
+
+import pytest
+
+from cache import ResultCache
+from claim_check import ClaimCheckStore
+from compression import MessageCodec
+from utils import ERROR_HEADER, UNSUPPORTED_FORMAT
+
+pytest_plugins = ('pytest_asyncio',)
+
+docx_example = (Path(__file__).parent / 'docs_examples' / 'doc_1.docx').read_bytes()
+
+
+class BrokenExecutor(Executor):
+    """
+    An executor whose process was killed, every task fails.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.set_exception(BrokenProcessPool('A process in the process pool was terminated abruptly'))
+        return future
+
+
+class FakeExchange:
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, message, routing_key):
+        self.published.append((message, routing_key))
+
+
+class FakeMessage:
+    def __init__(self, body: bytes, redelivered: bool = False):
+        self.body = body
+        self.headers = {}
+        self.correlation_id = 'task-1'
+        self.reply_to = 'replies'
+        self.routing_key = 'convert'
+        self.content_encoding = None
+        self.redelivered = redelivered
+        self.rejected = []
+
+    async def reject(self, requeue: bool = False):
+        self.rejected.append(requeue)
+
+
+def make_worker(executor: Executor, create_executor=None):
+    from worker import ConversionWorker
+
+    return ConversionWorker(executor, None, ResultCache(), ClaimCheckStore(), MessageCodec(),
+                            create_executor=create_executor)
+
+
+@pytest.mark.asyncio
+async def test_broken_pool_replaced():
+    broken = BrokenExecutor()
+    replacement = ThreadPoolExecutor(1)
+    worker = make_worker(broken, lambda: replacement)
+    message = FakeMessage(docx_example)
+    await worker.process_message(message)
+    # The task is retried by the broker with the new pool
+    assert message.rejected == [True]
+    assert worker.executor is replacement
+    assert worker.stats['requeued'] == 1 and worker.stats['pool_restarts'] == 1
+    replacement.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_broken_pool_redelivered():
+    worker = make_worker(BrokenExecutor(), ThreadPoolExecutor)
+    # A document that already broke a pool is not requeued again
+    with pytest.raises(BrokenProcessPool):
+        await worker.process_message(FakeMessage(docx_example, redelivered=True))
+    assert worker.stats['requeued'] == 0 and worker.stats['pool_restarts'] == 1
+    worker.executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_unsupported_format_reply():
+    worker = make_worker(BrokenExecutor())
+    worker.exchange = FakeExchange()
+    await worker.process_message(FakeMessage(b'%PDF-1.4 not a document'))
+    # The caller gets the error instead of waiting for the timeout
+    reply, routing_key = worker.exchange.published[0]
+    assert routing_key == 'replies'
+    assert reply.correlation_id == 'task-1'
+    assert reply.headers[ERROR_HEADER] == UNSUPPORTED_FORMAT
+    assert worker.stats['failed'] == 1
+
+
+@pytest.mark.asyncio
+async def test_claim_check_kept_until_reply(tmp_path):
+    replacement = ThreadPoolExecutor(1)
+    worker = make_worker(BrokenExecutor(), lambda: replacement)
+    worker.claims = ClaimCheckStore(str(tmp_path), threshold=10)
+    worker.exchange = FakeExchange()
+    requeued = FakeMessage(b'')
+    requeued.body, requeued.headers = worker.claims.put(docx_example)
+    await worker.process_message(requeued)
+    assert requeued.rejected == [True]
+    failed = FakeMessage(b'')
+    failed.body, failed.headers = worker.claims.put(b'%PDF-1.4 not a document')
+    await worker.process_message(failed)
+    assert len(worker.exchange.published) == 1
+    # Only the document of the replied task is removed, the requeued one is read again
+    assert [path.name for path in tmp_path.iterdir()] == [requeued.headers['x-claim-check']]
+    replacement.shutdown()
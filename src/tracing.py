@@ -0,0 +1,278 @@
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from typing import Dict, NamedTuple, Union
+from fastapi import FastAPI, Request
+from loguru import logger
+
+
+TRACEPARENT_HEADER = 'traceparent'
+# Span started by the current request or task, the parent of the spans started in it
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class SpanContext(NamedTuple):
+    trace_id: str
+    span_id: str
+    sampled: bool = True
+
+
+def parse_traceparent(value: Union[str, bytes, None]) -> Union[SpanContext, None]:
+    """
+    Parses a W3C Trace Context traceparent header.
+
+    Args:
+        value (str): The header value, e.g. "00-<trace id>-<span id>-01".
+
+    Returns:
+        SpanContext: The remote parent or None if the header is missing or invalid.
+    """
+    if isinstance(value, bytes):
+        value = value.decode()
+    parts = (value or '').split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        if not int(parts[1], 16) or not int(parts[2], 16):
+            return None
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    return SpanContext(parts[1], parts[2], bool(flags & 1))
+
+
+def format_traceparent(context: SpanContext) -> str:
+    return f"00-{context.trace_id}-{context.span_id}-{'01' if context.sampled else '00'}"
+
+
+def otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class Span:
+    """
+    A traced operation. Used as a context manager it becomes the parent of the
+    spans started inside and ends on exit.
+    """
+
+    def __init__(self, tracer: 'Tracer', name: str, context: SpanContext, parent_id: Union[str, None] = None,
+                 start_ns: Union[int, None] = None, attributes: Union[dict, None] = None):
+        self.tracer = tracer
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.token = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_error(self, message: str):
+        self.error = message
+
+    def end(self, end_ns: Union[int, None] = None):
+        if self.end_ns is not None:
+            return
+        self.end_ns = end_ns or time.time_ns()
+        if self.context.sampled:
+            self.tracer.export(self)
+
+    def __enter__(self) -> 'Span':
+        self.token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        current_span.reset(self.token)
+        if exc_type is not None and self.error is None:
+            self.set_error(f'{exc_type.__name__}: {exc}')
+        self.end()
+        return False
+
+    def to_otlp(self) -> dict:
+        span = {
+            'traceId': self.context.trace_id,
+            'spanId': self.context.span_id,
+            'name': self.name,
+            # SPAN_KIND_INTERNAL
+            'kind': 1,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [{'key': key, 'value': otlp_value(value)} for key, value in self.attributes.items()],
+            # STATUS_CODE_UNSET or STATUS_CODE_ERROR
+            'status': {'code': 2, 'message': self.error} if self.error else {},
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+class NullSpan:
+    """
+    The span returned when tracing is off, all its methods do nothing.
+    """
+    context = None
+
+    def set_attribute(self, key: str, value):
+        pass
+
+    def set_error(self, message: str):
+        pass
+
+    def end(self, end_ns: Union[int, None] = None):
+        pass
+
+    def __enter__(self) -> 'NullSpan':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    """
+    Records spans of a service and appends them to a file in the OTLP JSON
+    format, one export request per line, as the `otlpjsonfile` receiver of the
+    OpenTelemetry Collector reads them. The context is propagated between the
+    services in W3C traceparent headers.
+    """
+
+    def __init__(self, service: str, path: Union[str, None] = None, sample_ratio: float = 1.0):
+        """
+        Initializes the Tracer.
+
+        Args:
+            service (str): Service name of the spans.
+            path (str, optional): File the spans are appended to (None - tracing is off).
+            sample_ratio (float): Share of the traces started here that are recorded.
+                Traces started by other services follow their sampling decision.
+        """
+        self.service = service
+        self.path = path
+        self.sample_ratio = sample_ratio
+        self.lock = threading.Lock()
+        self.file = None
+        self.stats = {
+            'spans': 0,
+            'traces': 0,
+            'export_errors': 0,
+        }
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.file = open(path, 'a', buffering=1, encoding='utf-8')
+
+    @classmethod
+    def from_env(cls, service: str):
+        return cls(
+            service,
+            path=os.environ.get('TRACE_FILE') or None,
+            sample_ratio=float(os.environ.get('TRACE_SAMPLE_RATIO', default='1'))
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.file is not None
+
+    def start_span(self, name: str, parent: Union[Span, SpanContext, None] = None,
+                   attributes: Union[dict, None] = None, start_ns: Union[int, None] = None,
+                   trace_id: Union[str, None] = None) -> Union[Span, NullSpan]:
+        """
+        Starts a span.
+
+        Args:
+            name (str): The span name.
+            parent (Span | SpanContext, optional): The parent span or remote context,
+                the current span by default.
+            attributes (dict, optional): The span attributes.
+            start_ns (int, optional): Start time in nanoseconds since the epoch, now by default.
+            trace_id (str, optional): Trace id of a new trace, random by default.
+
+        Returns:
+            Span: The started span, NULL_SPAN if tracing is off. Spans of the traces
+                that are not sampled are only propagated, not exported.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        if parent is None:
+            parent = current_span.get()
+        if isinstance(parent, Span):
+            parent = parent.context
+        span_id = f'{random.getrandbits(64) or 1:016x}'
+        if parent is None:
+            sampled = random.random() < self.sample_ratio
+            context = SpanContext(trace_id or f'{random.getrandbits(128) or 1:032x}', span_id, sampled)
+            self.stats['traces'] += 1
+        else:
+            context = SpanContext(parent.trace_id, span_id, parent.sampled)
+        return Span(self, name, context, parent.span_id if parent is not None else None, start_ns, attributes)
+
+    def inject(self, headers: Dict, span: Union[Span, NullSpan, None] = None) -> Dict:
+        """
+        Adds the traceparent header of the span, the current one by default.
+        """
+        if span is None:
+            span = current_span.get()
+        if span is not None and span.context is not None:
+            headers[TRACEPARENT_HEADER] = format_traceparent(span.context)
+        return headers
+
+    @staticmethod
+    def extract(headers: Union[Dict, None]) -> Union[SpanContext, None]:
+        return parse_traceparent((headers or {}).get(TRACEPARENT_HEADER))
+
+    def export(self, span: Span):
+        line = json.dumps({'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': otlp_value(self.service)}]},
+            'scopeSpans': [{'scope': {'name': 'docparse'}, 'spans': [span.to_otlp()]}],
+        }]}, ensure_ascii=False)
+        with self.lock:
+            try:
+                self.file.write(line + '\n')
+                self.stats['spans'] += 1
+            except (OSError, ValueError):
+                self.stats['export_errors'] += 1
+                logger.exception(f"Failed to export span {span.name}")
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def trace_requests(app: FastAPI, tracer: Tracer):
+    """
+    Traces the requests of the app. The request span is the current span of the
+    handler, so the spans it starts and the tasks it publishes join its trace.
+    A traceparent header of the request continues the trace of the caller.
+    """
+    @app.middleware('http')
+    async def trace_request(request: Request, call_next):
+        if not tracer.enabled:
+            return await call_next(request)
+        span = tracer.start_span(f'{request.method} {request.url.path}', parent=tracer.extract(request.headers),
+                                 attributes={'http.method': request.method})
+        with span:
+            response = await call_next(request)
+            route = request.scope.get('route')
+            if route is not None:
+                span.name = f'{request.method} {route.path}'
+                span.set_attribute('http.route', route.path)
+            span.set_attribute('http.status_code', response.status_code)
+            if response.status_code >= 500:
+                span.set_error(f'HTTP {response.status_code}')
+            return response
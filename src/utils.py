@@ -1,14 +1,38 @@
 import asyncio
+import json
 import os
+import time
+from typing import Iterable, NamedTuple, Tuple, Union
 import uuid
-from aio_pika import Message, connect
+from itertools import cycle
+from aio_pika import ExchangeType, Message, connect, connect_robust
 from loguru import logger
+from cache import ResultCache
+from claim_check import ClaimCheckMissingException, ClaimCheckStore
+from compression import ACCEPT_ENCODING_HEADER, MessageCodec, available_encodings
+from formats import UnsupportedFormatException
+from tracing import Tracer
 
 
-async def get_connection():
+# Asks the worker to time the conversion stages, the report comes back in the reply header
+TIMING_HEADER = 'x-debug-timing'
+TIMING_REPORT_HEADER = 'x-conversion-timing'
+# Publish time of a task, the worker measures the queue wait with it
+PUBLISHED_HEADER = 'x-published'
+# Reason of a failed task, the worker replies with it instead of the result
+ERROR_HEADER = 'x-error'
+UNSUPPORTED_FORMAT = 'unsupported_format'
+CONVERSION_FAILED = 'conversion_failed'
+CLAIM_CHECK_MISSING = 'claim_check_missing'
+
+
+async def get_connection(robust: bool = False):
     """
     Establishes a connection to the RabbitMQ server.
 
+    Args:
+        robust (bool): Reconnect automatically, restoring channels, queues and consumers.
+
     Returns:
         aio_pika.Connection: The connection object to the RabbitMQ server.
     """
@@ -17,12 +41,49 @@ async def get_connection():
     host = os.environ.get('RABBITMQ_HOST', default='rabbitmq')
     port = os.environ.get('RABBITMQ_PORT', default=5672)
 
-    return await connect(f'amqp://{user}:{pasw}@{host}:{port}')
+    url = f'amqp://{user}:{pasw}@{host}:{port}'
+    if robust:
+        return await connect_robust(url)
+    return await connect(url)
+
+
+class ConversionReply(NamedTuple):
+    body: bytes
+    encoding: Union[str, None]
+    # Per-stage timing report of the worker, see `doc_parse.StageTimer`
+    timing: Union[dict, None] = None
 
 
 class FuturesLimitReachedException(Exception):
     pass
 
+
+class CostLimitReachedException(FuturesLimitReachedException):
+    pass
+
+
+class ConversionTimeoutException(Exception):
+    pass
+
+
+class ConversionFailedException(Exception):
+    pass
+
+
+def reply_error(reason: str, detail: str) -> Exception:
+    """
+    Makes the exception raised to the caller of a task failed by the worker.
+
+    Args:
+        reason (str): The ERROR_HEADER value of the reply.
+        detail (str): The error description sent by the worker.
+    """
+    if reason == UNSUPPORTED_FORMAT:
+        return UnsupportedFormatException(detail)
+    if reason == CLAIM_CHECK_MISSING:
+        return ClaimCheckMissingException(detail)
+    return ConversionFailedException(detail)
+
 class ConverterProxy:
     """
     A proxy class to handle document conversion requests via RabbitMQ.
@@ -33,54 +94,287 @@ class ConverterProxy:
         Initializes the ConverterProxy instance.
         """
         self.initialized = False
-        self.initializing = False
+        self.init_lock = None
+        self.channels_count = int(os.environ.get('CONVERTER_CHANNELS', default='4'))
         self.futures = {}
         self.futures_limit = int(os.environ.get('MAX_CONVERTER_FUTURES', default='0'))
+        # Estimated cost (paragraphs) of conversions in progress and its limit (0 - no limit)
+        self.cost = 0
+        self.cost_limit = float(os.environ.get('MAX_CONVERTER_COST', default='0'))
+        # Documents costing more go to the large lane, so they do not delay small ones
+        self.large_cost = float(os.environ.get('CONVERTER_LARGE_COST', default='2000'))
+        self.queue = os.environ.get('CONVERTER_QUEUE', default='convert')
+        self.large_queue = os.environ.get('CONVERTER_LARGE_QUEUE', default=f'{self.queue}.large')
+        # Seconds a caller waits for the result, also the task message TTL (0 - no limit)
+        self.timeout = float(os.environ.get('CONVERTER_TIMEOUT', default='300'))
+        self.cache = ResultCache.from_env()
+        # Large documents and results travel through a shared directory instead of the broker
+        self.claims = ClaimCheckStore.from_env()
+        self.codec = MessageCodec.from_env()
+        self.tracer = Tracer.from_env('docparse-api')
+        # Pending conversions by content key and the number of callers waiting for them
+        self.inflight = {}
+        self.waiters = {}
+        self.stats = {
+            'requests': 0,
+            'coalesced': 0,
+            'timeouts': 0,
+            'cancelled': 0,
+            'late_replies': 0,
+            'large': 0,
+            'cost_rejected': 0,
+            'futures_rejected': 0,
+            'failed': 0,
+        }
 
-    async def convert(self, data: bytes):
+    async def start(self):
+        """
+        Connects to RabbitMQ, declares the callback queue and opens publish channels.
+        Concurrent calls wait for a single initialization.
+        """
+        if self.initialized:
+            return
+        if self.init_lock is None:
+            self.init_lock = asyncio.Lock()
+        async with self.init_lock:
+            if self.initialized:
+                return
+            logger.info("Initializing ConverterProxy...")
+            self.connection = await get_connection(robust=True)
+            self.channel = await self.connection.channel()
+            self.callback_queue = await self.channel.declare_queue(exclusive=True)
+            await self.callback_queue.consume(self.on_message, no_ack=True)
+            self.cancel_exchange = await self.channel.declare_exchange(
+                os.environ.get('CONVERTER_CANCEL_EXCHANGE', default='convert.cancel'),
+                ExchangeType.FANOUT
+            )
+            # Tasks published before any worker declared the lane queues would be dropped
+            for queue in (self.queue, self.large_queue):
+                await self.channel.declare_queue(queue)
+            # Publishes are spread over the channels without exclusive locking,
+            # concurrent publishes on a channel are confirmed by the broker in batches
+            self.publish_channels = [
+                await self.connection.channel(publisher_confirms=True)
+                for _ in range(self.channels_count)
+            ]
+            self.publish_channels_cycle = cycle(self.publish_channels)
+            self.initialized = True
+            logger.info("ConverterProxy initialized.")
+
+    async def close(self):
+        if self.initialized:
+            await self.connection.close()
+            self.initialized = False
+        self.tracer.close()
+
+    async def publish(self, message: Message, routing_key: str):
+        """
+        Publishes a message to the default exchange and waits for the broker confirmation.
+        """
+        channel = next(self.publish_channels_cycle)
+        await channel.default_exchange.publish(message, routing_key=routing_key)
+
+    async def convert(self, data: bytes, cost: float = 1) -> bytes:
         """
         Sends a document conversion request to the RabbitMQ queue and waits for the response.
 
         Args:
             data (bytes): The document data to be converted.
+            cost (float): Estimated conversion cost, see `formats.estimate_cost`.
 
         Returns:
             bytes: The converted document data.
         """
-        if not self.initialized:
-            self.initializing = True
-            logger.info("Initializing ConverterProxy...")
-            self.connection = await get_connection()
-            self.channel = await self.connection.channel()
-            self.callback_queue = await self.channel.declare_queue(exclusive=True)
-            await self.callback_queue.consume(self.on_message, no_ack=True)
-            self.initialized = True
-            self.initializing = False
-            logger.info("ConverterProxy initialized.")
+        result, _ = await self.convert_encoded(data, cost)
+        return result
+
+    async def convert_encoded(self, data: bytes, cost: float = 1,
+                              accept: Iterable[str] = ()) -> Tuple[bytes, Union[str, None]]:
+        """
+        Same as `convert`, but returns the result compressed by the worker as is
+        when the caller accepts its encoding.
+
+        Args:
+            data (bytes): The document data to be converted.
+            cost (float): Estimated conversion cost, see `formats.estimate_cost`.
+            accept (Iterable[str]): Encodings the caller can pass on.
+
+        Returns:
+            Tuple[bytes, str]: The converted document data and its encoding (None - not compressed).
+        """
+        reply = await self.convert_reply(data, cost, accept)
+        return reply.body, reply.encoding
+
+    async def convert_reply(self, data: bytes, cost: float = 1, accept: Iterable[str] = (),
+                            timing: bool = False) -> ConversionReply:
+        """
+        Same as `convert_encoded`, but may also ask the worker for the timing of
+        the conversion stages. Cached results come without it, and so do results
+        of a pending conversion that was started without it.
+
+        Args:
+            data (bytes): The document data to be converted.
+            cost (float): Estimated conversion cost, see `formats.estimate_cost`.
+            accept (Iterable[str]): Encodings the caller can pass on.
+            timing (bool): Ask the worker for the timing report.
+
+        Returns:
+            ConversionReply: The converted document data, its encoding and the timing report.
+        """
+        await self.start()
 
-        while self.initializing:
-            await asyncio.sleep(0.1)
+        self.stats['requests'] += 1
+        key = self.cache.key(data)
+        cached = await asyncio.to_thread(self.cache.get, key)
+        if cached is not None:
+            logger.info(f"Conversion result found in cache (key: {key})")
+            return ConversionReply(cached, None)
+
+        pending = self.inflight.get(key)
+        if pending is not None:
+            # Identical document is already being converted, wait for its result
+            self.stats['coalesced'] += 1
+            logger.info(f"Joined pending conversion (key: {key})")
+            return await self.decode(await self.wait(key, pending), accept)
 
         if self.futures_limit > 0 and len(self.futures) >= self.futures_limit:
+            self.stats['futures_rejected'] += 1
             logger.error("Futures limit reached.")
             raise FuturesLimitReachedException()
 
+        # A single document over the limit is still admitted when nothing else runs
+        if self.cost_limit > 0 and self.cost and self.cost + cost > self.cost_limit:
+            self.stats['cost_rejected'] += 1
+            logger.error(f"Cost limit reached (in progress: {self.cost}, requested: {cost}).")
+            raise CostLimitReachedException()
+
         correlation_id = str(uuid.uuid4())
         loop = asyncio.get_running_loop()
         future = loop.create_future()
-
         self.futures[correlation_id] = future
 
-        logger.info(f"Sending conversion request with correlation_id: {correlation_id}")
-        await self.channel.default_exchange.publish(
-            Message(
-                data,
-                correlation_id=correlation_id,
-                reply_to=self.callback_queue.name
-                ),
-            routing_key=os.environ.get('CONVERTER_QUEUE', default='convert')
-            )
-        return await future
+        self.cost += cost
+        pending = asyncio.ensure_future(self.request(key, data, correlation_id, future, cost, timing))
+        self.inflight[key] = pending
+        self.waiters[pending] = 0
+        pending.add_done_callback(lambda _: self.finish(key, pending, cost))
+        return await self.decode(await self.wait(key, pending), accept)
+
+    async def decode(self, reply: ConversionReply, accept: Iterable[str]) -> ConversionReply:
+        if reply.encoding is None or reply.encoding in accept:
+            return reply
+        return reply._replace(body=await asyncio.to_thread(self.codec.decode, reply.body, reply.encoding), encoding=None)
+
+    async def wait(self, key: str, pending: asyncio.Future) -> ConversionReply:
+        """
+        Waits for a pending conversion shared by several callers. A cancelled or
+        timed out caller leaves the conversion running for the others; the
+        conversion is cancelled when the last caller is gone.
+        """
+        self.waiters[pending] += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(pending), self.timeout or None)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            logger.error(f"Conversion timed out (key: {key})")
+            self.release(key, pending)
+            raise ConversionTimeoutException()
+        except asyncio.CancelledError:
+            self.release(key, pending)
+            raise
+
+    def release(self, key: str, pending: asyncio.Future):
+        if pending not in self.waiters:
+            return
+        self.waiters[pending] -= 1
+        if self.waiters[pending] == 0:
+            logger.info(f"No callers left, dropping conversion (key: {key})")
+            pending.cancel()
+            self.forget(key, pending)
+
+    def finish(self, key: str, pending: asyncio.Future, cost: float):
+        self.cost -= cost
+        self.forget(key, pending)
+
+    def forget(self, key: str, pending: asyncio.Future):
+        self.waiters.pop(pending, None)
+        if self.inflight.get(key) is pending:
+            del self.inflight[key]
+
+    async def request(self, key: str, data: bytes, correlation_id: str,
+                      future: asyncio.Future, cost: float, timing: bool = False) -> ConversionReply:
+        routing_key = self.queue
+        if cost >= self.large_cost:
+            self.stats['large'] += 1
+            routing_key = self.large_queue
+        body, encoding = await asyncio.to_thread(self.codec.encode, data)
+        body, headers = await asyncio.to_thread(self.claims.put, body)
+        # The worker compresses the result only with an encoding the proxy can decode
+        headers[ACCEPT_ENCODING_HEADER] = ','.join(available_encodings())
+        if self.timeout:
+            # Lets the worker skip the task once nobody waits for it
+            headers['x-deadline'] = time.time() + self.timeout
+        if timing:
+            headers[TIMING_HEADER] = '1'
+        # The worker continues the trace of the request in the spans of the task
+        span = self.tracer.start_span('converter.request', attributes={
+            'correlation_id': correlation_id,
+            'queue': routing_key,
+            'document.bytes': len(data),
+            'cost': cost,
+        })
+        self.tracer.inject(headers, span)
+        try:
+            headers[PUBLISHED_HEADER] = time.time()
+            logger.info(f"Sending conversion request with correlation_id: {correlation_id} (queue: {routing_key})")
+            await self.publish(
+                Message(
+                    body,
+                    correlation_id=correlation_id,
+                    reply_to=self.callback_queue.name,
+                    headers=headers,
+                    content_encoding=encoding,
+                    # Broker drops the task if no worker takes it in time
+                    expiration=self.timeout or None
+                    ),
+                routing_key=routing_key
+                )
+            result = await future
+            span.set_attribute('reply.bytes', len(result.body))
+        except asyncio.CancelledError:
+            self.stats['cancelled'] += 1
+            span.set_error('Cancelled')
+            asyncio.ensure_future(self.notify_cancelled(correlation_id))
+            raise
+        except Exception as e:
+            span.set_error(f'{type(e).__name__}: {e}')
+            raise
+        finally:
+            self.futures.pop(correlation_id, None)
+            span.end()
+        # Cached results are stored uncompressed, like the worker stores them
+        await asyncio.to_thread(lambda: self.cache.put(key, self.codec.decode(result.body, result.encoding)))
+        return result
+
+    async def notify_cancelled(self, correlation_id: str):
+        """
+        Tells workers that nobody waits for the task anymore.
+        """
+        try:
+            await self.cancel_exchange.publish(Message(b'', correlation_id=correlation_id), routing_key='')
+        except Exception:
+            logger.exception(f"Failed to publish cancellation (correlation_id: {correlation_id})")
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            'futures': len(self.futures),
+            'inflight': len(self.inflight),
+            'cost': self.cost,
+            'claims': self.claims.stats,
+            'compression': self.codec.stats,
+            'tracing': self.tracer.stats,
+        }
 
     async def on_message(self, message):
         """
@@ -94,5 +388,32 @@ class ConverterProxy:
             return
 
         logger.info(f"Received message with correlation_id: {message.correlation_id}")
-        future: asyncio.Future = self.futures.pop(message.correlation_id)
-        future.set_result(message.body)
+        error = None
+        reason = (message.headers or {}).get(ERROR_HEADER)
+        if isinstance(reason, bytes):
+            reason = reason.decode()
+        if reason:
+            # Failed tasks are answered right away, the caller does not wait for the timeout
+            self.stats['failed'] += 1
+            error = reply_error(reason, message.body.decode(errors='replace'))
+            logger.error(f"Conversion failed: {reason} (correlation_id: {message.correlation_id})")
+        else:
+            try:
+                # Stored result is loaded (and removed) even if nobody waits for it
+                body = await asyncio.to_thread(self.claims.get, message.body, message.headers)
+            except ClaimCheckMissingException as e:
+                logger.error(f"{e} (correlation_id: {message.correlation_id})")
+                error = e
+        future: asyncio.Future = self.futures.pop(message.correlation_id, None)
+        if future is None or future.done():
+            # The caller timed out or went away, the conversion was wasted
+            self.stats['late_replies'] += 1
+            logger.warning(f"Nobody waits for correlation_id: {message.correlation_id}")
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            timing = (message.headers or {}).get(TIMING_REPORT_HEADER)
+            if isinstance(timing, bytes):
+                timing = timing.decode()
+            future.set_result(ConversionReply(body, message.content_encoding, json.loads(timing) if timing else None))
@@ -1,73 +1,582 @@
 import asyncio
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
+import multiprocessing
 import os
-from aio_pika import Message, connect
+import json
+import sys
+import time
+from typing import Callable, Tuple, Union
+import uuid
+from aio_pika import ExchangeType, Message, connect
 from loguru import logger
-from doc_parse import doc_to_docx, docx_to_json
-from utils import get_connection
+import torch
+from doc_parse import StageTimer, batching_stats, docx_to_json, enable_batching, model_load_stats, preload_models
+from cache import ResultCache
+from claim_check import ClaimCheckMissingException, ClaimCheckStore
+from compression import ACCEPT_ENCODING_HEADER, MessageCodec, UnsupportedEncodingException, parse_accept_encoding
+from doc_pool import DocConversionError, DocConversionPool
+from formats import DOC, UnsupportedFormatException, detect_format
+from metrics import Metrics, ModelLoadTimes, hit_ratio, serve_metrics, size_bucket
+from tracing import NULL_SPAN, Tracer, current_span
+from utils import (CLAIM_CHECK_MISSING, CONVERSION_FAILED, ERROR_HEADER, PUBLISHED_HEADER, TIMING_HEADER,
+                   TIMING_REPORT_HEADER, UNSUPPORTED_FORMAT, get_connection)
 
 
-async def process_message(message, exchange):
-    logger.info(f"Received task (reply to: {message.reply_to}, correlation_id: {message.correlation_id})")
-    
+# Stages traced as spans, the stages called per paragraph or table are only
+# added to the conversion span as their total time
+SPAN_STAGES = ('parse', 'process', 'analyse_tables', 'preclassify', 'export_json')
+
+
+def init_process(torch_threads: int, load_times: Union[multiprocessing.Queue, None] = None):
+    """
+    Initializes a conversion pool process: limits torch threads so that pool
+    processes do not oversubscribe cores and loads models once per process.
+
+    Args:
+        torch_threads (int): Number of intra-op threads torch may use.
+        load_times (multiprocessing.Queue, optional): Receives the pid of the
+            process and its model load times, for the metrics of the parent.
+    """
+    torch.set_num_threads(torch_threads)
+    logger.info(f"Preloading models (pid: {os.getpid()})")
+    preload_models()
+    logger.info(f"Models preloaded (pid: {os.getpid()}, seconds: {model_load_stats()})")
+    if load_times is not None:
+        load_times.put((os.getpid(), model_load_stats()))
+
+
+def convert_docx(data: bytes, correlation_id: str, timer: Union[StageTimer, None] = None) -> Union[str, None]:
+    """
+    Converts a .docx document to JSON. Runs inside a pool process.
+
+    Args:
+        data (bytes): The document content.
+        correlation_id (str): The task correlation id, used for logging.
+        timer (StageTimer, optional): Collects the time of the conversion stages.
+
+    Returns:
+        str: JSON content or None if the conversion failed.
+    """
+    logger.info(f"Starting conversion from DOCX to JSON (correlation_id: {correlation_id})")
     try:
-        logger.info(f"Starting conversion to JSON (correlation_id: {message.correlation_id})")
-        converted = docx_to_json(BytesIO(message.body))
+        return docx_to_json(BytesIO(data), timer)
     except Exception as e:
-        logger.exception(f"Error during direct conversion to JSON (correlation_id: {message.correlation_id})")
-        logger.info(f"Starting conversion from DOC to DOCX (correlation_id: {message.correlation_id})")
-        doc = BytesIO()
+        logger.exception(f"Error during conversion from DOCX to JSON (correlation_id: {correlation_id})")
+        return None
+
+
+def convert_docx_timed(data: bytes, correlation_id: str, spans: bool = False) -> Tuple[Union[str, None], dict]:
+    """
+    Same as `convert_docx`, but also returns the per-stage timing report. The
+    timer is created here, in the pool process, where the stages run.
+
+    Args:
+        data (bytes): The document content.
+        correlation_id (str): The task correlation id, used for logging.
+        spans (bool): Also record the calls of SPAN_STAGES for tracing.
+    """
+    timer = StageTimer(span_stages=SPAN_STAGES if spans else ())
+    converted = convert_docx(data, correlation_id, timer)
+    return converted, timer.report()
+
+
+def trace_id(correlation_id: Union[str, None]) -> Union[str, None]:
+    """
+    Makes a trace id of a UUID correlation id, None for other ids.
+    """
+    try:
+        return uuid.UUID(correlation_id).hex
+    except (TypeError, ValueError):
+        return None
+
+
+class ConversionWorker:
+    """
+    Consumes conversion tasks from RabbitMQ and publishes the results back.
+    """
+
+    def __init__(self, executor: Executor, doc_pool: DocConversionPool, cache: ResultCache,
+                 claims: ClaimCheckStore, codec: MessageCodec, cancelled_limit: int = 10000,
+                 timing: bool = False, load_times: Union[ModelLoadTimes, None] = None,
+                 tracer: Union[Tracer, None] = None, create_executor: Union[Callable[[], Executor], None] = None):
+        """
+        Initializes the ConversionWorker.
+
+        Args:
+            executor (Executor): Executor running DOCX to JSON conversions.
+            doc_pool (DocConversionPool): Pool converting .doc to .docx.
+            cache (ResultCache): Conversion results cache.
+            claims (ClaimCheckStore): Store of large message bodies.
+            codec (MessageCodec): Message bodies compression.
+            cancelled_limit (int): Number of cancelled correlation ids to remember.
+            timing (bool): Time the conversion stages of every document, not only
+                of the tasks asking for it.
+            load_times (ModelLoadTimes, optional): Model load times of the pool
+                processes, see `init_process`.
+            tracer (Tracer, optional): Records the spans of the tasks (None - off).
+            create_executor (Callable, optional): Starts a new executor when a process
+                of the current one dies (None - the executor is not replaced).
+        """
+        self.executor = executor
+        self.create_executor = create_executor
+        self.doc_pool = doc_pool
+        self.cache = cache
+        self.claims = claims
+        self.codec = codec
+        self.cancelled = OrderedDict()
+        self.cancelled_limit = cancelled_limit
+        self.timing = timing
+        self.exchange = None
+        self.tasks = set()
+        self.received = 0
+        self.max_tasks = 0
+        self.stopping = None
+        self.stats = {
+            'tasks': 0,
+            'converted': 0,
+            'failed': 0,
+            'skipped_expired': 0,
+            'skipped_cancelled': 0,
+            'unpublished_late': 0,
+            'requeued': 0,
+            'pool_restarts': 0,
+        }
+        self.load_times = load_times
+        self.tracer = tracer or Tracer('docparse-worker')
+        self.metrics = self.create_metrics()
+
+    def create_metrics(self) -> Metrics:
+        metrics = Metrics('docparse_worker')
+        self.queue_wait = metrics.histogram(
+            'queue_wait_seconds', 'Time from publishing a task to its delivery to the worker', ('queue',))
+        self.conversion_time = metrics.histogram(
+            'conversion_seconds', 'Conversion time of a document by its format and size bucket', ('format', 'size'))
+        metrics.gauge('tasks_in_progress', 'Tasks being processed', lambda: len(self.tasks))
+        metrics.gauge('model_load_seconds', 'Model load time by process and model',
+                      self.get_model_load, ('pid', 'model'))
+        metrics.gauge('cache_hit_ratio', 'Share of the cache lookups that found the result',
+                      lambda: hit_ratio(self.cache.stats))
+        metrics.stats('stats', 'Worker statistics', self.get_stats)
+        return metrics
+
+    def get_model_load(self) -> dict:
+        model_load = self.load_times.get() if self.load_times is not None else {}
+        # Models loaded by this process, in thread or supervisor mode
+        for model, seconds in model_load_stats().items():
+            model_load[(os.getpid(), model)] = seconds
+        return model_load
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            'cache': self.cache.stats,
+            'claims': self.claims.stats,
+            'compression': self.codec.stats,
+            'doc_pool': self.doc_pool.stats,
+            'batching': batching_stats(),
+            'tracing': self.tracer.stats,
+        }
+
+    def replace_executor(self, broken: Executor):
+        """
+        Replaces an executor broken by a dead process, e.g. killed by the OOM
+        killer. Tasks of the same executor fail together, it is replaced once.
+        """
+        if self.executor is not broken or self.create_executor is None:
+            return
+        logger.error("Conversion pool broken, starting a new one")
+        self.stats['pool_restarts'] += 1
+        self.executor = self.create_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def on_cancel(self, message):
+        """
+        Remembers a task cancelled by ConverterProxy.
+        """
+        self.cancelled[message.correlation_id] = True
+        while len(self.cancelled) > self.cancelled_limit:
+            self.cancelled.popitem(last=False)
+
+    def should_skip(self, message) -> bool:
+        """
+        Checks whether nobody waits for the task result anymore.
+        """
+        if message.correlation_id in self.cancelled:
+            self.stats['skipped_cancelled'] += 1
+            logger.info(f"Task cancelled by client, skipped (correlation_id: {message.correlation_id})")
+            return True
+        deadline = (message.headers or {}).get('x-deadline')
+        if deadline and time.time() > float(deadline):
+            self.stats['skipped_expired'] += 1
+            logger.info(f"Task deadline passed, skipped (correlation_id: {message.correlation_id})")
+            return True
+        return False
+
+    async def process_message(self, message):
+        logger.info(f"Received task (reply to: {message.reply_to}, correlation_id: {message.correlation_id})")
+        self.stats['tasks'] += 1
+        published = (message.headers or {}).get(PUBLISHED_HEADER)
+        if published:
+            self.queue_wait.observe(max(time.time() - float(published), 0), message.routing_key)
+            # Sibling of the task span, both are children of the proxy request
+            self.tracer.start_span('queue_wait', parent=self.tracer.extract(message.headers),
+                                   attributes={'queue': message.routing_key},
+                                   start_ns=int(float(published) * 1e9)).end()
+        if self.should_skip(message):
+            return
+
         try:
-            doc_to_docx(BytesIO(message.body), doc)
-        except Exception as e:
-            logger.exception(f"Error during conversion from DOC to DOCX (correlation_id: {message.correlation_id})")
+            # A task redelivered after a crash needs the stored document again,
+            # it is removed once the reply is published
+            data = await asyncio.to_thread(self.claims.get, message.body, message.headers, False)
+            data = await asyncio.to_thread(self.codec.decode, data, message.content_encoding)
+        except (ClaimCheckMissingException, UnsupportedEncodingException) as e:
+            self.stats['failed'] += 1
+            logger.error(f"{e} (correlation_id: {message.correlation_id})")
+            reason = CLAIM_CHECK_MISSING if isinstance(e, ClaimCheckMissingException) else CONVERSION_FAILED
+            await self.publish_error(message, reason, str(e))
+            return
+
+        key = self.cache.key(data)
+        converted = await asyncio.to_thread(self.cache.get, key)
+        if converted is not None:
+            logger.info(f"Conversion result found in cache (correlation_id: {message.correlation_id}, cache: {self.cache.stats})")
+            (current_span.get() or NULL_SPAN).set_attribute('cached', True)
+            await self.publish_result(message, converted)
             return
-        doc.seek(0)
-        logger.info(f"Starting conversion from DOCX to JSON (correlation_id: {message.correlation_id})")
+
         try:
-            converted = docx_to_json(doc)
-        except Exception as e:
-            logger.exception(f"Error during conversion from DOCX to JSON (correlation_id: {message.correlation_id})")
+            doc_format = detect_format(data)
+        except UnsupportedFormatException as e:
+            self.stats['failed'] += 1
+            logger.error(f"Unsupported document format: {e} (correlation_id: {message.correlation_id})")
+            await self.publish_error(message, UNSUPPORTED_FORMAT, str(e))
             return
-    
-    logger.info(f"Conversion completed (correlation_id: {message.correlation_id})")
-    
-    await exchange.publish(
-        Message(
-            body=converted.encode(),
-            correlation_id=message.correlation_id
-        ),
-        routing_key=message.reply_to
-    )
-    logger.info(f"Message published back to exchange (correlation_id: {message.correlation_id})")
-    logger.info(f"Task complete (correlation_id: {message.correlation_id})")
-
-
-async def main():
-    try:
+        logger.info(f"Detected {doc_format} format (correlation_id: {message.correlation_id})")
+
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        size = len(data)
+        if doc_format == DOC:
+            logger.info(f"Starting conversion from DOC to DOCX (correlation_id: {message.correlation_id})")
+            span = self.tracer.start_span('doc_to_docx', attributes={'document.bytes': size})
+            try:
+                data = await loop.run_in_executor(None, self.doc_pool.convert, data)
+            except DocConversionError as e:
+                self.stats['failed'] += 1
+                span.set_error(str(e))
+                logger.error(f"Error during conversion from DOC to DOCX: {e} (correlation_id: {message.correlation_id})")
+                await self.publish_error(message, CONVERSION_FAILED, 'DOC to DOCX conversion failed')
+                return
+            finally:
+                span.end()
+                logger.info(f"DOC pool stats: {self.doc_pool.stats}")
+            if self.should_skip(message):
+                return
+
+        try:
+            converted, report = await self.convert(data, message)
+        except BrokenProcessPool:
+            # Another worker retries the task, unless it was delivered again
+            # already: the document itself may be killing the pool processes
+            if message.redelivered or self.create_executor is None:
+                raise
+            self.stats['requeued'] += 1
+            logger.error(f"Conversion pool broken, task requeued (correlation_id: {message.correlation_id})")
+            await message.reject(requeue=True)
+            return
+        if converted is None:
+            self.stats['failed'] += 1
+            await self.publish_error(message, CONVERSION_FAILED, 'DOCX to JSON conversion failed')
+            return
+        self.stats['converted'] += 1
+        self.conversion_time.observe(time.perf_counter() - start, doc_format, size_bucket(size))
+
+        logger.info(f"Conversion completed (correlation_id: {message.correlation_id})")
+        inference_stats = batching_stats()
+        if inference_stats:
+            logger.info(f"Inference batching stats: {inference_stats}")
+        converted = converted.encode()
+        await asyncio.to_thread(self.cache.put, key, converted)
+        if self.should_skip(message):
+            # The result stays in the cache for a retry
+            self.stats['unpublished_late'] += 1
+            logger.info(f"Worker stats: {self.stats}")
+            return
+        await self.publish_result(message, converted, report)
+
+    async def convert(self, data: bytes, message) -> Tuple[Union[str, None], Union[dict, None]]:
+        """
+        Converts a .docx document in the executor. When the task is traced, the
+        stages of the conversion become spans under the conversion span.
+
+        Returns:
+            tuple: JSON content (None if the conversion failed) and the timing
+                report if it was asked for.
+
+        Raises:
+            BrokenProcessPool: If a process of the executor died, the executor is
+                replaced for the next tasks.
+        """
+        executor = self.executor
+        try:
+            return await self.convert_in(executor, data, message)
+        except BrokenProcessPool:
+            self.replace_executor(executor)
+            raise
+
+    async def convert_in(self, executor: Executor, data: bytes,
+                         message) -> Tuple[Union[str, None], Union[dict, None]]:
+        loop = asyncio.get_running_loop()
+        timing = self.timing or bool((message.headers or {}).get(TIMING_HEADER))
+        with self.tracer.start_span('convert_docx', attributes={'document.bytes': len(data)}) as span:
+            traced = span.context is not None and span.context.sampled
+            if not timing and not traced:
+                return await loop.run_in_executor(executor, convert_docx, data, message.correlation_id), None
+            converted, report = await loop.run_in_executor(
+                executor, convert_docx_timed, data, message.correlation_id, traced)
+            if traced:
+                self.trace_stages(span, report)
+            if converted is None:
+                span.set_error('Conversion failed')
+        if not timing:
+            return converted, None
+        logger.info(f"Conversion timing (correlation_id: {message.correlation_id}): {json.dumps(report, ensure_ascii=False)}")
+        return converted, report
+
+    def trace_stages(self, span, report: dict):
+        # Recorded stage calls become spans nested by their time ranges
+        stack = [span]
+        for stage in sorted(report.pop('spans', []), key=lambda stage: (stage['start_ns'], -stage['end_ns'])):
+            while len(stack) > 1 and stage['start_ns'] >= stack[-1].end_ns:
+                stack.pop()
+            child = self.tracer.start_span(stage['name'], parent=stack[-1], start_ns=stage['start_ns'])
+            child.end(stage['end_ns'])
+            stack.append(child)
+        # Stages called per paragraph or table are summed up
+        for name, stage in report['stages'].items():
+            span.set_attribute(f'stage.{name}.seconds', stage['seconds'])
+            span.set_attribute(f'stage.{name}.calls', stage['calls'])
+        span.set_attribute('tables', report['tables']['count'])
+
+    async def publish_result(self, message, converted: bytes, report: Union[dict, None] = None):
+        with self.tracer.start_span('publish_reply', attributes={'reply.bytes': len(converted)}):
+            # Proxies that do not announce encodings get uncompressed results
+            accept = parse_accept_encoding((message.headers or {}).get(ACCEPT_ENCODING_HEADER))
+            body, encoding = await asyncio.to_thread(self.codec.encode, converted, accept)
+            body, headers = await asyncio.to_thread(self.claims.put, body)
+            if report is not None:
+                headers[TIMING_REPORT_HEADER] = json.dumps(report)
+            await self.exchange.publish(
+                Message(
+                    body=body,
+                    correlation_id=message.correlation_id,
+                    headers=headers,
+                    content_encoding=encoding
+                ),
+                routing_key=message.reply_to
+            )
+        await asyncio.to_thread(self.claims.remove, message.headers)
+        logger.info(f"Message published back to exchange (correlation_id: {message.correlation_id})")
+        logger.info(f"Task complete (correlation_id: {message.correlation_id})")
+
+    async def publish_error(self, message, reason: str, detail: str):
+        """
+        Replies to a failed task with the reason of the failure, so the caller
+        gets the error at once instead of waiting for its timeout.
+
+        Args:
+            message (aio_pika.IncomingMessage): The task.
+            reason (str): UNSUPPORTED_FORMAT, CONVERSION_FAILED or CLAIM_CHECK_MISSING.
+            detail (str): The error description for the caller.
+        """
+        if not message.reply_to:
+            return
+        try:
+            await self.exchange.publish(
+                Message(body=detail.encode(), correlation_id=message.correlation_id, headers={ERROR_HEADER: reason}),
+                routing_key=message.reply_to
+            )
+        except Exception:
+            logger.exception(f"Failed to publish error reply (correlation_id: {message.correlation_id})")
+            return
+        await asyncio.to_thread(self.claims.remove, message.headers)
+        logger.info(f"Error reply published: {reason} (correlation_id: {message.correlation_id})")
+
+    async def handle_message(self, message):
+        # Continues the trace of the proxy request, tasks published without one
+        # start a trace with the correlation id as its id
+        span = self.tracer.start_span('worker.task', parent=self.tracer.extract(message.headers),
+                                      attributes={'correlation_id': message.correlation_id or ''},
+                                      trace_id=trace_id(message.correlation_id))
+        with span:
+            try:
+                # Tasks requeued by process_message are not acknowledged
+                async with message.process(requeue=False, ignore_processed=True):
+                    await self.process_message(message)
+            except Exception as e:
+                span.set_error(f'{type(e).__name__}: {e}')
+                self.stats['failed'] += 1
+                logger.exception(f"Processing error (correlation_id: {message.correlation_id})")
+                await self.publish_error(message, CONVERSION_FAILED, 'Conversion failed')
+
+    async def on_task(self, message):
+        if self.stopping.is_set():
+            # Delivered after the tasks limit, let another worker take it
+            await message.reject(requeue=True)
+            return
+        # Conversion runs in the executor, the loop stays free for
+        # heartbeats, acknowledgements and replies
+        task = asyncio.create_task(self.handle_message(message))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        self.received += 1
+        if self.max_tasks and self.received >= self.max_tasks:
+            logger.info(f"Tasks limit reached ({self.max_tasks}), stop consuming")
+            self.stopping.set()
+
+    async def run(self, prefetch: int, large_prefetch: int, max_tasks: int = 0):
+        """
+        Consumes tasks from the small and large documents lanes until the connection
+        is closed or `max_tasks` tasks are received.
+
+        Each lane is consumed on its own channel with its own prefetch, so large
+        documents never hold more than `large_prefetch` conversion slots and the
+        rest of the pool keeps serving small documents.
+
+        Args:
+            prefetch (int): Prefetch count of the small documents lane.
+            large_prefetch (int): Prefetch count of the large documents lane.
+            max_tasks (int): Stop consuming after this number of tasks (0 - never).
+        """
+        self.tasks = set()
+        self.received = 0
+        self.max_tasks = max_tasks
+        self.stopping = asyncio.Event()
         async with await get_connection() as connection:
             logger.info("Connection to RabbitMQ established")
-            
+            connection.close_callbacks.add(lambda *args: self.stopping.set())
+
             async with connection.channel() as channel:
                 logger.info("Channel opened")
-                
-                exchange = channel.default_exchange
-                
+                self.exchange = channel.default_exchange
+
+                # Cancellations are broadcast to every worker
+                cancel_exchange = await channel.declare_exchange(
+                    os.environ.get('CONVERTER_CANCEL_EXCHANGE', default='convert.cancel'),
+                    ExchangeType.FANOUT
+                )
+                cancel_queue = await channel.declare_queue(exclusive=True)
+                await cancel_queue.bind(cancel_exchange)
+                await cancel_queue.consume(self.on_cancel, no_ack=True)
+
                 queue_name = os.environ.get('CONVERTER_QUEUE', default='convert')
-                queue = await channel.declare_queue(queue_name)  # Await the coroutine
-                logger.info("Queue declared")
-                
-                logger.info("Waiting for tasks")
-                async with queue.iterator() as iterator:
-                    async for message in iterator:
-                        try:
-                            async with message.process(requeue=False):
-                                await process_message(message, exchange)
-                        except Exception as e:
-                            logger.exception(f"Processing error (correlation_id: {message.correlation_id})")
+                lanes = [
+                    (queue_name, prefetch),
+                    (os.environ.get('CONVERTER_LARGE_QUEUE', default=f'{queue_name}.large'), large_prefetch),
+                ]
+                consumers = []
+                for lane_name, lane_prefetch in lanes:
+                    lane_channel = await connection.channel()
+                    # Broker delivers at most `lane_prefetch` unacknowledged tasks of the lane
+                    await lane_channel.set_qos(prefetch_count=lane_prefetch)
+                    queue = await lane_channel.declare_queue(lane_name)
+                    consumer_tag = await queue.consume(self.on_task)
+                    consumers.append((lane_channel, queue, consumer_tag))
+                    logger.info(f"Waiting for tasks (queue: {lane_name}, prefetch: {lane_prefetch})")
+
+                await self.stopping.wait()
+                if not connection.is_closed:
+                    for lane_channel, queue, consumer_tag in consumers:
+                        await queue.cancel(consumer_tag)
+                # Let started tasks publish their replies before the channels close
+                await asyncio.gather(*self.tasks)
+                for lane_channel, _, _ in consumers:
+                    await lane_channel.close()
 
+
+async def main(executor: Union[Executor, None] = None, prefetch: Union[int, None] = None,
+               max_tasks: int = 0, metrics_port: Union[int, None] = None):
+    """
+    Consumes conversion tasks from RabbitMQ.
+
+    Args:
+        executor (Executor, optional): Executor running conversions. By default
+            a process pool of WORKER_PROCESSES processes is created.
+        prefetch (int, optional): Small documents lane prefetch count, WORKER_PREFETCH by default.
+        max_tasks (int): Stop consuming after this number of tasks (0 - never).
+        metrics_port (int, optional): Port of the metrics exporter (0 - disabled),
+            WORKER_METRICS_PORT by default.
+    """
+    processes = int(os.environ.get('WORKER_PROCESSES', default=str(os.cpu_count())))
+    load_times = None
+    create_executor = None
+    batch_size = int(os.environ.get('INFERENCE_BATCH_SIZE', default='1'))
+    own_executor = executor is None
+    if own_executor and batch_size > 1:
+        # Conversions run in threads of this process, so classifier calls of
+        # all documents meet in one batching classifier
+        init_process(int(os.environ.get('WORKER_TORCH_THREADS', default=str(processes))))
+        enable_batching(batch_size, float(os.environ.get('INFERENCE_MAX_WAIT_MS', default='5')) / 1000)
+        executor = ThreadPoolExecutor(max_workers=processes)
+        logger.info(f"Conversion threads started (threads: {processes}, inference batch size: {batch_size})")
+    elif own_executor:
+        torch_threads = int(os.environ.get('WORKER_TORCH_THREADS', default='1'))
+        load_times = ModelLoadTimes()
+
+        def create_executor():
+            return ProcessPoolExecutor(
+                max_workers=processes,
+                initializer=init_process,
+                initargs=(torch_threads, load_times.queue)
+            )
+
+        executor = create_executor()
+        logger.info(f"Conversion pool started (processes: {processes})")
+    if prefetch is None:
+        prefetch = int(os.environ.get('WORKER_PREFETCH', default=str(processes)))
+    # Share of the conversion slots large documents may take
+    large_prefetch = int(os.environ.get('WORKER_LARGE_PREFETCH', default=str(max(1, prefetch // 4))))
+    # Aspose.Words runs in separate processes, so a pathological .doc cannot
+    # bloat or wedge the worker itself
+    doc_pool = DocConversionPool.from_env()
+    worker = ConversionWorker(executor, doc_pool, ResultCache.from_env(), ClaimCheckStore.from_env(),
+                              MessageCodec.from_env(),
+                              timing=os.environ.get('CONVERSION_TIMING', default='0') == '1',
+                              load_times=load_times, tracer=Tracer.from_env('docparse-worker'),
+                              create_executor=create_executor)
+    if metrics_port is None:
+        metrics_port = int(os.environ.get('WORKER_METRICS_PORT', default='0'))
+    metrics_server = await serve_metrics(worker.metrics, metrics_port) if metrics_port else None
+    try:
+        await worker.run(prefetch, large_prefetch, max_tasks)
     except Exception as e:
         logger.exception("Main error")
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        worker.tracer.close()
+        doc_pool.close()
+        if own_executor:
+            worker.executor.shutdown(cancel_futures=True)
+
+
+def run_child(max_tasks: int):
+    """
+    Supervisor child entry point: models are already loaded by the parent, so
+    conversions run in a single thread of this process. Children would compete
+    for the metrics port, so they do not export metrics.
+    """
+    asyncio.run(main(ThreadPoolExecutor(max_workers=1), prefetch=1, max_tasks=max_tasks, metrics_port=0))
+
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    if os.environ.get('WORKER_MODE', default='pool') == 'supervisor':
+        from supervisor import Supervisor
+        # A non-zero exit code tells the orchestrator the children keep failing
+        sys.exit(Supervisor.from_env(run_child).run())
+    else:
+        asyncio.run(main())